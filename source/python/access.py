@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import threading
+import time
+from datetime import datetime
+from psycopg2.extras import execute_values
+
+from typing import Self
+from typing import Any, Callable, ContextManager, Dict, Optional
+
+
+class AccessRecorder:
+    """
+    最終アクセス日時の遅延書き込み
+
+    auth.users.last_access_at の更新をプロセス内にためておき、一定間隔で
+    複数行をまとめた1文の UPDATE で反映する。
+    書き込みはバックグラウンドのスレッドで行い、record はメモリへの追加のみ行う。
+
+    Parameters:
+        connect: DB接続を返す関数（with 文で使え、終了時に commit されるもの）
+                 例: ConnectionPool.connection、lambda: psycopg2.connect(dsn)
+        interval: 書き込み間隔（秒）。0以下の場合は定期的には書き込まない（上限を超えた時と flush 時のみ）
+        max_staleness: 反映遅れの上限（秒）。これより古い未反映分があれば、record 時にバックグラウンドの書き込みを起こす
+        max_pending: ためておくユーザ数の上限。超えた場合は、record 時にバックグラウンドの書き込みを起こす
+    """
+
+    def __init__(self: Self, connect: Callable[[], ContextManager[Any]], interval: float = 5.0,
+                 max_staleness: float = 30.0, max_pending: int = 10000) -> None:
+        self._connect = connect
+        self._interval = interval
+        self._max_staleness = max_staleness
+        self._max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[int, datetime] = {}
+        self._oldest: Optional[float] = None
+
+        self.recorded = 0   # record の呼び出し回数
+        self.flushed = 0    # DBへ反映した行数
+        self.flushes = 0    # UPDATE の実行回数
+
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = threading.Thread(target=self._run, name="AccessRecorder", daemon=True)
+        self._thread.start()
+        return
+
+    def record(self: Self, uid: int, at: Optional[datetime] = None) -> None:
+        """
+        アクセスを記録する
+
+        Parameters:
+            uid: ユーザID
+            at: アクセス日時。省略時は現在日時
+        """
+        if at is None:
+            at = datetime.now()
+
+        with self._lock:
+            prev = self._pending.get(uid)
+            if prev is None or prev < at:
+                self._pending[uid] = at
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self.recorded += 1
+            overdue = time.monotonic() - self._oldest >= self._max_staleness
+            full = len(self._pending) >= self._max_pending
+
+        if overdue or full:
+            # 要求の処理中には書き込まない（バックグラウンドのスレッドに任せる）
+            self._wake.set()
+        return
+
+    def pending(self: Self) -> int:
+        """
+        未反映のユーザ数
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self: Self) -> int:
+        """
+        ためている最終アクセス日時をDBへ反映する
+
+        Returns:
+            反映した行数（ためていたユーザ数）
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+                self._oldest = None
+
+            if not pending:
+                return 0
+
+            try:
+                with self._connect() as conn:
+                    with conn.cursor() as cur:
+                        # 既により新しい日時が入っている行は更新しない
+                        execute_values(cur, """
+                            UPDATE auth.users AS u
+                            SET last_access_at = v.at
+                            FROM (VALUES %s) AS v(uid, at)
+                            WHERE u.uid = v.uid
+                              AND (u.last_access_at IS NULL OR u.last_access_at < v.at)
+                        """, list(pending.items()), template="(%s, %s::timestamptz)", page_size=len(pending))
+                    conn.commit()
+            except Exception as e:
+                print(f"DBエラー: {e}")
+                # 書き込めなかった分は戻して次回に回す
+                with self._lock:
+                    for uid, at in pending.items():
+                        prev = self._pending.get(uid)
+                        if prev is None or prev < at:
+                            self._pending[uid] = at
+                    if self._oldest is None:
+                        self._oldest = time.monotonic()
+                return 0
+
+            self.flushes += 1
+            self.flushed += len(pending)
+            return len(pending)
+
+    def close(self: Self) -> None:
+        """
+        バックグラウンドの書き込みを停止し、残りを反映する
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        return
+
+    def __enter__(self: Self) -> Self:
+        return self
+
+    def __exit__(self: Self, *args: Any) -> None:
+        self.close()
+        return
+
+    def _run(self: Self) -> None:
+        while True:
+            # 書き込み間隔の経過、または record からの要求で書き込む
+            self._wake.wait(self._interval if self._interval > 0 else None)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            self.flush()
@@ -7,12 +7,20 @@ sys.dont_write_bytecode = True
 warnings.filterwarnings('ignore')
 
 import psycopg2
+from psycopg2.extras import execute_values
 import random
 import zlib
 from datetime import datetime
 
 from typing import Self
-from typing import TypedDict, List, Optional
+from typing import TypedDict, NotRequired, List, Optional, Any, ContextManager, Dict, Tuple
+
+from access import AccessRecorder
+from cache import NotifyListener, TTLCache
+from icon import IconCache
+from pool import ConnectionPool
+from prepared import PreparedStatements
+from session import PostgresSessionStore, SessionStore
 
 class FeatureInfo(TypedDict):
     fid: int
@@ -20,13 +28,226 @@ class FeatureInfo(TypedDict):
     feature_url: str
     icon_data: Optional[bytes]
     icon_mime_type: Optional[str]
+    icon_hash: NotRequired[Optional[str]]   # アイコン内容のハッシュ値（with_icon=False の場合）
+    icon_url: NotRequired[Optional[str]]    # アイコン取得URL（with_icon=False かつ icon_url 指定時）
+
+# 機能一覧の変更通知チャネル（test_environment/make_menu_notify.sql のトリガーが通知する）
+# ペイロードはユーザ名称。'*' は全ユーザ
+MENU_CHANNEL: str = "auth_menu_changed"
+
+# 認証の各文（Authorize と AsyncAuthorize で共有する）
+
+# ユーザID取得（パラメータ: ユーザ名称）
+_SELECT_UID: str = "SELECT uid FROM auth.users WHERE uname = %s"
+
+# マジックナンバーの設定（パラメータ: マジックナンバー, 最終アクセス日時, uid）
+_SET_MAGIC: str = """
+    UPDATE auth.users
+    SET magic_number = %s,
+        sequence_number = NULL,
+        last_access_at = %s
+    WHERE uid = %s
+"""
+
+# マジックナンバーの設定（1文版。パラメータ: マジックナンバー, 最終アクセス日時, ユーザ名称）
+_SET_MAGIC_ATOMIC: str = """
+    UPDATE auth.users
+    SET magic_number = %s,
+        sequence_number = NULL,
+        last_access_at = %s
+    WHERE uname = %s
+    RETURNING uid
+"""
+
+# 認証のユーザ確認（パラメータ: ユーザ名称, マジックナンバー）
+_UNLOCK_SELECT: str = "SELECT uid, upass FROM auth.users WHERE uname = %s and magic_number = %s"
+
+# 認証（1文版。パラメータ: シーケンス管理用番号, 最終アクセス日時, ユーザ名称, マジックナンバー）
+_UNLOCK_ATOMIC: str = """
+    UPDATE auth.users
+    SET magic_number = NULL,
+        sequence_number = %s,
+        last_access_at = %s
+    WHERE uname = %s AND magic_number = %s
+    RETURNING uid, upass
+"""
+
+# セッション保存先の利用時のユーザ確認（パラメータ: ユーザ名称。auth.users に切り替え前の値が残っているかも返す）
+_STORE_SELECT_USER: str = """
+    SELECT uid, magic_number IS NOT NULL OR sequence_number IS NOT NULL
+    FROM auth.users WHERE uname = %s
+"""
+
+# 切り替え前の値を消す（パラメータ: uid）
+_CLEAR_SESSION_COLUMNS: str = "UPDATE auth.users SET magic_number = NULL, sequence_number = NULL WHERE uid = %s"
+
+# セッション保存先の利用時のパスワード取得（パラメータ: ユーザ名称）
+_STORE_SELECT_PASSWORD: str = "SELECT uid, upass FROM auth.users WHERE uname = %s"
+
+# アイコン取得（パラメータ: アイコンのハッシュ値）
+_SELECT_ICON: str = """
+    SELECT icon_data, icon_mime_type
+    FROM auth.features
+    WHERE icon_hash = %s
+    LIMIT 1
+"""
+
+# 頻繁に実行する文（test_query_plan.py で実行計画を検証する）
+
+# 認証延長のユーザ確認（パラメータ: ユーザ名称, シーケンス管理用番号）
+_EXTEND_SELECT: str = """
+    SELECT uid FROM auth.users
+    WHERE uname = %s AND sequence_number = %s
+"""
+
+# 認証延長の更新（パラメータ: シーケンス管理用番号, 最終アクセス日時, uid）
+_EXTEND_UPDATE: str = """
+    UPDATE auth.users
+    SET magic_number = NULL,
+        sequence_number = %s,
+        last_access_at = %s
+    WHERE uid = %s
+"""
+
+# 認証延長（1文版。パラメータ: 新しいシーケンス管理用番号, 最終アクセス日時, ユーザ名称, シーケンス管理用番号）
+_EXTEND_ATOMIC: str = """
+    UPDATE auth.users
+    SET magic_number = NULL,
+        sequence_number = %s,
+        last_access_at = %s
+    WHERE uname = %s AND sequence_number = %s
+    RETURNING uid
+"""
+
+# 認証の更新（_EXTEND_UPDATE と同じ文。パラメータ: シーケンス管理用番号, 最終アクセス日時, uid）
+_UNLOCK_UPDATE: str = _EXTEND_UPDATE
+
+
+def _feature_list_sql(with_icon: bool) -> str:
+    """
+    機能一覧取得の文（パラメータ: ユーザ名称）
+    """
+    return f"""
+        SELECT f.fid, f.fname, f.feature_url, {"f.icon_data" if with_icon else "f.icon_hash"}, f.icon_mime_type
+        FROM auth.users u
+        JOIN auth.user_features uf ON u.uid = uf.uid
+        JOIN auth.features f ON uf.fid = f.fid
+        WHERE u.uname = %s AND (f.is_deleted = false OR f.is_deleted IS NULL)
+        ORDER BY uf.display_order
+    """
+
+
+def _feature_list(rows: List[Tuple[Any, ...]], with_icon: bool, icon_url: Optional[str]) -> List[FeatureInfo]:
+    """
+    _feature_list_sql の結果を FeatureInfo にする
+    """
+    if with_icon:
+        return [
+            FeatureInfo(
+                fid=row[0],
+                fname=row[1],
+                feature_url=row[2],
+                icon_data=row[3],
+                icon_mime_type=row[4]
+            )
+            for row in rows
+        ]
+    return [
+        FeatureInfo(
+            fid=row[0],
+            fname=row[1],
+            feature_url=row[2],
+            icon_data=None,
+            icon_mime_type=row[4],
+            icon_hash=row[3],
+            icon_url=icon_url.format(row[3]) if icon_url is not None and row[3] is not None else None
+        )
+        for row in rows
+    ]
+
 
 class Authorize:
 
     _dsn: str = ""
-
-    def __init__(self: Self, dbhost: str, dbport: int, dbname: str, dbuser: str, dbpass: str) -> None:
+    _pool: Optional[ConnectionPool] = None
+    _atomic: bool = False
+    _recorder: Optional[AccessRecorder] = None
+    _store: Optional[SessionStore] = None
+    _icons: IconCache
+    _icon_url: Optional[str] = None
+    _menu_cache: Optional[TTLCache] = None
+    _prepared: Optional[PreparedStatements] = None
+
+    def __init__(self: Self, dbhost: str, dbport: int, dbname: str, dbuser: str, dbpass: str, pool: Optional[ConnectionPool] = None, atomic: bool = False,
+                 access_recorder: Optional[AccessRecorder] = None, session_store: Optional[SessionStore] = None,
+                 icon_cache: Optional[IconCache] = None, icon_url: Optional[str] = None, menu_cache: Optional[TTLCache] = None,
+                 prepared: Optional[PreparedStatements] = None) -> None:
+        """
+        Parameters:
+            dbhost, dbport, dbname, dbuser, dbpass: DB接続情報
+            pool: コネクションプール。指定した場合は呼び出し毎の接続を行わず、プールから借りる
+            atomic: True の場合、認証の各ステップを UPDATE ... RETURNING の1文で行う
+                    （SELECT と UPDATE の間で他の要求に割り込まれない）
+            access_recorder: 指定した場合、last_access_at は各処理では更新せず、
+                    AccessRecorder にためてまとめて書き込む。DBを使わない session_store と合わせて指定する
+                    （auth.users で認証する場合は、各処理がシーケンス管理用番号の更新で行を書き換えるため、
+                    遅延書き込みで書き込みは減らない。この組み合わせは ValueError）
+            session_store: 指定した場合、マジックナンバー・シーケンス管理用番号を auth.users ではなく
+                    この保存先で管理する。try_unlock_extend はDBに接続しない
+                    （last_access_at を更新する場合は access_recorder も指定する）。
+                    PostgresSessionStore 以外の場合、auth.users の magic_number / sequence_number は
+                    セッション状態を表さない（get_magic_number で該当ユーザの値を NULL にする。
+                    ログインしていないユーザの値も消す場合は、切り替え時に
+                    UPDATE auth.users SET magic_number = NULL, sequence_number = NULL を実行する）
+            icon_cache: get_icon で使うアイコンのキャッシュ。省略時はインスタンス毎に作成する
+            icon_url: get_feature_list(with_icon=False) で返すアイコン取得URLの書式。
+                    {} がアイコンのハッシュ値に置き換わる（例: '/portal/menu/api/icon/{}'）
+            menu_cache: 指定した場合、get_feature_list の結果をユーザ毎にキャッシュする。
+                    変更時の破棄は listen_menu_changes で開始する
+            prepared: 指定した場合、try_unlock_extend の文を接続毎に PREPARE して名前で実行する。
+                    pool と合わせて指定する（pool がない場合は ValueError）。Expense と同じインスタンスを共有できる
+        """
         self._dsn = f"host={dbhost} port={dbport} dbname={dbname} user={dbuser} password={dbpass}"
+        self._pool = pool
+        self._atomic = atomic
+        if access_recorder is not None and (session_store is None or isinstance(session_store, PostgresSessionStore)):
+            raise ValueError("access_recorder はDBを使わない session_store と合わせて指定してください")
+        self._recorder = access_recorder
+        self._store = session_store
+        self._icons = icon_cache if icon_cache is not None else IconCache()
+        self._icon_url = icon_url
+        self._menu_cache = menu_cache
+        if prepared is not None and pool is None:
+            raise ValueError("prepared は pool と合わせて指定してください")
+        self._prepared = prepared
+        return
+
+    def _connect(self: Self) -> ContextManager[Any]:
+        """
+        DB接続を取得する
+
+        プール未指定時は毎回接続する。いずれも with 文の終了時に commit（例外時は rollback）される。
+        """
+        if self._pool is not None:
+            return self._pool.connection()
+        return psycopg2.connect(self._dsn)
+
+    def _execute(self: Self, cur: Any, name: str, sql: str, params: Tuple[Any, ...]) -> None:
+        """
+        頻繁に実行する文の実行（prepared 指定時は準備済み文で実行する）
+        """
+        if self._prepared is not None:
+            self._prepared.execute(cur, name, sql, params)
+        else:
+            cur.execute(sql, params)
+        return
+
+    def _record_access(self: Self, uid: int) -> None:
+        """
+        セッション保存先の利用時に、最終アクセス日時を記録する（access_recorder 指定時）
+        """
+        if self._recorder is not None:
+            self._recorder.record(uid)
         return
 
     def get_magic_number(self: Self, user: str) -> int:
@@ -43,11 +264,16 @@ class Authorize:
                     -9:   処理異常
         """
 
+        if self._store is not None:
+            return self._get_magic_number_store(user)
+        if self._atomic:
+            return self._get_magic_number_atomic(user)
+
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
                     # ユーザIDを取得
-                    cur.execute("SELECT uid FROM auth.users WHERE uname = %s", (user,))
+                    cur.execute(_SELECT_UID, (user,))
                     row = cur.fetchone()
 
                     if row is None:
@@ -59,13 +285,7 @@ class Authorize:
                     mnum = random.randint(100000, 999999)
 
                     # ユーザ情報を更新
-                    cur.execute("""
-                        UPDATE auth.users
-                        SET magic_number = %s,
-                            sequence_number = NULL,
-                            last_access_at = %s
-                        WHERE uid = %s
-                    """, (mnum, datetime.now(), uid))
+                    cur.execute(_SET_MAGIC, (mnum, datetime.now(), uid))
 
                     if cur.rowcount == 0:
                         return -9  # 更新されなかった場合
@@ -94,11 +314,16 @@ class Authorize:
                     -9:   処理異常
         """
 
+        if self._store is not None:
+            return self._try_unlock_store(user, magic, pass_hash)
+        if self._atomic:
+            return self._try_unlock_atomic(user, magic, pass_hash)
+
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
                     # ユーザ情報の取得
-                    cur.execute("SELECT uid, upass FROM auth.users WHERE uname = %s and magic_number = %s", (user, magic,))
+                    cur.execute(_UNLOCK_SELECT, (user, magic))
                     row = cur.fetchone()
 
                     if row is None:
@@ -117,13 +342,7 @@ class Authorize:
                     snum = random.randint(100000, 999999)
 
                     # ユーザ情報を更新
-                    cur.execute("""
-                        UPDATE auth.users
-                        SET magic_number = NULL,
-                            sequence_number = %s,
-                            last_access_at = %s
-                        WHERE uid = %s
-                    """, (snum, datetime.now(), uid))
+                    cur.execute(_UNLOCK_UPDATE, (snum, datetime.now(), uid))
 
                     if cur.rowcount == 0:
                         return -1  # 更新失敗
@@ -149,14 +368,16 @@ class Authorize:
             number or None: シーケンス管理用番号
         """
 
+        if self._store is not None:
+            return self._try_unlock_extend_store(user, sequence)
+        if self._atomic:
+            return self._try_unlock_extend_atomic(user, sequence)
+
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
                     # ユーザ確認
-                    cur.execute("""
-                        SELECT uid FROM auth.users
-                        WHERE uname = %s AND sequence_number = %s
-                    """, (user, sequence))
+                    self._execute(cur, "auth_extend_select", _EXTEND_SELECT, (user, sequence))
                     row = cur.fetchone()
 
                     if row is None:
@@ -168,13 +389,7 @@ class Authorize:
                     snum = random.randint(100000, 999999)
 
                     # 更新処理
-                    cur.execute("""
-                        UPDATE auth.users
-                        SET magic_number = NULL,
-                            sequence_number = %s,
-                            last_access_at = %s
-                        WHERE uid = %s
-                    """, (snum, datetime.now(), uid))
+                    self._execute(cur, "auth_extend_update", _EXTEND_UPDATE, (snum, datetime.now(), uid))
 
                     if cur.rowcount == 0:
                         return -2  # 更新されなかった
@@ -187,37 +402,360 @@ class Authorize:
             return -9
 
 
-    def get_feature_list(self: Self, user: str) -> List[FeatureInfo]:
+    def try_unlock_extend_many(self: Self, entries: List[Tuple[str, int]]) -> List[int]:
+        """
+        認証延長処理（一括）
+
+        複数ユーザの認証延長を、1文の UPDATE と1回の commit で行う。
+        ゲートウェイで要求をまとめて検証する用途を想定。
+
+        Parameters:
+            entries: (ユーザ名称, シーケンス管理用番号) のリスト
+
+        Returns:
+            entries と同じ順のリスト。各要素は try_unlock_extend と同じ
+            （正数: 新しいシーケンス管理用番号、-2: 該当なし、-9: 処理異常）
+            同じユーザが複数含まれる場合は、最初の1件のみ判定し、以降は -2 とする。
+        """
+
+        # ユーザ毎に最初の1件だけを対象にする
+        targets: Dict[str, Tuple[int, int, int]] = {}
+        for i, (user, sequence) in enumerate(entries):
+            if user not in targets:
+                targets[user] = (i, sequence, random.randint(100000, 999999))
+
+        results: List[int] = [-2] * len(entries)
+        if not targets:
+            return results
+
+        if self._store is not None:
+            for user, (i, sequence, snum) in targets.items():
+                try:
+                    uid = self._store.extend(user, sequence, snum)
+                except Exception as e:
+                    print(f"エラーが発生しました: {e}")
+                    results[i] = -9
+                    continue
+                if uid is not None:
+                    self._record_access(uid)
+                    results[i] = snum
+            return results
+
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    at = datetime.now()
+                    rows = execute_values(cur, """
+                        UPDATE auth.users AS u
+                        SET magic_number = NULL,
+                            sequence_number = v.new_sequence,
+                            last_access_at = v.at
+                        FROM (VALUES %s) AS v(uname, sequence, new_sequence, at)
+                        WHERE u.uname = v.uname AND u.sequence_number = v.sequence
+                        RETURNING u.uid, u.uname
+                    """, [(user, sequence, snum, at) for user, (i, sequence, snum) in targets.items()],
+                        template="(%s, %s::bigint, %s::bigint, %s::timestamptz)", page_size=len(targets), fetch=True)
+
+                    conn.commit()
+
+                    for uid, user in rows:
+                        i, sequence, snum = targets[user]
+                        results[i] = snum
+                    return results
+
+        except Exception as e:
+            print(f"DB接続エラー: {e}")
+            return [-9] * len(entries)
+
+
+    def logout(self: Self, user: str, sequence: int) -> int:
+        """
+        ログアウト処理（セッションを破棄する。セッション保存先指定時はその領域を解放する）
+
+        Parameters:
+            user: ユーザ名称（ユニーク）
+            sequence: シーケンス管理用番号
+
+        Returns:
+            0: 破棄した
+            -2: 該当なし
+            -9: 処理異常
+        """
+
+        try:
+            store = self._store if self._store is not None else PostgresSessionStore(self._connect)
+            return 0 if store.remove(user, sequence) else -2
+
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return -9
+
+
+    def _get_magic_number_atomic(self: Self, user: str) -> int:
+        """
+        マジックナンバー取得処理（1文版）
+        """
+
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    mnum = random.randint(100000, 999999)
+
+                    cur.execute(_SET_MAGIC_ATOMIC, (mnum, datetime.now(), user))
+                    row = cur.fetchone()
+
+                    if row is None:
+                        return -1  # 該当なし
+
+                    uid = row[0]
+
+                    conn.commit()
+                    return mnum
+
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return -9
+
+
+    def _try_unlock_atomic(self: Self, user: str, magic: int, pass_hash: str) -> int:
+        """
+        認証処理（1文版）
+
+        マジックナンバーの一致を条件に更新し、RETURNING で受け取ったパスワードで照合する。
+        照合に失敗した場合は rollback するので、マジックナンバーは消費されない。
+        """
+
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    snum = random.randint(100000, 999999)
+
+                    cur.execute(_UNLOCK_ATOMIC, (snum, datetime.now(), user, magic))
+                    row = cur.fetchone()
+
+                    if row is None:
+                        return -1  # 該当ユーザなし
+
+                    uid, upass = row
+                    combined = f"{upass}{magic}"
+                    generated_hash = format(zlib.crc32(combined.encode()) & 0xFFFFFFFF, '08x')
+
+                    if generated_hash != pass_hash:
+                        conn.rollback()
+                        return -2  # 認証失敗
+
+                    conn.commit()
+                    return snum
+
+        except Exception as e:
+            print(f"DB接続エラー: {e}")
+            return -9
+
+
+    def _try_unlock_extend_atomic(self: Self, user: str, sequence: int) -> int:
+        """
+        認証延長処理（1文版）
+
+        現在のシーケンス番号の一致を条件に更新する（compare-and-swap）。
+        同じシーケンス番号での同時要求は、1件だけが成功する。
+        """
+
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    snum = random.randint(100000, 999999)
+
+                    self._execute(cur, "auth_extend_atomic", _EXTEND_ATOMIC, (snum, datetime.now(), user, sequence))
+                    row = cur.fetchone()
+
+                    if row is None:
+                        return -2  # 該当なし
+
+                    uid = row[0]
+
+                    conn.commit()
+                    return snum
+
+        except Exception as e:
+            print(f"DB接続エラー: {e}")
+            return -9
+
+
+    def _get_magic_number_store(self: Self, user: str) -> int:
+        """
+        マジックナンバー取得処理（セッション保存先版）
+        """
+
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    cur.execute(_STORE_SELECT_USER, (user,))
+                    row = cur.fetchone()
+
+                    if row is None:
+                        return -1  # 該当なし
+
+                    uid, stale = row
+
+                    # 保存先の切り替え前の値が残っていれば消す（有効なセッションに見えないように）
+                    if stale and not isinstance(self._store, PostgresSessionStore):
+                        cur.execute(_CLEAR_SESSION_COLUMNS, (uid,))
+                        conn.commit()
+
+            mnum = random.randint(100000, 999999)
+            self._store.set_magic(user, uid, mnum)
+            self._record_access(uid)
+            return mnum
+
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return -9
+
+
+    def _try_unlock_store(self: Self, user: str, magic: int, pass_hash: str) -> int:
+        """
+        認証処理（セッション保存先版）
+        """
+
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    # ユーザ情報の取得
+                    cur.execute(_STORE_SELECT_PASSWORD, (user,))
+                    row = cur.fetchone()
+
+                    if row is None:
+                        return -1  # 該当ユーザなし
+
+                    uid, upass = row
+
+            if not self._store.has_magic(user, magic):
+                return -1  # マジックナンバー不一致
+
+            combined = f"{upass}{magic}"
+            generated_hash = format(zlib.crc32(combined.encode()) & 0xFFFFFFFF, '08x')
+
+            if generated_hash != pass_hash:
+                return -2  # 認証失敗
+
+            snum = random.randint(100000, 999999)
+            if self._store.unlock(user, magic, snum) is None:
+                return -1  # 他の要求で使用済み
+
+            self._record_access(uid)
+            return snum
+
+        except Exception as e:
+            print(f"DB接続エラー: {e}")
+            return -9
+
+
+    def _try_unlock_extend_store(self: Self, user: str, sequence: int) -> int:
+        """
+        認証延長処理（セッション保存先版）
+
+        DBには接続しない。
+        """
+
+        try:
+            snum = random.randint(100000, 999999)
+            uid = self._store.extend(user, sequence, snum)
+
+            if uid is None:
+                return -2  # 該当なし
+
+            self._record_access(uid)
+            return snum
+
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return -9
+
+
+    def get_feature_list(self: Self, user: str, with_icon: bool = True) -> List[FeatureInfo]:
         """
         機能一覧取得
 
         Parameter:
             user: ユーザ名称
+            with_icon: False の場合、icon_data は返さず、icon_hash（と icon_url）を返す。
+                       画像は get_icon で取得する（auth.features.icon_hash 列が必要）
         """
+        key = (user, with_icon)
+        generation = 0
+        if self._menu_cache is not None:
+            cached = self._menu_cache.get(key)
+            if cached is not None:
+                return [FeatureInfo(**feature) for feature in cached]
+            generation = self._menu_cache.generation()
+
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
-                    cur.execute("""
-                        SELECT f.fid, f.fname, f.feature_url, f.icon_data, f.icon_mime_type
-                        FROM auth.users u
-                        JOIN auth.user_features uf ON u.uid = uf.uid
-                        JOIN auth.features f ON uf.fid = f.fid
-                        WHERE u.uname = %s AND (f.is_deleted = false OR f.is_deleted IS NULL)
-                        ORDER BY uf.display_order
-                    """, (user,))
-                    rows = cur.fetchall()
-
-                    return [
-                        FeatureInfo(
-                            fid=row[0],
-                            fname=row[1],
-                            feature_url=row[2],
-                            icon_data=row[3],
-                            icon_mime_type=row[4]
-                        )
-                        for row in rows
-                    ]
+                    cur.execute(_feature_list_sql(with_icon), (user,))
+                    features = _feature_list(cur.fetchall(), with_icon, self._icon_url)
+
+                    if self._menu_cache is not None:
+                        self._menu_cache.put(key, [FeatureInfo(**feature) for feature in features], generation)
+                    return features
 
         except Exception as e:
             print(f"DBエラー: {e}")
             return []
+
+    def invalidate_menu(self: Self, user: Optional[str] = None) -> None:
+        """
+        機能一覧のキャッシュを破棄する
+
+        Parameter:
+            user: ユーザ名称。None または '*' の場合は全ユーザ
+        """
+        if self._menu_cache is None:
+            return
+        if user is None or user == "*":
+            self._menu_cache.clear()
+        else:
+            self._menu_cache.discard(lambda key: key[0] == user)
+        return
+
+    def listen_menu_changes(self: Self) -> NotifyListener:
+        """
+        機能一覧の変更通知（MENU_CHANNEL）の受信を開始する
+
+        通知を受けると該当ユーザのキャッシュを破棄する。ワーカープロセス毎に1回呼ぶ。
+
+        Returns:
+            受信スレッド。終了時は close() を呼ぶ
+        """
+        return NotifyListener(self._dsn, MENU_CHANNEL, self.invalidate_menu).start()
+
+    def get_icon(self: Self, icon_hash: str) -> Optional[Tuple[memoryview, Optional[str]]]:
+        """
+        アイコン取得
+
+        Parameter:
+            icon_hash: get_feature_list(with_icon=False) で返した icon_hash
+
+        Returns:
+            (画像データ, MIMEタイプ)。画像データはキャッシュ内のバイト列を参照する memoryview（コピーしない）
+            None: 該当なし、または処理異常
+        """
+        cached = self._icons.get(icon_hash)
+        if cached is not None:
+            return cached
+
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(_SELECT_ICON, (icon_hash,))
+                    row = cur.fetchone()
+
+                    if row is None or row[0] is None:
+                        return None
+
+                    return self._icons.put(icon_hash, row[0], row[1]), row[1]
+
+        except Exception as e:
+            print(f"DBエラー: {e}")
+            return None
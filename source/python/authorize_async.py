@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import psycopg
+import random
+import zlib
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from typing import Self
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+from psycopg_pool import AsyncConnectionPool
+
+from access import AccessRecorder
+from authorize import (MENU_CHANNEL, FeatureInfo, _feature_list, _feature_list_sql,
+                       _CLEAR_SESSION_COLUMNS, _EXTEND_ATOMIC, _EXTEND_SELECT, _EXTEND_UPDATE, _SELECT_ICON,
+                       _SELECT_UID, _SET_MAGIC, _SET_MAGIC_ATOMIC, _STORE_SELECT_PASSWORD, _STORE_SELECT_USER,
+                       _UNLOCK_ATOMIC, _UNLOCK_SELECT, _UNLOCK_UPDATE)
+from cache import NotifyListener, TTLCache
+from icon import IconCache
+from session import _REMOVE_SESSION, PostgresSessionStore, SessionStore
+
+class AsyncAuthorize:
+    """
+    Authorize の asyncio 版
+
+    ドライバに psycopg (v3) の AsyncConnection を使う。
+    psycopg_pool.AsyncConnectionPool を渡した場合は、プールから接続を借りる。
+    戻り値は Authorize の同名メソッドと同じで、各文は authorize.py の定数を共有する。
+
+    try_unlock_extend_many には対応しない（Authorize を使う）。
+    prepared も指定しない（psycopg (v3) は同じ文を繰り返し実行すると自動で PREPARE する）。
+    """
+
+    _dsn: str = ""
+    _pool: Optional[AsyncConnectionPool] = None
+    _atomic: bool = False
+    _recorder: Optional[AccessRecorder] = None
+    _store: Optional[SessionStore] = None
+    _icons: IconCache
+    _icon_url: Optional[str] = None
+    _menu_cache: Optional[TTLCache] = None
+
+    def __init__(self: Self, dbhost: str, dbport: int, dbname: str, dbuser: str, dbpass: str, pool: Optional[AsyncConnectionPool] = None, atomic: bool = False,
+                 access_recorder: Optional[AccessRecorder] = None, session_store: Optional[SessionStore] = None,
+                 icon_cache: Optional[IconCache] = None, icon_url: Optional[str] = None, menu_cache: Optional[TTLCache] = None) -> None:
+        """
+        Parameters:
+            dbhost, dbport, dbname, dbuser, dbpass: DB接続情報
+            pool: コネクションプール
+            atomic, access_recorder, session_store, icon_cache, icon_url, menu_cache: Authorize の同名の引数と同じ。
+                    session_store の各メソッドはイベントループ上で同期的に呼ぶため、DBを使う PostgresSessionStore は ValueError
+                    （auth.users で管理する場合は省略する）。access_recorder の書き込みは AccessRecorder のスレッドで行う
+        """
+        self._dsn = f"host={dbhost} port={dbport} dbname={dbname} user={dbuser} password={dbpass}"
+        self._pool = pool
+        self._atomic = atomic
+        if isinstance(session_store, PostgresSessionStore):
+            raise ValueError("AsyncAuthorize では PostgresSessionStore は使えません（auth.users で管理する場合は session_store を省略してください）")
+        if access_recorder is not None and session_store is None:
+            raise ValueError("access_recorder はDBを使わない session_store と合わせて指定してください")
+        self._recorder = access_recorder
+        self._store = session_store
+        self._icons = icon_cache if icon_cache is not None else IconCache()
+        self._icon_url = icon_url
+        self._menu_cache = menu_cache
+        return
+
+    @asynccontextmanager
+    async def _connect(self: Self) -> AsyncIterator[Any]:
+        """
+        DB接続を取得する
+
+        ブロック終了時に commit（例外時は rollback）される。
+        """
+        if self._pool is not None:
+            async with self._pool.connection() as conn:
+                yield conn
+            return
+
+        async with await psycopg.AsyncConnection.connect(self._dsn) as conn:
+            yield conn
+
+    def _record_access(self: Self, uid: int) -> None:
+        """
+        セッション保存先の利用時に、最終アクセス日時を記録する（access_recorder 指定時）
+        """
+        if self._recorder is not None:
+            self._recorder.record(uid)
+        return
+
+    async def get_magic_number(self: Self, user: str) -> int:
+        """
+        マジックナンバー取得処理（Authorize.get_magic_number の非同期版）
+        """
+
+        if self._store is not None:
+            return await self._get_magic_number_store(user)
+        if self._atomic:
+            return await self._get_magic_number_atomic(user)
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    await cur.execute(_SELECT_UID, (user,))
+                    row = await cur.fetchone()
+
+                    if row is None:
+                        return -1  # 該当なし
+
+                    uid = row[0]
+
+                    # マジックナンバー生成（例：100000〜999999のランダムな整数）
+                    mnum = random.randint(100000, 999999)
+
+                    # ユーザ情報を更新
+                    await cur.execute(_SET_MAGIC, (mnum, datetime.now(), uid))
+
+                    if cur.rowcount == 0:
+                        return -9  # 更新されなかった場合
+
+                    await conn.commit()
+                    return mnum
+
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return -9
+
+
+    async def try_unlock(self: Self, user: str, magic: int, pass_hash: str) -> int:
+        """
+        認証処理（Authorize.try_unlock の非同期版）
+        """
+
+        if self._store is not None:
+            return await self._try_unlock_store(user, magic, pass_hash)
+        if self._atomic:
+            return await self._try_unlock_atomic(user, magic, pass_hash)
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザ情報の取得
+                    await cur.execute(_UNLOCK_SELECT, (user, magic))
+                    row = await cur.fetchone()
+
+                    if row is None:
+                        return -1  # 該当ユーザなし
+
+                    uid, upass = row
+
+                    # マジックナンバーを使ってハッシュを生成
+                    combined = f"{upass}{magic}"
+                    generated_hash = format(zlib.crc32(combined.encode()) & 0xFFFFFFFF, '08x')
+
+                    if generated_hash != pass_hash:
+                        return -2  # 認証失敗
+
+                    # シーケンス番号を生成
+                    snum = random.randint(100000, 999999)
+
+                    # ユーザ情報を更新
+                    await cur.execute(_UNLOCK_UPDATE, (snum, datetime.now(), uid))
+
+                    if cur.rowcount == 0:
+                        return -1  # 更新失敗
+
+                    await conn.commit()
+                    return snum
+
+        except Exception as e:
+            print(f"DB接続エラー: {e}")
+            return -9
+
+
+    async def try_unlock_extend(self: Self, user: str, sequence: int) -> int:
+        """
+        認証延長処理（Authorize.try_unlock_extend の非同期版）
+        """
+
+        if self._store is not None:
+            return self._try_unlock_extend_store(user, sequence)
+        if self._atomic:
+            return await self._try_unlock_extend_atomic(user, sequence)
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザ確認
+                    await cur.execute(_EXTEND_SELECT, (user, sequence))
+                    row = await cur.fetchone()
+
+                    if row is None:
+                        return -2  # 該当なし
+
+                    uid = row[0]
+
+                    # 新しいシーケンス番号を生成
+                    snum = random.randint(100000, 999999)
+
+                    # 更新処理
+                    await cur.execute(_EXTEND_UPDATE, (snum, datetime.now(), uid))
+
+                    if cur.rowcount == 0:
+                        return -2  # 更新されなかった
+
+                    await conn.commit()
+                    return snum
+
+        except Exception as e:
+            print(f"DB接続エラー: {e}")
+            return -9
+
+
+    async def logout(self: Self, user: str, sequence: int) -> int:
+        """
+        ログアウト処理（Authorize.logout の非同期版）
+        """
+
+        try:
+            if self._store is not None:
+                return 0 if self._store.remove(user, sequence) else -2
+
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(_REMOVE_SESSION, (user, sequence))
+                    removed = cur.rowcount > 0
+                    await conn.commit()
+                    return 0 if removed else -2
+
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return -9
+
+
+    async def _get_magic_number_atomic(self: Self, user: str) -> int:
+        """
+        マジックナンバー取得処理（1文版）
+        """
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    mnum = random.randint(100000, 999999)
+
+                    await cur.execute(_SET_MAGIC_ATOMIC, (mnum, datetime.now(), user))
+                    row = await cur.fetchone()
+
+                    if row is None:
+                        return -1  # 該当なし
+
+                    await conn.commit()
+                    return mnum
+
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return -9
+
+
+    async def _try_unlock_atomic(self: Self, user: str, magic: int, pass_hash: str) -> int:
+        """
+        認証処理（1文版。照合に失敗した場合は rollback するので、マジックナンバーは消費されない）
+        """
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    snum = random.randint(100000, 999999)
+
+                    await cur.execute(_UNLOCK_ATOMIC, (snum, datetime.now(), user, magic))
+                    row = await cur.fetchone()
+
+                    if row is None:
+                        return -1  # 該当ユーザなし
+
+                    uid, upass = row
+                    combined = f"{upass}{magic}"
+                    generated_hash = format(zlib.crc32(combined.encode()) & 0xFFFFFFFF, '08x')
+
+                    if generated_hash != pass_hash:
+                        await conn.rollback()
+                        return -2  # 認証失敗
+
+                    await conn.commit()
+                    return snum
+
+        except Exception as e:
+            print(f"DB接続エラー: {e}")
+            return -9
+
+
+    async def _try_unlock_extend_atomic(self: Self, user: str, sequence: int) -> int:
+        """
+        認証延長処理（1文版。同じシーケンス番号での同時要求は、1件だけが成功する）
+        """
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    snum = random.randint(100000, 999999)
+
+                    await cur.execute(_EXTEND_ATOMIC, (snum, datetime.now(), user, sequence))
+                    row = await cur.fetchone()
+
+                    if row is None:
+                        return -2  # 該当なし
+
+                    await conn.commit()
+                    return snum
+
+        except Exception as e:
+            print(f"DB接続エラー: {e}")
+            return -9
+
+
+    async def _get_magic_number_store(self: Self, user: str) -> int:
+        """
+        マジックナンバー取得処理（セッション保存先版）
+        """
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    await cur.execute(_STORE_SELECT_USER, (user,))
+                    row = await cur.fetchone()
+
+                    if row is None:
+                        return -1  # 該当なし
+
+                    uid, stale = row
+
+                    # 保存先の切り替え前の値が残っていれば消す（有効なセッションに見えないように）
+                    if stale:
+                        await cur.execute(_CLEAR_SESSION_COLUMNS, (uid,))
+                        await conn.commit()
+
+            mnum = random.randint(100000, 999999)
+            self._store.set_magic(user, uid, mnum)
+            self._record_access(uid)
+            return mnum
+
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return -9
+
+
+    async def _try_unlock_store(self: Self, user: str, magic: int, pass_hash: str) -> int:
+        """
+        認証処理（セッション保存先版）
+        """
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザ情報の取得
+                    await cur.execute(_STORE_SELECT_PASSWORD, (user,))
+                    row = await cur.fetchone()
+
+                    if row is None:
+                        return -1  # 該当ユーザなし
+
+                    uid, upass = row
+
+            if not self._store.has_magic(user, magic):
+                return -1  # マジックナンバー不一致
+
+            combined = f"{upass}{magic}"
+            generated_hash = format(zlib.crc32(combined.encode()) & 0xFFFFFFFF, '08x')
+
+            if generated_hash != pass_hash:
+                return -2  # 認証失敗
+
+            snum = random.randint(100000, 999999)
+            if self._store.unlock(user, magic, snum) is None:
+                return -1  # 他の要求で使用済み
+
+            self._record_access(uid)
+            return snum
+
+        except Exception as e:
+            print(f"DB接続エラー: {e}")
+            return -9
+
+
+    def _try_unlock_extend_store(self: Self, user: str, sequence: int) -> int:
+        """
+        認証延長処理（セッション保存先版。DBには接続しない）
+        """
+
+        try:
+            snum = random.randint(100000, 999999)
+            uid = self._store.extend(user, sequence, snum)
+
+            if uid is None:
+                return -2  # 該当なし
+
+            self._record_access(uid)
+            return snum
+
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return -9
+
+
+    async def get_feature_list(self: Self, user: str, with_icon: bool = True) -> List[FeatureInfo]:
+        """
+        機能一覧取得（Authorize.get_feature_list の非同期版）
+        """
+        key = (user, with_icon)
+        generation = 0
+        if self._menu_cache is not None:
+            cached = self._menu_cache.get(key)
+            if cached is not None:
+                return [FeatureInfo(**feature) for feature in cached]
+            generation = self._menu_cache.generation()
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(_feature_list_sql(with_icon), (user,))
+                    features = _feature_list(await cur.fetchall(), with_icon, self._icon_url)
+
+                    if self._menu_cache is not None:
+                        self._menu_cache.put(key, [FeatureInfo(**feature) for feature in features], generation)
+                    return features
+
+        except Exception as e:
+            print(f"DBエラー: {e}")
+            return []
+
+    def invalidate_menu(self: Self, user: Optional[str] = None) -> None:
+        """
+        機能一覧のキャッシュを破棄する（Authorize.invalidate_menu と同じ）
+        """
+        if self._menu_cache is None:
+            return
+        if user is None or user == "*":
+            self._menu_cache.clear()
+        else:
+            self._menu_cache.discard(lambda key: key[0] == user)
+        return
+
+    def listen_menu_changes(self: Self) -> NotifyListener:
+        """
+        機能一覧の変更通知の受信を開始する（Authorize.listen_menu_changes と同じ。受信はスレッドで行う）
+        """
+        return NotifyListener(self._dsn, MENU_CHANNEL, self.invalidate_menu).start()
+
+    async def get_icon(self: Self, icon_hash: str) -> Optional[Tuple[memoryview, Optional[str]]]:
+        """
+        アイコン取得（Authorize.get_icon の非同期版）
+        """
+        cached = self._icons.get(icon_hash)
+        if cached is not None:
+            return cached
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(_SELECT_ICON, (icon_hash,))
+                    row = await cur.fetchone()
+
+                    if row is None or row[0] is None:
+                        return None
+
+                    return self._icons.put(icon_hash, row[0], row[1]), row[1]
+
+        except Exception as e:
+            print(f"DBエラー: {e}")
+            return None
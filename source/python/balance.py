@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+from datetime import date
+from typing import Self
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# 残高木（expense.account_balance_tree）の月番号: 1970年1月 = 1
+TREE_BASE_YEAR: int = 1970
+# 月番号の上限（4096ヶ月 = 2311年12月まで）。2のべき乗にしておくと、根のノードが1つになる
+TREE_SIZE: int = 4096
+# 口座履歴を書き換える文の前に付ける（make_balance_tree.sql のトリガーは、これを設定していない
+# トランザクションからの口座履歴の追加・更新を拒否する）
+TREE_WRITER: str = "SET LOCAL expense.balance_tree = on;"
+
+
+def month_index(d: date) -> int:
+    """
+    日付の月番号（1始まり）
+    """
+    index = (d.year - TREE_BASE_YEAR) * 12 + d.month
+    if index < 1 or index > TREE_SIZE:
+        raise ValueError(f"残高木で扱えない日付です: {d}")
+    return index
+
+
+def month_start(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+
+def update_nodes(index: int, size: int = TREE_SIZE) -> List[int]:
+    """
+    index の月に加算する時に更新するノード（Fenwick木）
+    """
+    nodes: List[int] = []
+    while index <= size:
+        nodes.append(index)
+        index += index & -index
+    return nodes
+
+
+def prefix_nodes(index: int) -> List[int]:
+    """
+    1〜index の月の合計を求める時に読むノード（Fenwick木）
+    """
+    nodes: List[int] = []
+    while index > 0:
+        nodes.append(index)
+        index -= index & -index
+    return nodes
+
+
+# 木への増減の加算（パラメータ: aid の配列, ノードの配列, 増減の配列）
+_TREE_ADD: str = """
+    INSERT INTO expense.account_balance_tree (aid, node, total)
+    SELECT * FROM unnest(%s::int[], %s::int[], %s::bigint[])
+    ON CONFLICT (aid, node) DO UPDATE
+    SET total = expense.account_balance_tree.total + EXCLUDED.total
+"""
+
+# 残高取得（パラメータは BalanceTree._balance_params）
+_BALANCE_AT: str = """
+    SELECT COALESCE((
+               SELECT sum(total) FROM expense.account_balance_tree
+               WHERE aid = %s AND node = ANY(%s)
+           ), 0)
+         + COALESCE((
+               SELECT sum(delta) FROM expense.account_histories
+               WHERE aid = %s AND is_deleted = FALSE
+                 AND payment_date >= %s AND payment_date <= %s
+                 AND (%s::int IS NULL OR payment_date < %s OR dorder <= %s)
+           ), 0)
+"""
+
+# 口座履歴の追加（TREE_WRITER の後に実行する。パラメータ: aid, 支払日, tid, 残高, 増減）
+_TREE_APPEND: str = """
+    INSERT INTO expense.account_histories (aid, payment_date, tid, amount, delta, is_deleted)
+    VALUES (%s, %s, %s, %s, %s, FALSE)
+"""
+
+# 取引の口座履歴の削除マーク（TREE_WRITER の後に実行する。パラメータ: tid の配列, 最小の支払日, 最大の支払日, 支払日の配列）
+# 支払日はパーティションの絞り込み用（配列の条件では汎用プランで絞り込めないため、範囲も指定する）
+_TREE_REMOVE: str = """
+    UPDATE expense.account_histories
+    SET is_deleted = TRUE
+    WHERE tid = ANY(%s) AND is_deleted = FALSE
+      AND payment_date >= %s AND payment_date <= %s AND payment_date = ANY(%s)
+    RETURNING aid, payment_date, delta
+"""
+
+
+class BalanceTree:
+    """
+    口座残高の差分管理
+
+    expense.account_histories には各行の増減（delta）を持たせ、月毎の増減の合計を
+    Fenwick木（expense.account_balance_tree）で管理する。
+    ある時点の残高 = 前月までの合計（木のノード O(log n) 件）+ 当月の delta の合計。
+    取引の追加・削除で更新するのは、履歴1行と木のノード O(log n) 行のみで、
+    以降の履歴の amount は書き換えない。
+
+    amount 列には、追加した時点での残高を記録する（以降の遡り追加では更新されない）。
+    正しい残高は balance_at で求める。
+    test_environment/make_balance_tree.sql の適用が必要（適用後は balance_tree 以外の口座履歴の書き込みを拒否する）。
+    *_async は psycopg の AsyncCursor 用（AsyncExpense で使う。文は同じ。
+    psycopg (v3) はパラメータ付きの複数文を実行できないため、TREE_WRITER は別に実行する）。
+    """
+
+    def add(self: Self, cur: Any, entries: Iterable[Tuple[int, date, int]]) -> None:
+        """
+        木に増減を加算する
+
+        Parameters:
+            entries: (aid, 支払日, 増減) の並び
+        """
+        params = self._add_params(entries)
+        if params is not None:
+            cur.execute(_TREE_ADD, params)
+        return
+
+    async def add_async(self: Self, cur: Any, entries: Iterable[Tuple[int, date, int]]) -> None:
+        params = self._add_params(entries)
+        if params is not None:
+            await cur.execute(_TREE_ADD, params)
+        return
+
+    def balance_at(self: Self, cur: Any, aid: int, payment_date: date, dorder: Optional[int] = None) -> int:
+        """
+        残高取得
+
+        Parameters:
+            aid: 口座ID
+            payment_date: 日付
+            dorder: 指定した場合は payment_date の dorder 以下の行まで。省略時は payment_date の全行まで
+        """
+        cur.execute(_BALANCE_AT, self._balance_params(aid, payment_date, dorder))
+        return int(cur.fetchone()[0])
+
+    async def balance_at_async(self: Self, cur: Any, aid: int, payment_date: date, dorder: Optional[int] = None) -> int:
+        await cur.execute(_BALANCE_AT, self._balance_params(aid, payment_date, dorder))
+        return int((await cur.fetchone())[0])
+
+    def append(self: Self, cur: Any, aid: int, payment_date: date, tid: int, delta: int) -> None:
+        """
+        口座履歴を追加する（payment_date の最後の行になる）
+        """
+        balance = self.balance_at(cur, aid, payment_date)
+        cur.execute(TREE_WRITER + _TREE_APPEND, (aid, payment_date, tid, balance + delta, delta))
+        self.add(cur, [(aid, payment_date, delta)])
+        return
+
+    async def append_async(self: Self, cur: Any, aid: int, payment_date: date, tid: int, delta: int) -> None:
+        balance = await self.balance_at_async(cur, aid, payment_date)
+        await cur.execute(TREE_WRITER)
+        await cur.execute(_TREE_APPEND, (aid, payment_date, tid, balance + delta, delta))
+        await self.add_async(cur, [(aid, payment_date, delta)])
+        return
+
+    def remove(self: Self, cur: Any, tid: int, payment_dates: List[date]) -> List[Tuple[int, date, int]]:
+        """
+        取引の口座履歴をすべて削除マークし、木から増減を差し引く
+
+        Parameters:
+            payment_dates: 口座履歴の支払日（取引日と支出日。パーティション分割時に対象の年だけを読むため）
+
+        Returns:
+            削除した履歴の (aid, 支払日, 増減)
+        """
+        return self.remove_many(cur, [tid], payment_dates)
+
+    async def remove_async(self: Self, cur: Any, tid: int, payment_dates: List[date]) -> List[Tuple[int, date, int]]:
+        await cur.execute(TREE_WRITER)
+        await cur.execute(_TREE_REMOVE, ([tid], min(payment_dates), max(payment_dates), payment_dates))
+        removed = [(row[0], row[1], row[2]) for row in await cur.fetchall()]
+        await self.add_async(cur, [(aid, payment_date, -delta) for aid, payment_date, delta in removed])
+        return removed
+
+    def remove_many(self: Self, cur: Any, tids: List[int], payment_dates: List[date]) -> List[Tuple[int, date, int]]:
+        """
+        複数の取引の口座履歴をまとめて削除マークし、木から増減を差し引く（payment_dates は remove と同じ）
+        """
+        cur.execute(TREE_WRITER + _TREE_REMOVE, (tids, min(payment_dates), max(payment_dates), payment_dates))
+        removed = [(row[0], row[1], row[2]) for row in cur.fetchall()]
+        self.add(cur, [(aid, payment_date, -delta) for aid, payment_date, delta in removed])
+        return removed
+
+    @staticmethod
+    def _add_params(entries: Iterable[Tuple[int, date, int]]) -> Optional[Tuple[List[int], List[int], List[int]]]:
+        """
+        _TREE_ADD のパラメータ（ノード毎に増減を合計する。加算するものがなければ None）
+        """
+        totals: Dict[Tuple[int, int], int] = {}
+        for aid, payment_date, delta in entries:
+            if delta == 0:
+                continue
+            for node in update_nodes(month_index(payment_date)):
+                totals[(aid, node)] = totals.get((aid, node), 0) + delta
+        if not totals:
+            return None
+        return [k[0] for k in totals], [k[1] for k in totals], list(totals.values())
+
+    @staticmethod
+    def _balance_params(aid: int, payment_date: date, dorder: Optional[int]) -> Tuple[Any, ...]:
+        """
+        _BALANCE_AT のパラメータ
+        """
+        return (aid, prefix_nodes(month_index(payment_date) - 1),
+                aid, month_start(payment_date), payment_date, dorder, payment_date, dorder)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import psycopg2
+import psycopg2.extensions
+import select
+import threading
+import time
+from collections import OrderedDict
+
+from typing import Self
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    有効期限付きのLRUキャッシュ（スレッドセーフ）
+
+    Parameters:
+        ttl: 有効期限（秒）
+        max_entries: 保持するエントリ数の上限。超えた場合は最も古く使われたものから破棄する
+    """
+
+    def __init__(self: Self, ttl: float = 60.0, max_entries: int = 1024) -> None:
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def get(self: Self, key: Hashable, default: Any = None) -> Any:
+        """
+        値を取得する。ない場合、期限切れの場合は default を返す
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def generation(self: Self) -> int:
+        """
+        無効化の世代番号。delete / discard / clear のたびに増える
+
+        DBから読み込む前に取得して put に渡すと、読み込み中に無効化された古い値を登録しない。
+        """
+        with self._lock:
+            return self._generation
+
+    def put(self: Self, key: Hashable, value: Any, generation: Optional[int] = None) -> bool:
+        """
+        値を登録する
+
+        Returns:
+            True: 登録した
+            False: generation 以降に無効化があったため登録しなかった
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def delete(self: Self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+        return
+
+    def discard(self: Self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        条件に合うキーをすべて破棄する
+
+        Returns:
+            破棄した件数
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            self._generation += 1
+            return len(keys)
+
+    def clear(self: Self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+        return
+
+    def __len__(self: Self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class NotifyListener:
+    """
+    PostgreSQL の LISTEN/NOTIFY を受信するスレッド
+
+    通知を受けるたびに callback(payload) を呼ぶ。接続が切れた場合は再接続し、
+    その間の通知を取りこぼしている可能性があるため、(再)接続のたびに callback(None) を呼ぶ。
+
+    Parameters:
+        dsn: 接続文字列（LISTEN 用に専用の接続を1本使う）
+        channel: チャネル名
+        callback: 通知を受けた時に呼ぶ関数
+        reconnect_interval: 再接続までの待ち時間（秒）
+    """
+
+    def __init__(self: Self, dsn: str, channel: str, callback: Callable[[Optional[str]], None], reconnect_interval: float = 5.0) -> None:
+        self._dsn = dsn
+        self._channel = channel
+        self._callback = callback
+        self._reconnect_interval = reconnect_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        return
+
+    def start(self: Self) -> Self:
+        self._thread = threading.Thread(target=self._run, name=f"NotifyListener({self._channel})", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self: Self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return
+
+    def _run(self: Self) -> None:
+        while not self._stop.is_set():
+            try:
+                conn = psycopg2.connect(self._dsn)
+            except Exception as e:
+                print(f"DB接続エラー: {e}")
+                self._stop.wait(self._reconnect_interval)
+                continue
+
+            try:
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{self._channel}"')
+                self._callback(None)
+
+                while not self._stop.is_set():
+                    # close() で止められるよう、待ち時間を区切る
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._callback(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"DBエラー: {e}")
+                self._stop.wait(self._reconnect_interval)
+            finally:
+                conn.close()
+        return
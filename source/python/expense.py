@@ -6,21 +6,656 @@ import warnings
 sys.dont_write_bytecode = True
 warnings.filterwarnings('ignore')
 
+import io
 import psycopg2
+import threading
+from contextlib import contextmanager
 from datetime import datetime as dtm
 from datetime import date
 from calendar import monthrange
 from typing import Self
-from typing import Optional
+from typing import Optional, Any, Callable, ContextManager, Dict, Hashable, IO, Iterable, Iterator, List, Tuple, TypedDict
+
+from balance import TREE_WRITER, BalanceTree, month_index, month_start, prefix_nodes
+from cache import TTLCache
+from payment_schedule import payment_dates, to_dates
+from locks import AccountLocks
+from pool import ConnectionPool
+from prepared import PreparedStatements
+
+class PaymentInfo(TypedDict):
+    pid: int
+    aid: int
+    closing_day: int
+    payment_offset_month: int
+    payment_day: int
+
+class TransactionRow(TypedDict):
+    """
+    一括取引追加の1行（add_transaction の引数と同じ）
+    """
+    tdate: dtm
+    purpose: str
+    memo: Optional[str]
+    pname: Optional[str]
+    amount_spent: int
+    aname: Optional[str]
+    amount_received: int
+
+class TransactionInfo(TypedDict):
+    """
+    取引一覧の1行
+    """
+    transaction_date: date
+    dorder: int
+    purpose: str
+    memo: Optional[str]
+    pname: Optional[str]
+    amount_spent: int
+    aname: Optional[str]
+    amount_received: int
+
+class MonthlySummary(TypedDict):
+    """
+    月別集計の1行
+    """
+    month: date
+    purpose: str
+    pname: Optional[str]
+    aname: Optional[str]
+    spent: int
+    received: int
+    count: int
+
+# 取引一覧の列（TransactionInfo の順）
+_TRANSACTION_COLUMNS: str = """
+    t.transaction_date, t.dorder, t.purpose, t.memo, p.payment_name, t.amount_spent, a.account_name, t.amount_received
+    FROM expense.transactions t
+    LEFT JOIN expense.payments p ON p.pid = t.pid
+    LEFT JOIN expense.accounts a ON a.aid = t.aid
+"""
+
+# 頻繁に実行する文（test_query_plan.py で実行計画を検証する）
+
+# ユーザID取得（パラメータ: ユーザ名）
+_SELECT_UID: str = "SELECT uid FROM auth.users WHERE uname = %s"
+
+# 残高取得（指定日以前の最後の口座履歴の残高。パラメータ: aid, 日付）
+_BALANCE_PROBE: str = """
+    SELECT amount FROM expense.account_histories
+    WHERE aid = %s AND is_deleted = FALSE AND payment_date <= %s
+    ORDER BY payment_date DESC, dorder DESC
+    LIMIT 1
+"""
+
+# 口座ID取得（削除済みを除く。パラメータ: uid, 口座名称）
+_SELECT_AID: str = """
+    SELECT aid FROM expense.accounts
+    WHERE uid = %s AND account_name = %s AND is_deleted = FALSE
+"""
+
+# 支払い方法取得（削除済みを除く。パラメータ: uid, 支払い方法名称）
+_SELECT_PAYMENT: str = """
+    SELECT pid, aid, closing_day, payment_offset_month, payment_day
+    FROM expense.payments
+    WHERE uid = %s AND payment_name = %s AND deleted_at IS NULL
+"""
+
+# 取引の口座履歴の口座（パラメータ: tid の配列, 最小の支払日, 最大の支払日, 支払日の配列）
+# 支払日はパーティションの絞り込み用（配列の条件では汎用プランで絞り込めないため、範囲も指定する）
+_SELECT_TRANSACTION_ACCOUNTS: str = """
+    SELECT DISTINCT aid FROM expense.account_histories
+    WHERE tid = ANY(%s) AND is_deleted = FALSE
+      AND payment_date >= %s AND payment_date <= %s AND payment_date = ANY(%s)
+"""
+
+# 取引の追加（パラメータ: uid, 取引日, 用途, メモ, pid, 支出額, aid, 収入額）
+_INSERT_TRANSACTION: str = """
+    INSERT INTO expense.transactions (uid, transaction_date, purpose, memo, pid, amount_spent, aid, amount_received, is_deleted)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, FALSE)
+    RETURNING tid
+"""
+
+# 口座履歴の追加（パラメータ: aid, 支払日, tid, 残高）
+_INSERT_HISTORY: str = """
+    INSERT INTO expense.account_histories (aid, payment_date, tid, amount, is_deleted)
+    VALUES (%s, %s, %s, %s, FALSE)
+"""
+
+# 取引の追加（サーバ側関数。パラメータ: ユーザ名, 取引日, 用途, メモ, 支払い方法名称, 支出額, 口座名称, 収入額, ロックの名前空間）
+_ADD_TRANSACTION_FUNCTION: str = """
+    SELECT expense.add_transaction(%s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+# 取引の追加で、以降の口座履歴の残高を更新する（パラメータ: 増減, aid, 支払日）
+_SHIFT_LATER_BALANCES: str = """
+    UPDATE expense.account_histories
+    SET amount = amount + %s
+    WHERE aid = %s AND is_deleted = FALSE AND payment_date > %s
+"""
+
+# 取引取得（削除済みを除く。パラメータ: uid, 取引日, dorder）
+_SELECT_TRANSACTION: str = """
+    SELECT tid, pid, aid, amount_spent, amount_received
+    FROM expense.transactions
+    WHERE uid = %s AND transaction_date = %s AND dorder = %s AND is_deleted = FALSE
+"""
+
+# 取引の削除マーク（パラメータ: tid, 取引日）
+_DELETE_TRANSACTION: str = """
+    UPDATE expense.transactions
+    SET is_deleted = TRUE
+    WHERE tid = %s AND transaction_date = %s
+"""
+
+# 取引の支払い方法（削除済みも含む。取引の登録後に支払い方法が削除されていても、口座履歴を取り消すため。パラメータ: uid, pid）
+_SELECT_TRANSACTION_PAYMENT: str = """
+    SELECT aid, closing_day, payment_offset_month, payment_day FROM expense.payments
+    WHERE uid = %s AND pid = %s
+"""
+
+# 取引の口座履歴（パラメータ: aid, tid, 支払日）
+_SELECT_TRANSACTION_HISTORY: str = """
+    SELECT payment_date, dorder
+    FROM expense.account_histories
+    WHERE aid = %s AND tid = %s AND payment_date = %s AND is_deleted = FALSE
+"""
+
+# 取引の口座履歴の削除マーク（パラメータ: aid, tid, 支払日）
+_DELETE_TRANSACTION_HISTORY: str = """
+    UPDATE expense.account_histories
+    SET is_deleted = TRUE
+    WHERE aid = %s AND tid = %s AND payment_date = %s AND is_deleted = FALSE
+"""
+
+# 取引の削除で、削除した口座履歴より後の残高を更新する（パラメータ: 増減, aid, 支払日, 支払日, dorder）
+_SHIFT_BALANCES_AFTER: str = """
+    UPDATE expense.account_histories
+    SET amount = amount + %s
+    WHERE aid = %s AND is_deleted = FALSE
+    AND (payment_date > %s OR (payment_date = %s AND dorder > %s))
+"""
+
+# 口座毎の残高（削除済みの口座を除く。パラメータ: 日付, uid, 口座名称, 口座名称。口座名称が NULL の場合は全口座）
+_SELECT_BALANCES: str = """
+    SELECT a.account_name, COALESCE(h.amount, 0)
+    FROM expense.accounts a
+    LEFT JOIN LATERAL (
+        SELECT amount FROM expense.account_histories
+        WHERE aid = a.aid AND is_deleted = FALSE AND payment_date <= %s
+        ORDER BY payment_date DESC, dorder DESC
+        LIMIT 1
+    ) h ON TRUE
+    WHERE a.uid = %s AND a.is_deleted = FALSE
+      AND (%s::text IS NULL OR a.account_name = %s)
+    ORDER BY a.aid
+"""
+
+# 取引一覧（キーセットページング。パラメータ: uid, 開始日, 終了日, after の取引日, after の dorder, 件数）
+_LIST_TRANSACTIONS: str = f"""
+    SELECT {_TRANSACTION_COLUMNS}
+    WHERE t.uid = %s AND t.is_deleted = FALSE
+      AND t.transaction_date >= %s AND t.transaction_date <= %s
+      AND (t.transaction_date, t.dorder) > (%s, %s)
+    ORDER BY t.transaction_date, t.dorder
+    LIMIT %s
+"""
+
+# 一括追加の一時テーブル（同じトランザクション（ExpenseSession）での2回目以降に備えて、前回のものを削除する）
+_BULK_TABLES: str = """
+    DROP TABLE IF EXISTS bulk_transactions, bulk_histories;
+    CREATE TEMP TABLE bulk_transactions (
+        seq INTEGER PRIMARY KEY, transaction_date DATE, purpose TEXT, memo TEXT,
+        pid INTEGER, amount_spent INTEGER, aid INTEGER, amount_received INTEGER,
+        dorder INTEGER, tid INTEGER
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE bulk_histories (
+        seq INTEGER, side INTEGER, aid INTEGER, payment_date DATE, delta INTEGER, nodes INTEGER[]
+    ) ON COMMIT DROP
+"""
+
+# 一括追加の取引の dorder（採番テーブルから取引日毎に件数分をまとめて払い出す。パラメータ: uid）
+_BULK_TRANSACTION_DORDERS_COUNTER: str = """
+    WITH alloc AS (
+        INSERT INTO expense.transaction_dorders AS c (uid, transaction_date, last_dorder)
+        SELECT %s, transaction_date, count(*) FROM bulk_transactions GROUP BY transaction_date
+        ON CONFLICT (uid, transaction_date) DO UPDATE
+        SET last_dorder = c.last_dorder + EXCLUDED.last_dorder
+        RETURNING transaction_date, last_dorder
+    )
+    UPDATE bulk_transactions b
+    SET dorder = d.dorder
+    FROM (
+        SELECT s.seq,
+               a.last_dorder - count(*) OVER (PARTITION BY s.transaction_date)
+             + row_number() OVER (PARTITION BY s.transaction_date ORDER BY s.seq) AS dorder
+        FROM bulk_transactions s
+        JOIN alloc a ON a.transaction_date = s.transaction_date
+    ) d
+    WHERE b.seq = d.seq
+"""
+
+# 一括追加の取引の dorder（既存の最大値 + 取引日毎の行番号。パラメータ: uid）
+_BULK_TRANSACTION_DORDERS: str = """
+    UPDATE bulk_transactions b
+    SET dorder = d.dorder
+    FROM (
+        SELECT s.seq,
+               COALESCE(m.dorder, 0) + row_number() OVER (PARTITION BY s.transaction_date ORDER BY s.seq) AS dorder
+        FROM bulk_transactions s
+        LEFT JOIN LATERAL (
+            SELECT max(dorder) AS dorder FROM expense.transactions t
+            WHERE t.uid = %s AND t.transaction_date = s.transaction_date
+        ) m ON TRUE
+    ) d
+    WHERE b.seq = d.seq
+"""
+
+# 一括追加の取引の追加（パラメータ: uid）
+_BULK_INSERT_TRANSACTIONS: str = """
+    WITH ins AS (
+        INSERT INTO expense.transactions (uid, transaction_date, dorder, purpose, memo, pid, amount_spent, aid, amount_received, is_deleted)
+        SELECT %s, transaction_date, dorder, purpose, memo, pid, amount_spent, aid, amount_received, FALSE
+        FROM bulk_transactions
+        RETURNING tid, transaction_date, dorder
+    )
+    UPDATE bulk_transactions b
+    SET tid = ins.tid
+    FROM ins
+    WHERE b.transaction_date = ins.transaction_date AND b.dorder = ins.dorder
+"""
+
+# 一括追加で、以降の既存の口座履歴の残高を更新する（既存の行に、それより前の日付の追加分の合計を加算）
+_BULK_SHIFT_LATER_BALANCES: str = """
+    UPDATE expense.account_histories h
+    SET amount = h.amount + s.shift
+    FROM (
+        SELECT h.hid, sum(e.delta) AS shift
+        FROM expense.account_histories h
+        JOIN bulk_histories e ON e.aid = h.aid AND e.payment_date < h.payment_date
+        WHERE h.is_deleted = FALSE
+          AND h.payment_date > (SELECT min(payment_date) FROM bulk_histories)
+          AND h.tid NOT IN (SELECT tid FROM bulk_transactions)
+        GROUP BY h.hid
+    ) s
+    WHERE h.hid = s.hid
+"""
+
+# 一括削除の取引の削除マーク（パラメータ: uid, 最小の取引日, 最大の取引日, 取引日の配列, dorder の配列）
+# 口座履歴の支払日を求めるため、取引日と支払い方法（削除済みも含む）も返す
+_BULK_DELETE_TRANSACTIONS: str = """
+    WITH deleted AS (
+        UPDATE expense.transactions
+        SET is_deleted = TRUE
+        WHERE uid = %s AND is_deleted = FALSE
+          AND transaction_date >= %s AND transaction_date <= %s
+          AND (transaction_date, dorder) IN (SELECT * FROM unnest(%s::date[], %s::int[]))
+        RETURNING tid, transaction_date, pid
+    )
+    SELECT d.tid, d.transaction_date, p.closing_day, p.payment_offset_month, p.payment_day
+    FROM deleted d
+    LEFT JOIN expense.payments p ON p.pid = d.pid
+"""
+
+# 一括削除の口座履歴の削除マークと、口座毎に最初の削除位置以降の残高の再計算
+# （パラメータ: tid の配列, 最小の支払日, 最大の支払日, 支払日の配列。_SELECT_TRANSACTION_ACCOUNTS と同じ）
+# （WITH 内の UPDATE の結果は同じ文の他の部分から見えないため、seq には削除した行も含まれる）
+_BULK_DELETE_HISTORIES: str = """
+    WITH removed AS (
+        UPDATE expense.account_histories
+        SET is_deleted = TRUE
+        WHERE tid = ANY(%s) AND is_deleted = FALSE
+          AND payment_date >= %s AND payment_date <= %s AND payment_date = ANY(%s)
+        RETURNING hid, aid, payment_date, dorder
+    ), starts AS (
+        SELECT DISTINCT ON (aid) aid, payment_date, dorder
+        FROM removed
+        ORDER BY aid, payment_date, dorder
+    ), seq AS (
+        SELECT h.hid, h.aid, h.payment_date, h.dorder, r.hid IS NOT NULL AS removed,
+               h.amount - COALESCE(lag(h.amount) OVER w, b.amount, 0) AS delta
+        FROM starts s
+        JOIN expense.account_histories h
+          ON h.aid = s.aid AND h.is_deleted = FALSE
+         AND (h.payment_date, h.dorder) >= (s.payment_date, s.dorder)
+         AND h.payment_date >= (SELECT min(payment_date) FROM removed)
+        LEFT JOIN LATERAL (
+            SELECT p.amount FROM expense.account_histories p
+            WHERE p.aid = s.aid AND p.is_deleted = FALSE
+              AND (p.payment_date, p.dorder) < (s.payment_date, s.dorder)
+            ORDER BY p.payment_date DESC, p.dorder DESC
+            LIMIT 1
+        ) b ON TRUE
+        LEFT JOIN removed r ON r.hid = h.hid
+        WINDOW w AS (PARTITION BY h.aid ORDER BY h.payment_date, h.dorder)
+    ), shifted AS (
+        SELECT hid, removed,
+               sum(delta) FILTER (WHERE removed) OVER (PARTITION BY aid ORDER BY payment_date, dorder) AS shift
+        FROM seq
+    )
+    UPDATE expense.account_histories h
+    SET amount = h.amount - s.shift
+    FROM shifted s
+    WHERE h.hid = s.hid AND NOT s.removed AND s.shift <> 0
+"""
+
+# エクスポートの列（列名, Parquet の型）
+_EXPORT_COLUMNS: Dict[str, List[Tuple[str, str]]] = {
+    "transactions": [
+        ("transaction_date", "date32"), ("dorder", "int32"), ("purpose", "string"), ("memo", "string"),
+        ("payment_name", "string"), ("amount_spent", "int64"), ("account_name", "string"), ("amount_received", "int64"),
+    ],
+    "histories": [
+        ("account_name", "string"), ("payment_date", "date32"), ("dorder", "int32"),
+        ("transaction_date", "date32"), ("purpose", "string"), ("balance", "int64"),
+    ],
+}
+
+def _bulk_histories_sql(balance_tree: bool, dorder_counter: bool) -> str:
+    """
+    一括追加の口座履歴の追加（bulk_histories から。残高 = 直前の残高 + 追加分の累積和）
+    """
+    if balance_tree:
+        base = """
+            COALESCE((
+                SELECT sum(t.total) FROM expense.account_balance_tree t
+                WHERE t.aid = e.aid AND t.node = ANY(e.nodes)
+            ), 0)
+          + COALESCE((
+                SELECT sum(h.delta) FROM expense.account_histories h
+                WHERE h.aid = e.aid AND h.is_deleted = FALSE
+                  AND h.payment_date >= date_trunc('month', e.payment_date)::date
+                  AND h.payment_date <= e.payment_date
+            ), 0)
+        """
+    else:
+        base = """
+            COALESCE((
+                SELECT h.amount FROM expense.account_histories h
+                WHERE h.aid = e.aid AND h.is_deleted = FALSE AND h.payment_date <= e.payment_date
+                ORDER BY h.payment_date DESC, h.dorder DESC
+                LIMIT 1
+            ), 0)
+        """
+    if dorder_counter:
+        # (aid, payment_date) 毎に件数分をまとめて払い出す
+        alloc = """
+            alloc AS (
+                INSERT INTO expense.account_history_dorders AS c (aid, payment_date, last_dorder)
+                SELECT aid, payment_date, count(*) FROM bulk_histories GROUP BY aid, payment_date
+                ON CONFLICT (aid, payment_date) DO UPDATE
+                SET last_dorder = c.last_dorder + EXCLUDED.last_dorder
+                RETURNING aid, payment_date, last_dorder
+            ),
+        """
+        last_dorder = "(SELECT a.last_dorder FROM alloc a WHERE a.aid = e.aid AND a.payment_date = e.payment_date) - count(*) OVER (PARTITION BY e.aid, e.payment_date)"
+    else:
+        alloc = ""
+        last_dorder = """
+            COALESCE((
+                SELECT max(h.dorder) FROM expense.account_histories h
+                WHERE h.aid = e.aid AND h.payment_date = e.payment_date
+            ), 0)
+        """
+    return f"""
+        WITH {alloc} numbered AS (
+            SELECT e.aid, e.payment_date, b.tid, e.delta,
+                   {last_dorder}
+                 + row_number() OVER (PARTITION BY e.aid, e.payment_date ORDER BY e.seq, e.side) AS dorder,
+                   {base}
+                 + sum(e.delta) OVER (PARTITION BY e.aid ORDER BY e.payment_date, e.seq, e.side) AS amount
+            FROM bulk_histories e
+            JOIN bulk_transactions b ON b.seq = e.seq
+        )
+        INSERT INTO expense.account_histories (aid, payment_date, dorder, tid, amount, {"delta, " if balance_tree else ""}is_deleted)
+        SELECT aid, payment_date, dorder, tid, amount, {"delta, " if balance_tree else ""}FALSE
+        FROM numbered
+    """
+
+def _transaction_info(row: Tuple[Any, ...]) -> TransactionInfo:
+    return TransactionInfo(transaction_date=row[0], dorder=row[1], purpose=row[2], memo=row[3],
+                           pname=row[4], amount_spent=row[5], aname=row[6], amount_received=row[7])
+
+def _copy_text(values: Iterable[Any]) -> str:
+    """
+    COPY（text形式）の1行を作る
+    """
+    fields: List[str] = []
+    for value in values:
+        if value is None:
+            fields.append("\\N")
+        elif isinstance(value, list):
+            fields.append("{" + ",".join(str(v) for v in value) + "}")
+        else:
+            fields.append(str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r"))
+    return "\t".join(fields) + "\n"
+
+def calc_payment_date(transaction_date: date, closing_day: int, payment_offset_month: int, payment_day: int) -> date:
+    """
+    支出日計算
+
+    parameters
+        transaction_date: 取引日
+        closing_day: 締め日（0の場合は当日払い）
+        payment_offset_month: 支払い月ズレ
+        payment_day: 支払い日
+
+    returns
+        支出日
+
+    notes:
+        closing_day=0の場合、支出日=取引日
+        closing_day>0の場合、支出日の「年月」は、「取引日」+「payment_offset_month」、支出日の「日」は、payment_day
+        （payment_dayがその月の末日を超える場合は末日）
+    """
+    if closing_day == 0:
+        return transaction_date
+
+    # 年月を計算（payment_offset_monthを加算）
+    year: int = transaction_date.year
+    month: int = transaction_date.month
+    month += payment_offset_month
+    while month > 12:
+        month -= 12
+        year += 1
+    while month < 1:
+        month += 12
+        year -= 1
+    # 日付の妥当性を確認
+    max_day: int = monthrange(year, month)[1]
+    day: int = min(payment_day, max_day)
+    return date(year, month, day)
+
+def _history_dates(rows: Iterable[Tuple[date, Optional[int], Optional[int], Optional[int]]]) -> List[date]:
+    """
+    取引の口座履歴の支払日（パーティションの絞り込み用）
+
+    parameters
+        rows: 取引毎の (取引日, closing_day, payment_offset_month, payment_day)。支払い方法がない場合は closing_day 以降が None
+
+    returns
+        収入の支払日（取引日）と支出の支払日（calc_payment_date）の重複を除いた並び
+    """
+    dates: Dict[date, None] = {}
+    for transaction_date, closing_day, payment_offset_month, payment_day in rows:
+        dates[transaction_date] = None
+        if closing_day is not None:
+            dates[calc_payment_date(transaction_date, closing_day, payment_offset_month, payment_day)] = None
+    return list(dates)
 
 class Expense:
 
     _dsn: str = ""
-
-    def __init__(self: Self, dbhost: str, dbport: int, dbname: str, dbuser: str, dbpass: str) -> None:
+    _pool: Optional[ConnectionPool] = None
+    _cache: Optional[TTLCache] = None
+    _tree: Optional[BalanceTree] = None
+    _dorder_counter: bool = False
+    _locks: Optional[AccountLocks] = None
+    _server_function: bool = False
+    _prepared: Optional[PreparedStatements] = None
+
+    def __init__(self: Self, dbhost: str, dbport: int, dbname: str, dbuser: str, dbpass: str, pool: Optional[ConnectionPool] = None,
+                 cache: Optional[TTLCache] = None, balance_tree: bool = False, dorder_counter: bool = False,
+                 locks: Optional[AccountLocks] = None, server_function: bool = False,
+                 prepared: Optional[PreparedStatements] = None) -> None:
+        """
+        Parameters:
+            dbhost, dbport, dbname, dbuser, dbpass: DB接続情報
+            pool: コネクションプール。指定した場合は呼び出し毎の接続を行わず、プールから借りる
+            cache: 指定した場合、ユーザID・口座ID・支払い方法の検索結果をキャッシュする。
+                   このインスタンスでの口座・支払い方法の作成／削除時に破棄する。
+                   他プロセスでの変更は ttl の間反映されない
+            balance_tree: True の場合、残高を差分と月毎の Fenwick木で管理する（balance.BalanceTree）。
+                   取引の追加・削除で以降の口座履歴を書き換えない。
+                   test_environment/make_balance_tree.sql を適用したDBでは必ず指定する（指定しない書き込みはDBが拒否する）
+            dorder_counter: True の場合、一括追加の dorder を採番テーブルから払い出す。
+                   test_environment/make_dorder_counter.sql の適用が必要（1件毎の追加はトリガーで採番テーブルを使う）
+            locks: 指定した場合、口座履歴を更新する前に対象の口座をロックし、同じ口座への書き込みを直列化する。
+                   複数のインスタンス・プロセスで同じ口座に書き込む場合に指定する（ロック待ちは locks.stats() で確認できる）
+            server_function: True の場合、add_transaction をサーバ側関数 expense.add_transaction の1回の呼び出しで行う。
+                   test_environment/make_add_transaction_function.sql の適用が必要。balance_tree指定時は使わない
+            prepared: 指定した場合、ユーザID取得・残高取得の文を接続毎に PREPARE して名前で実行する。
+                   pool と合わせて指定する（pool がない場合は ValueError）。Authorize と同じインスタンスを共有できる
+        """
         self._dsn = f"host={dbhost} port={dbport} dbname={dbname} user={dbuser} password={dbpass}"
+        self._pool = pool
+        self._cache = cache
+        self._tree = BalanceTree() if balance_tree else None
+        self._dorder_counter = dorder_counter
+        self._locks = locks
+        self._server_function = server_function
+        if prepared is not None and pool is None:
+            raise ValueError("prepared は pool と合わせて指定してください")
+        self._prepared = prepared
+        self._local = threading.local()
         return
 
+    def _connect(self: Self) -> ContextManager[Any]:
+        """
+        DB接続を取得する
+
+        プール未指定時は毎回接続する。いずれも with 文の終了時に commit（例外時は rollback）される。
+        このスレッドで session を使用中の場合は、その接続を使う（操作毎のセーブポイントになり、commit しない）。
+        """
+        session: Optional[ExpenseSession] = getattr(self._local, "session", None)
+        if session is not None:
+            return session._operation()
+        if self._pool is not None:
+            return self._pool.connection()
+        return psycopg2.connect(self._dsn)
+
+    def _cached(self: Self, key: Hashable, load: Any) -> Any:
+        """
+        キャッシュから取得する。ない場合は load() の結果を登録する（None は登録しない）
+
+        session の中で読み込んだ値は commit まで登録しない（commit 前の行のIDを他の接続に見せないため）。
+        """
+        if self._cache is None:
+            return load()
+        session: Optional[ExpenseSession] = getattr(self._local, "session", None)
+        if session is not None and key in session._cache_pending:
+            value = session._cache_pending[key][0]
+        else:
+            value = self._cache.get(key)
+        if value is not None:
+            return value
+        generation = self._cache.generation()
+        value = load()
+        if value is not None:
+            if session is not None:
+                session._cache_pending[key] = (value, generation)
+            else:
+                self._cache.put(key, value, generation)
+        return value
+
+    def _invalidate(self: Self, key: Hashable) -> None:
+        if self._cache is not None:
+            self._cache.delete(key)
+            session: Optional[ExpenseSession] = getattr(self._local, "session", None)
+            if session is not None:
+                # commit 時にも破棄する（それまでに他の接続が変更前の値を登録することがあるため）
+                session._cache_pending[key] = (None, None)
+        return
+
+    def _execute(self: Self, cur: Any, name: str, sql: str, params: Tuple[Any, ...]) -> None:
+        """
+        頻繁に実行する文の実行（prepared 指定時は準備済み文で実行する）
+        """
+        if self._prepared is not None:
+            self._prepared.execute(cur, name, sql, params)
+        else:
+            cur.execute(sql, params)
+        return
+
+    def _lock_accounts(self: Self, cur: Any, aids: Iterable[Optional[int]]) -> None:
+        """
+        口座をロックする（locks 未指定時は何もしない）
+        """
+        if self._locks is not None:
+            self._locks.lock(cur, aids)
+        return
+
+    def _lock_transaction_accounts(self: Self, cur: Any, tids: List[int], payment_dates: List[date]) -> None:
+        """
+        取引の口座履歴の口座をロックする（locks 未指定時は何もしない）
+        """
+        if self._locks is not None:
+            cur.execute(_SELECT_TRANSACTION_ACCOUNTS, (tids, min(payment_dates), max(payment_dates), payment_dates))
+            self._locks.lock(cur, [row[0] for row in cur.fetchall()])
+        return
+
+    def _get_uid(self: Self, cur: Any, uname: str) -> Optional[int]:
+        """
+        ユーザID取得
+        """
+        session: Optional[ExpenseSession] = getattr(self._local, "session", None)
+        if session is not None and session.uname == uname and session.uid is not None:
+            return session.uid
+
+        def load() -> Optional[int]:
+            self._execute(cur, "expense_uid", _SELECT_UID, (uname,))
+            row = cur.fetchone()
+            return row[0] if row is not None else None
+        return self._cached(("uid", uname), load)
+
+    def _get_aid(self: Self, cur: Any, uid: int, aname: str) -> Optional[int]:
+        """
+        口座ID取得（削除済みを除く）
+        """
+        def load() -> Optional[int]:
+            cur.execute(_SELECT_AID, (uid, aname))
+            row = cur.fetchone()
+            return row[0] if row is not None else None
+        return self._cached(("aid", uid, aname), load)
+
+    def _get_payment(self: Self, cur: Any, uid: int, pname: str) -> Optional[PaymentInfo]:
+        """
+        支払い方法取得（削除済みを除く）
+        """
+        def load() -> Optional[PaymentInfo]:
+            cur.execute(_SELECT_PAYMENT, (uid, pname))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return PaymentInfo(pid=row[0], aid=row[1], closing_day=row[2], payment_offset_month=row[3], payment_day=row[4])
+        return self._cached(("payment", uid, pname), load)
+
+    def session(self: Self, uname: str, commit_every: Optional[int] = None) -> "ExpenseSession":
+        """
+        複数の操作を1本の接続・1トランザクションで行うセッション
+
+        使用例:
+            with expense.session("admin") as s:
+                s.create_account("口座")
+                s.create_immediate_payment("現金", "口座")
+                s.add_transactions_bulk(rows)
+
+        parameters
+            uname: ユーザ名（セッションの操作はすべてこのユーザで行う）
+            commit_every: 指定した場合、この操作数毎に commit する。省略時は with 文の終了時にまとめて commit する
+        """
+        return ExpenseSession(self, uname, commit_every)
+
     def create_account(self: Self, uname: str, aname: str) -> bool:
         """
         口座作成処理
@@ -41,14 +676,12 @@ class Expense:
             正常に処理できたらTrue、できなかったらFalseを返す。
         """
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
                     # ユーザIDを取得
-                    cur.execute("SELECT uid FROM auth.users WHERE uname = %s", (uname,))
-                    row = cur.fetchone()
-                    if row is None:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
                         return False
-                    uid: int = row[0]
 
                     # 口座を追加
                     cur.execute("""
@@ -57,6 +690,7 @@ class Expense:
                     """, (uid, aname))
 
                     conn.commit()
+                    self._invalidate(("aid", uid, aname))
                     return True
         except Exception as e:
             print(f"エラーが発生しました: {e}")
@@ -85,24 +719,17 @@ class Expense:
             正常に処理できたらTrue、できなかったらFalseを返す。
         """
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
                     # ユーザIDを取得
-                    cur.execute("SELECT uid FROM auth.users WHERE uname = %s", (uname,))
-                    row = cur.fetchone()
-                    if row is None:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
                         return False
-                    uid: int = row[0]
 
                     # 口座IDを取得
-                    cur.execute("""
-                        SELECT aid FROM expense.accounts
-                        WHERE uid = %s AND account_name = %s AND is_deleted = FALSE
-                    """, (uid, aname))
-                    row = cur.fetchone()
-                    if row is None:
+                    aid: Optional[int] = self._get_aid(cur, uid, aname)
+                    if aid is None:
                         return False
-                    aid: int = row[0]
 
                     # 削除済みマークを付ける（同名が存在する場合は連番を付ける）
                     new_name: str = f"{aname}(削除済み)"
@@ -125,6 +752,7 @@ class Expense:
                     """, (new_name, aid))
 
                     conn.commit()
+                    self._invalidate(("aid", uid, aname))
                     return True
         except Exception as e:
             print(f"エラーが発生しました: {e}")
@@ -160,24 +788,17 @@ class Expense:
             正常に処理できたらTrue、できなかったらFalseを返す。
         """
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
                     # ユーザIDを取得
-                    cur.execute("SELECT uid FROM auth.users WHERE uname = %s", (uname,))
-                    row = cur.fetchone()
-                    if row is None:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
                         return False
-                    uid: int = row[0]
 
                     # 口座IDを取得
-                    cur.execute("""
-                        SELECT aid FROM expense.accounts
-                        WHERE uid = %s AND account_name = %s AND is_deleted = FALSE
-                    """, (uid, aname))
-                    row = cur.fetchone()
-                    if row is None:
+                    aid: Optional[int] = self._get_aid(cur, uid, aname)
+                    if aid is None:
                         return False
-                    aid: int = row[0]
 
                     # 支払い方法を追加
                     cur.execute("""
@@ -186,6 +807,7 @@ class Expense:
                     """, (uid, pname, aid))
 
                     conn.commit()
+                    self._invalidate(("payment", uid, pname))
                     return True
         except Exception as e:
             print(f"エラーが発生しました: {e}")
@@ -224,24 +846,17 @@ class Expense:
             正常に処理できたらTrue、できなかったらFalseを返す。
         """
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
                     # ユーザIDを取得
-                    cur.execute("SELECT uid FROM auth.users WHERE uname = %s", (uname,))
-                    row = cur.fetchone()
-                    if row is None:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
                         return False
-                    uid: int = row[0]
 
                     # 口座IDを取得
-                    cur.execute("""
-                        SELECT aid FROM expense.accounts
-                        WHERE uid = %s AND account_name = %s AND is_deleted = FALSE
-                    """, (uid, aname))
-                    row = cur.fetchone()
-                    if row is None:
+                    aid: Optional[int] = self._get_aid(cur, uid, aname)
+                    if aid is None:
                         return False
-                    aid: int = row[0]
 
                     # 支払い方法を追加
                     cur.execute("""
@@ -250,6 +865,7 @@ class Expense:
                     """, (uid, pname, close_day, payment_offset_month, payment_day, aid))
 
                     conn.commit()
+                    self._invalidate(("payment", uid, pname))
                     return True
         except Exception as e:
             print(f"エラーが発生しました: {e}")
@@ -278,24 +894,18 @@ class Expense:
             正常に処理できたらTrue、できなかったらFalseを返す。
         """
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
                     # ユーザIDを取得
-                    cur.execute("SELECT uid FROM auth.users WHERE uname = %s", (uname,))
-                    row = cur.fetchone()
-                    if row is None:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
                         return False
-                    uid: int = row[0]
 
                     # 支払い方法IDを取得
-                    cur.execute("""
-                        SELECT pid FROM expense.payments
-                        WHERE uid = %s AND payment_name = %s AND deleted_at IS NULL
-                    """, (uid, pname))
-                    row = cur.fetchone()
-                    if row is None:
+                    payment: Optional[PaymentInfo] = self._get_payment(cur, uid, pname)
+                    if payment is None:
                         return False
-                    pid: int = row[0]
+                    pid: int = payment["pid"]
 
                     # 削除済みマークを付ける（同名が存在する場合は連番を付ける）
                     new_name: str = f"{pname}(削除済み)"
@@ -318,6 +928,7 @@ class Expense:
                     """, (new_name, pid))
 
                     conn.commit()
+                    self._invalidate(("payment", uid, pname))
                     return True
         except Exception as e:
             print(f"エラーが発生しました: {e}")
@@ -407,139 +1018,116 @@ class Expense:
             更新値 amount = amount + 引数のamount_received
             収入の処理 ここまで
 
+            balance_tree指定時は、口座履歴の追加を BalanceTree.append で行い、以降の残高は更新しない。
+            server_function指定時は、以上をサーバ側関数で行う（_add_transaction_server）。
+
             すべて正常に処理できた場合にはcommitする。処理異常が発生した場合には、rollbackする。
             正常に処理できたらTrue、できなかったらFalseを返す。
         """
+        if self._server_function and self._tree is None:
+            return self._add_transaction_server(uname, tdate, purpose, memo, pname, amount_spent, aname, amount_received)
+
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
                     # ユーザIDを取得
-                    cur.execute("SELECT uid FROM auth.users WHERE uname = %s", (uname,))
-                    row = cur.fetchone()
-                    if row is None:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
                         return False
-                    uid: int = row[0]
 
                     # 支出pidを取得
+                    payment: Optional[PaymentInfo] = None
                     expense_pid: Optional[int] = None
                     if pname is not None:
-                        cur.execute("""
-                            SELECT pid FROM expense.payments
-                            WHERE uid = %s AND payment_name = %s AND deleted_at IS NULL
-                        """, (uid, pname))
-                        row = cur.fetchone()
-                        if row is not None:
-                            expense_pid = row[0]
+                        payment = self._get_payment(cur, uid, pname)
+                        if payment is not None:
+                            expense_pid = payment["pid"]
 
                     # 収入aidを取得
                     income_aid: Optional[int] = None
                     if aname is not None:
-                        cur.execute("""
-                            SELECT aid FROM expense.accounts
-                            WHERE uid = %s AND account_name = %s AND is_deleted = FALSE
-                        """, (uid, aname))
-                        row = cur.fetchone()
-                        if row is not None:
-                            income_aid = row[0]
+                        income_aid = self._get_aid(cur, uid, aname)
+
+                    # 口座をロック
+                    self._lock_accounts(cur, [payment["aid"] if payment is not None else None, income_aid])
 
                     # 取引日をdate型に変換
                     transaction_date: date = tdate.date()
 
                     # 取引を追加
-                    cur.execute("""
-                        INSERT INTO expense.transactions (uid, transaction_date, purpose, memo, pid, amount_spent, aid, amount_received, is_deleted)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, FALSE)
-                        RETURNING tid
-                    """, (uid, transaction_date, purpose, memo, expense_pid, amount_spent, income_aid, amount_received))
+                    cur.execute(_INSERT_TRANSACTION, (uid, transaction_date, purpose, memo, expense_pid, amount_spent, income_aid, amount_received))
                     row = cur.fetchone()
                     if row is None:
                         return False
                     tid: int = row[0]
 
                     # 支出の処理
-                    if expense_pid is not None:
-                        # 支払い方法情報を取得
-                        cur.execute("""
-                            SELECT aid, closing_day, payment_offset_month, payment_day
-                            FROM expense.payments
-                            WHERE uid = %s AND pid = %s AND deleted_at IS NULL
-                        """, (uid, expense_pid))
-                        row = cur.fetchone()
-                        if row is None:
-                            return False
-                        expense_aid: int = row[0]
-                        closing_day: int = row[1]
-                        payment_offset_month: int = row[2]
-                        payment_day: int = row[3]
+                    if payment is not None:
+                        # 支払い方法情報
+                        expense_aid: int = payment["aid"]
+                        closing_day: int = payment["closing_day"]
+                        payment_offset_month: int = payment["payment_offset_month"]
+                        payment_day: int = payment["payment_day"]
 
                         # 支出日を決定
-                        if closing_day == 0:
-                            payment_date: date = transaction_date
+                        payment_date: date = calc_payment_date(transaction_date, closing_day, payment_offset_month, payment_day)
+
+                        if self._tree is not None:
+                            # 口座履歴を追加（以降の残高は更新しない）
+                            self._tree.append(cur, expense_aid, payment_date, tid, -amount_spent)
                         else:
-                            # 年月を計算（payment_offset_monthを加算）
-                            year: int = transaction_date.year
-                            month: int = transaction_date.month
-                            month += payment_offset_month
-                            while month > 12:
-                                month -= 12
-                                year += 1
-                            while month < 1:
-                                month += 12
-                                year -= 1
-                            # 日付の妥当性を確認
-                            max_day: int = monthrange(year, month)[1]
-                            day: int = min(payment_day, max_day)
-                            payment_date = date(year, month, day)
-
-                        # 支出残額を取得
-                        cur.execute("""
-                            SELECT amount FROM expense.account_histories
-                            WHERE aid = %s AND is_deleted = FALSE AND payment_date <= %s
-                            ORDER BY payment_date DESC, dorder DESC
-                            LIMIT 1
-                        """, (expense_aid, payment_date))
-                        row = cur.fetchone()
-                        expense_balance: int = row[0] if row is not None else 0
+                            # 支出残額を取得
+                            self._execute(cur, "expense_balance_probe", _BALANCE_PROBE, (expense_aid, payment_date))
+                            row = cur.fetchone()
+                            expense_balance: int = row[0] if row is not None else 0
 
-                        # 口座履歴を追加
-                        cur.execute("""
-                            INSERT INTO expense.account_histories (aid, payment_date, tid, amount, is_deleted)
-                            VALUES (%s, %s, %s, %s, FALSE)
-                        """, (expense_aid, payment_date, tid, expense_balance - amount_spent))
+                            # 口座履歴を追加
+                            cur.execute(_INSERT_HISTORY, (expense_aid, payment_date, tid, expense_balance - amount_spent))
 
-                        # 以降の残高を更新
-                        cur.execute("""
-                            UPDATE expense.account_histories
-                            SET amount = amount - %s
-                            WHERE aid = %s AND is_deleted = FALSE AND payment_date > %s
-                        """, (amount_spent, expense_aid, payment_date))
+                            # 以降の残高を更新
+                            cur.execute(_SHIFT_LATER_BALANCES, (-amount_spent, expense_aid, payment_date))
 
                     # 収入の処理
                     if income_aid is not None:
                         income_date: date = transaction_date
 
-                        # 収入残額を取得
-                        cur.execute("""
-                            SELECT amount FROM expense.account_histories
-                            WHERE aid = %s AND is_deleted = FALSE AND payment_date <= %s
-                            ORDER BY payment_date DESC, dorder DESC
-                            LIMIT 1
-                        """, (income_aid, income_date))
-                        row = cur.fetchone()
-                        income_balance: int = row[0] if row is not None else 0
+                        if self._tree is not None:
+                            # 口座履歴を追加（以降の残高は更新しない）
+                            self._tree.append(cur, income_aid, income_date, tid, amount_received)
+                        else:
+                            # 収入残額を取得
+                            self._execute(cur, "expense_balance_probe", _BALANCE_PROBE, (income_aid, income_date))
+                            row = cur.fetchone()
+                            income_balance: int = row[0] if row is not None else 0
 
-                        # 口座履歴を追加
-                        cur.execute("""
-                            INSERT INTO expense.account_histories (aid, payment_date, tid, amount, is_deleted)
-                            VALUES (%s, %s, %s, %s, FALSE)
-                        """, (income_aid, income_date, tid, income_balance + amount_received))
+                            # 口座履歴を追加
+                            cur.execute(_INSERT_HISTORY, (income_aid, income_date, tid, income_balance + amount_received))
 
-                        # 以降の残高を更新
-                        cur.execute("""
-                            UPDATE expense.account_histories
-                            SET amount = amount + %s
-                            WHERE aid = %s AND is_deleted = FALSE AND payment_date > %s
-                        """, (amount_received, income_aid, income_date))
+                            # 以降の残高を更新
+                            cur.execute(_SHIFT_LATER_BALANCES, (amount_received, income_aid, income_date))
+
+                    conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+    def _add_transaction_server(self: Self, uname: str, tdate: dtm, purpose: str, memo: Optional[str], pname: Optional[str], amount_spent: int, aname: Optional[str], amount_received: int) -> bool:
+        """
+        取引追加（サーバ側関数 expense.add_transaction の1回の呼び出しで行う）
+
+        DBとの往復は、関数の呼び出しと commit の2回（add_transaction は支出・収入の両方がある場合、
+        ユーザID・支払い方法・口座の検索、取引の追加、口座毎の残高取得・履歴追加・残高更新と commit の11回）。
+        locks 指定時は関数内で口座をロックする（locks.stats() には計上されない）。
+        """
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(_ADD_TRANSACTION_FUNCTION, (uname, tdate.date(), purpose, memo, pname, amount_spent, aname, amount_received,
+                                                            self._locks.namespace if self._locks is not None else None))
+                    row = cur.fetchone()
+                    if row is None or row[0] is None:
+                        return False
 
                     conn.commit()
                     return True
@@ -567,15 +1155,17 @@ class Expense:
             expense.transactionsから、uid、transaction_date=引数のtdateの日付、dorder=引数のdorder、is_deleted=Falseを条件に、tid、pid、aid、amount_spent、amount_receivedを取得する。以降、tidを支出tid、aidを収入aidと呼称する。
 
             expense.transactionsを以下の条件で更新する
-            条件 tid = 取得したtid
+            条件 tid = 取得したtid、transaction_date=引数のtdateの日付
             更新値 is_deleted True
 
             支出取り消し処理（支出pidがNULL以外の場合に実行する。NULLの場合は実行しない）
-            expense.paymentsから、uid、pid=支出pid、deleted_at=NULLを条件に、aidを取得する。以降、aidを支出aidと呼称する。
-            expense.account_historiesから、aid=支出aid、tid=取得したtid、is_deleted=Falseを条件に、payment_date、dorderを取得する。以降、支出payment_date、支出dorderと呼称する。
+            expense.paymentsから、uid、pid=支出pid を条件に、aid、closing_day、payment_offset_month、payment_dayを取得する。以降、aidを支出aidと呼称する。
+            （deleted_at は条件にしない。支払い方法が削除済みでも、登録時の口座履歴を取り消す）
+            取引日と支払い方法から支出日を決定する（calc_payment_date）。
+            expense.account_historiesから、aid=支出aid、tid=取得したtid、payment_date=支出日、is_deleted=Falseを条件に、payment_date、dorderを取得する。以降、支出payment_date、支出dorderと呼称する。
 
             以下の条件で、expense.account_historiesを更新する。
-            条件 aid=支出aid、tid=取得したtid、is_deleted=False
+            条件 aid=支出aid、tid=取得したtid、payment_date=支出payment_date、is_deleted=False
             更新値 is_deleted True
 
             以下の条件で、expense.account_historiesを更新する。
@@ -584,10 +1174,10 @@ class Expense:
             支出取り消し処理 ここまで
 
             収入取り消し処理（収入aidがNULL以外の場合に実行する。NULLの場合は実行しない）
-            expense.account_historiesから、aid=収入aid、tid=取得したtid、is_deleted=Falseを条件に、payment_date、dorderを取得する。以降、収入payment_date、収入dorderと呼称する。
+            expense.account_historiesから、aid=収入aid、tid=取得したtid、payment_date=取引日、is_deleted=Falseを条件に、payment_date、dorderを取得する。以降、収入payment_date、収入dorderと呼称する。
 
             以下の条件で、expense.account_historiesを更新する。
-            条件 aid=収入aid、tid=取得したtid、is_deleted=False
+            条件 aid=収入aid、tid=取得したtid、payment_date=収入payment_date、is_deleted=False
             更新値 is_deleted True
 
             以下の条件で、expense.account_historiesを更新する。
@@ -595,28 +1185,27 @@ class Expense:
             更新値 amount = amount - amount_received
             収入取り消し処理 ここまで
 
+            balance_tree指定時は、tidの口座履歴をすべて BalanceTree.remove で削除マークし、以降の残高は更新しない。
+
+            取引・口座履歴の条件に日付を含めるのは、パーティション分割（make_partition.sql）時に対象の年だけを読むため。
+            そのため支払い方法の取得は口座のロックより前に行い、ロック・BalanceTree.remove でも取引日と支出日を条件にする。
+
             すべて正常に処理できた場合にはcommitする。処理異常が発生した場合には、rollbackする。
             正常に処理できたらTrue、できなかったらFalseを返す。
         """
         try:
-            with psycopg2.connect(self._dsn) as conn:
+            with self._connect() as conn:
                 with conn.cursor() as cur:
                     # ユーザIDを取得
-                    cur.execute("SELECT uid FROM auth.users WHERE uname = %s", (uname,))
-                    row = cur.fetchone()
-                    if row is None:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
                         return False
-                    uid: int = row[0]
 
                     # 取引日をdate型に変換
                     transaction_date: date = tdate.date()
 
                     # 取引情報を取得
-                    cur.execute("""
-                        SELECT tid, pid, aid, amount_spent, amount_received
-                        FROM expense.transactions
-                        WHERE uid = %s AND transaction_date = %s AND dorder = %s AND is_deleted = FALSE
-                    """, (uid, transaction_date, dorder))
+                    cur.execute(_SELECT_TRANSACTION, (uid, transaction_date, dorder))
                     row = cur.fetchone()
                     if row is None:
                         return False
@@ -626,80 +1215,674 @@ class Expense:
                     amount_spent: int = row[3]
                     amount_received: int = row[4]
 
-                    # 取引を削除マーク
-                    cur.execute("""
-                        UPDATE expense.transactions
-                        SET is_deleted = TRUE
-                        WHERE tid = %s
-                    """, (tid,))
-
-                    # 支出取り消し処理
+                    # 支払い方法から口座IDを取得し、支出日を決定（削除済みの支払い方法も含む）
+                    expense_aid: Optional[int] = None
+                    payment_date: Optional[date] = None
                     if expense_pid is not None:
-                        # 支払い方法から口座IDを取得
-                        cur.execute("""
-                            SELECT aid FROM expense.payments
-                            WHERE uid = %s AND pid = %s AND deleted_at IS NULL
-                        """, (uid, expense_pid))
+                        cur.execute(_SELECT_TRANSACTION_PAYMENT, (uid, expense_pid))
                         row = cur.fetchone()
                         if row is not None:
-                            expense_aid: int = row[0]
+                            expense_aid = row[0]
+                            payment_date = calc_payment_date(transaction_date, row[1], row[2], row[3])
+
+                    # 口座履歴の支払日（パーティションの絞り込み用）
+                    payment_dates: List[date] = [transaction_date] if payment_date in (None, transaction_date) else [transaction_date, payment_date]
 
+                    # 口座をロック
+                    self._lock_transaction_accounts(cur, [tid], payment_dates)
+
+                    # 取引を削除マーク
+                    cur.execute(_DELETE_TRANSACTION, (tid, transaction_date))
+
+                    if self._tree is not None:
+                        # 口座履歴を削除マーク（以降の残高は更新しない）
+                        self._tree.remove(cur, tid, payment_dates)
+                    else:
+                        # 支出取り消し処理
+                        if expense_aid is not None and payment_date is not None:
                             # 口座履歴からpayment_dateとdorderを取得
-                            cur.execute("""
-                                SELECT payment_date, dorder
-                                FROM expense.account_histories
-                                WHERE aid = %s AND tid = %s AND is_deleted = FALSE
-                            """, (expense_aid, tid))
+                            cur.execute(_SELECT_TRANSACTION_HISTORY, (expense_aid, tid, payment_date))
                             row = cur.fetchone()
                             if row is not None:
                                 expense_payment_date: date = row[0]
                                 expense_dorder: int = row[1]
 
                                 # 口座履歴を削除マーク
-                                cur.execute("""
-                                    UPDATE expense.account_histories
-                                    SET is_deleted = TRUE
-                                    WHERE aid = %s AND tid = %s AND is_deleted = FALSE
-                                """, (expense_aid, tid))
+                                cur.execute(_DELETE_TRANSACTION_HISTORY, (expense_aid, tid, expense_payment_date))
 
                                 # 以降の残高を更新（支出を取り消すので加算）
-                                cur.execute("""
-                                    UPDATE expense.account_histories
-                                    SET amount = amount + %s
-                                    WHERE aid = %s AND is_deleted = FALSE
-                                    AND (payment_date > %s OR (payment_date = %s AND dorder > %s))
-                                """, (amount_spent, expense_aid, expense_payment_date, expense_payment_date, expense_dorder))
-
-                    # 収入取り消し処理
-                    if income_aid is not None:
-                        # 口座履歴からpayment_dateとdorderを取得
-                        cur.execute("""
-                            SELECT payment_date, dorder
-                            FROM expense.account_histories
-                            WHERE aid = %s AND tid = %s AND is_deleted = FALSE
-                        """, (income_aid, tid))
-                        row = cur.fetchone()
-                        if row is not None:
-                            income_payment_date: date = row[0]
-                            income_dorder: int = row[1]
-
-                            # 口座履歴を削除マーク
-                            cur.execute("""
-                                UPDATE expense.account_histories
-                                SET is_deleted = TRUE
-                                WHERE aid = %s AND tid = %s AND is_deleted = FALSE
-                            """, (income_aid, tid))
-
-                            # 以降の残高を更新（収入を取り消すので減算）
-                            cur.execute("""
-                                UPDATE expense.account_histories
-                                SET amount = amount - %s
-                                WHERE aid = %s AND is_deleted = FALSE
-                                AND (payment_date > %s OR (payment_date = %s AND dorder > %s))
-                            """, (amount_received, income_aid, income_payment_date, income_payment_date, income_dorder))
+                                cur.execute(_SHIFT_BALANCES_AFTER, (amount_spent, expense_aid, expense_payment_date, expense_payment_date, expense_dorder))
+
+                        # 収入取り消し処理
+                        if income_aid is not None:
+                            # 口座履歴からpayment_dateとdorderを取得
+                            cur.execute(_SELECT_TRANSACTION_HISTORY, (income_aid, tid, transaction_date))
+                            row = cur.fetchone()
+                            if row is not None:
+                                income_payment_date: date = row[0]
+                                income_dorder: int = row[1]
+
+                                # 口座履歴を削除マーク
+                                cur.execute(_DELETE_TRANSACTION_HISTORY, (income_aid, tid, income_payment_date))
+
+                                # 以降の残高を更新（収入を取り消すので減算）
+                                cur.execute(_SHIFT_BALANCES_AFTER, (-amount_received, income_aid, income_payment_date, income_payment_date, income_dorder))
+
+                    conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+    def _select_balances(self: Self, cur: Any, uid: int, as_of: date, aname: Optional[str] = None) -> Dict[str, int]:
+        """
+        口座毎の残高を1回の問い合わせで取得する（削除済みの口座を除く）
+
+        balance_tree指定時は、前月までの合計を Fenwick木（月毎のスナップショット）のノードから、
+        当月分を口座履歴の delta から求める。
+        未指定時は、口座毎に payment_date<=as_of の最後の口座履歴の amount を
+        UNIQUE(aid, payment_date, dorder) の索引で1件だけ読む。
+        """
+        if self._tree is not None:
+            cur.execute("""
+                SELECT a.account_name,
+                       COALESCE((
+                           SELECT sum(t.total) FROM expense.account_balance_tree t
+                           WHERE t.aid = a.aid AND t.node = ANY(%s)
+                       ), 0)
+                     + COALESCE((
+                           SELECT sum(h.delta) FROM expense.account_histories h
+                           WHERE h.aid = a.aid AND h.is_deleted = FALSE
+                             AND h.payment_date >= %s AND h.payment_date <= %s
+                       ), 0)
+                FROM expense.accounts a
+                WHERE a.uid = %s AND a.is_deleted = FALSE
+                  AND (%s::text IS NULL OR a.account_name = %s)
+                ORDER BY a.aid
+            """, (prefix_nodes(month_index(as_of) - 1), month_start(as_of), as_of, uid, aname, aname))
+        else:
+            cur.execute(_SELECT_BALANCES, (as_of, uid, aname, aname))
+        return {row[0]: int(row[1]) for row in cur.fetchall()}
+
+    def get_balance(self: Self, uname: str, aname: str, as_of: date) -> Optional[int]:
+        """
+        残高取得
+
+        parameters
+            uname: ユーザ名
+            aname: 口座名称
+            as_of: 日付（この日までの口座履歴をすべて反映した残高）
+
+        returns
+            残高（口座履歴がない場合は0）
+            None: ユーザ、口座が存在しない場合、異常終了
+        """
+        if isinstance(as_of, dtm):
+            as_of = as_of.date()
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
+                        return None
+                    return self._select_balances(cur, uid, as_of, aname).get(aname)
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return None
+
+    def get_balances(self: Self, uname: str, as_of: date) -> Optional[Dict[str, int]]:
+        """
+        全口座の残高取得
+
+        parameters
+            uname: ユーザ名
+            as_of: 日付
+
+        returns
+            口座名称 → 残高（削除済みの口座を除く）
+            None: ユーザが存在しない場合、異常終了
+        """
+        if isinstance(as_of, dtm):
+            as_of = as_of.date()
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
+                        return None
+                    return self._select_balances(cur, uid, as_of)
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return None
+
+    def add_transactions_bulk(self: Self, uname: str, rows: Iterable[TransactionRow]) -> bool:
+        """
+        取引一括追加
+
+        parameters
+            uname: ユーザ名
+            rows: 追加する取引（この順に dorder を付与する）
+
+        returns
+            True: 正常終了
+            False: 異常終了
+
+        notes:
+            結果は rows の各行で add_transaction を順に呼んだ場合と同じになる（1トランザクション）。
+            ・取引と口座履歴を COPY で一時テーブルに読み込む
+            ・dorder は (transaction_date) / (aid, payment_date) 毎に、既存の最大値 + 行番号で付与する
+              （dorder_counter指定時は、採番テーブルから件数分をまとめて払い出す）
+            ・支出日は payment_schedule.payment_dates でまとめて計算する
+            ・口座履歴の残高は、直前の既存履歴の残高 + 追加分の累積和（ウィンドウ関数）で求め、
+              以降の既存履歴の残高は1回の UPDATE で更新する
+              （balance_tree指定時は既存履歴を更新せず、木にまとめて加算する）
+            test_environment/make_bulk_dorder.sql の適用が必要。
+        """
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+
+                    # 支払い方法・口座を解決
+                    resolved: List[Tuple[TransactionRow, Optional[PaymentInfo], Optional[int]]] = []
+                    for row in rows:
+                        payment: Optional[PaymentInfo] = None
+                        if row["pname"] is not None:
+                            payment = self._get_payment(cur, uid, row["pname"])
+                        income_aid: Optional[int] = None
+                        if row["aname"] is not None:
+                            income_aid = self._get_aid(cur, uid, row["aname"])
+                        resolved.append((row, payment, income_aid))
+                    count: int = len(resolved)
+
+                    # 支出日をまとめて計算（支払い方法のない行は当日扱いで計算し、使わない）
+                    transaction_dates: List[date] = [row["tdate"].date() for row, _, _ in resolved]
+                    payment_date_list: List[date] = to_dates(payment_dates(
+                        transaction_dates,
+                        [payment["closing_day"] if payment is not None else 0 for _, payment, _ in resolved],
+                        [payment["payment_offset_month"] if payment is not None else 0 for _, payment, _ in resolved],
+                        [payment["payment_day"] if payment is not None else 0 for _, payment, _ in resolved]))
+
+                    transactions = io.StringIO()
+                    entries = io.StringIO()
+                    tree_entries: List[Tuple[int, date, int]] = []
+                    for seq, (row, payment, income_aid) in enumerate(resolved):
+                        transaction_date: date = transaction_dates[seq]
+                        transactions.write(_copy_text((
+                            seq, transaction_date, row["purpose"], row["memo"],
+                            payment["pid"] if payment is not None else None, row["amount_spent"],
+                            income_aid, row["amount_received"])))
+
+                        # 口座履歴（同じ取引では支出 → 収入の順）
+                        histories: List[Tuple[int, date, int]] = []
+                        if payment is not None:
+                            histories.append((payment["aid"], payment_date_list[seq], -row["amount_spent"]))
+                        if income_aid is not None:
+                            histories.append((income_aid, transaction_date, row["amount_received"]))
+                        for side, (aid, payment_date, delta) in enumerate(histories):
+                            nodes = prefix_nodes(month_index(payment_date) - 1) if self._tree is not None else None
+                            entries.write(_copy_text((seq, side, aid, payment_date, delta, nodes)))
+                            tree_entries.append((aid, payment_date, delta))
+
+                    if count == 0:
+                        return True
+
+                    # 口座をロック
+                    self._lock_accounts(cur, [aid for aid, _, _ in tree_entries])
+
+                    cur.execute(_BULK_TABLES)
+                    transactions.seek(0)
+                    cur.copy_expert("""
+                        COPY bulk_transactions (seq, transaction_date, purpose, memo, pid, amount_spent, aid, amount_received)
+                        FROM STDIN
+                    """, transactions)
+                    entries.seek(0)
+                    cur.copy_expert("COPY bulk_histories (seq, side, aid, payment_date, delta, nodes) FROM STDIN", entries)
+
+                    # 取引を追加（dorder = 採番済みの最大値 + 取引日毎の行番号）
+                    if self._dorder_counter:
+                        # 取引日毎に件数分をまとめて払い出す
+                        cur.execute(_BULK_TRANSACTION_DORDERS_COUNTER, (uid,))
+                    else:
+                        cur.execute(_BULK_TRANSACTION_DORDERS, (uid,))
+                    cur.execute(_BULK_INSERT_TRANSACTIONS, (uid,))
+
+                    # 口座履歴を追加（残高 = 直前の残高 + 追加分の累積和）
+                    histories_sql: str = _bulk_histories_sql(self._tree is not None, self._dorder_counter)
+                    cur.execute(TREE_WRITER + histories_sql if self._tree is not None else histories_sql)
+
+                    if self._tree is not None:
+                        self._tree.add(cur, tree_entries)
+                    else:
+                        # 以降の既存履歴の残高を更新（既存の行に、それより前の日付の追加分の合計を加算）
+                        cur.execute(_BULK_SHIFT_LATER_BALANCES)
+
+                    conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+    def delete_transactions_bulk(self: Self, uname: str, keys: Iterable[Tuple[dtm, int]]) -> bool:
+        """
+        取引一括削除
+
+        parameters
+            uname: ユーザ名
+            keys: 削除する取引の (取引日, 表示順)
+
+        returns
+            True: 正常終了
+            False: 異常終了（存在しない取引が含まれる場合は、何も削除しない）
+
+        notes:
+            取引と、その口座履歴をまとめて削除マークする（1トランザクション）。
+            口座毎に、削除した最も前の履歴以降の残高を1回の UPDATE で再計算する。
+            各履歴の増減（amount - 直前の amount）を求め、それより前に削除した履歴の増減の合計を差し引く。
+            balance_tree指定時は、BalanceTree.remove_many で木からまとめて差し引く。
+            口座履歴の条件には、削除した取引の取引日と支出日も含める（パーティション分割時に対象の年だけを読むため）。
+        """
+        key_list: List[Tuple[date, int]] = list(dict.fromkeys((tdate.date(), dorder) for tdate, dorder in keys))
+        if not key_list:
+            return True
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+
+                    # 取引を削除マーク
+                    cur.execute(_BULK_DELETE_TRANSACTIONS, (uid, min(k[0] for k in key_list), max(k[0] for k in key_list), [k[0] for k in key_list], [k[1] for k in key_list]))
+                    rows = cur.fetchall()
+                    if len(rows) != len(key_list):
+                        conn.rollback()
+                        return False
+                    tids: List[int] = [row[0] for row in rows]
+
+                    # 口座履歴の支払日（パーティションの絞り込み用）
+                    payment_dates: List[date] = _history_dates(row[1:] for row in rows)
+
+                    # 口座をロック
+                    self._lock_transaction_accounts(cur, tids, payment_dates)
+
+                    if self._tree is not None:
+                        # 口座履歴を削除マーク（以降の残高は更新しない）
+                        self._tree.remove_many(cur, tids, payment_dates)
+                    else:
+                        # 口座履歴を削除マークし、口座毎に最初の削除位置以降の残高を再計算
+                        cur.execute(_BULK_DELETE_HISTORIES, (tids, min(payment_dates), max(payment_dates), payment_dates))
 
                     conn.commit()
                     return True
         except Exception as e:
             print(f"エラーが発生しました: {e}")
             return False
+
+    def list_transactions(self: Self, uname: str, date_from: date, date_to: date, after: Optional[Tuple[date, int]] = None, limit: int = 100) -> Optional[List[TransactionInfo]]:
+        """
+        取引一覧取得（キーセットページング）
+
+        parameters
+            uname: ユーザ名
+            date_from, date_to: 取引日の範囲（両端を含む）
+            after: 前のページの最後の行の (取引日, 表示順)。省略時は先頭から
+            limit: 最大件数
+
+        returns
+            取引日、表示順の昇順の取引（削除済みを除く）。次のページは、最後の行の (transaction_date, dorder) を after に渡す
+            None: ユーザが存在しない場合、異常終了
+
+        notes:
+            OFFSET を使わず、UNIQUE(uid, transaction_date, dorder) の索引を after の位置から読むため、
+            ページの位置によらず limit 件分のコストで済む
+        """
+        if after is None:
+            # dorder は1始まり
+            after = (date_from, 0)
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
+                        return None
+                    cur.execute(_LIST_TRANSACTIONS, (uid, date_from, date_to, after[0], after[1], limit))
+                    return [_transaction_info(row) for row in cur.fetchall()]
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return None
+
+    def iter_transactions(self: Self, uname: str, date_from: date, date_to: date, batch_size: int = 1000) -> Iterator[TransactionInfo]:
+        """
+        取引一覧取得（ストリーミング）
+
+        parameters
+            uname: ユーザ名
+            date_from, date_to: 取引日の範囲（両端を含む）
+            batch_size: 1回にサーバから受け取る件数
+
+        returns
+            取引日、表示順の昇順の取引（削除済みを除く）を1件ずつ返すジェネレータ。ユーザが存在しない場合は何も返さない
+
+        notes:
+            サーバ側の名前付きカーソルで batch_size 件ずつ受け取るため、範囲の大きさによらずメモリ使用量は一定。
+            読み終わる（またはジェネレータを閉じる）まで接続を占有する。途中で抜けた場合（break、ジェネレータの破棄）も
+            名前付きカーソルを閉じて rollback し、接続を返却する。
+            途中でエラーが発生した場合は、表示した上で例外を送出する（読み終えた分と区別できるように）
+        """
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                if uid is None:
+                    return
+                with conn.cursor(name="expense_iter_transactions") as cur:
+                    cur.itersize = batch_size
+                    cur.execute(f"""
+                        SELECT {_TRANSACTION_COLUMNS}
+                        WHERE t.uid = %s AND t.is_deleted = FALSE
+                          AND t.transaction_date >= %s AND t.transaction_date <= %s
+                        ORDER BY t.transaction_date, t.dorder
+                    """, (uid, date_from, date_to))
+                    for row in cur:
+                        yield _transaction_info(row)
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            raise
+
+    def monthly_summary(self: Self, uname: str, month_from: date, month_to: date) -> Optional[List[MonthlySummary]]:
+        """
+        月別集計取得
+
+        parameters
+            uname: ユーザ名
+            month_from, month_to: 月の範囲（日は無視する。両端の月を含む）
+
+        returns
+            月、用途、支払い方法、入金口座毎の出金・入金の合計と件数（削除済みの取引を除く）
+            None: ユーザが存在しない場合、異常終了
+
+        notes:
+            expense.monthly_rollups（取引の追加・削除時にトリガーで更新）を読むため、
+            コストは取引件数ではなく月数 × 分類数に比例する。
+            test_environment/make_monthly_rollup.sql の適用が必要。
+        """
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
+                        return None
+                    cur.execute("""
+                        SELECT r.month, r.purpose, p.payment_name, a.account_name, r.spent, r.received, r.count
+                        FROM expense.monthly_rollups r
+                        LEFT JOIN expense.payments p ON p.pid = r.pid
+                        LEFT JOIN expense.accounts a ON a.aid = r.aid
+                        WHERE r.uid = %s AND r.month >= %s AND r.month <= %s AND r.count <> 0
+                        ORDER BY r.month, r.purpose, r.pid, r.aid
+                    """, (uid, month_start(month_from), month_start(month_to)))
+                    return [
+                        MonthlySummary(month=row[0], purpose=row[1], pname=row[2], aname=row[3],
+                                       spent=int(row[4]), received=int(row[5]), count=row[6])
+                        for row in cur.fetchall()
+                    ]
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return None
+
+    def _export_query(self: Self, kind: str) -> str:
+        """
+        エクスポートの問い合わせ（パラメータ: uid, 開始日, 終了日）
+        """
+        if kind == "transactions":
+            return f"""
+                SELECT {_TRANSACTION_COLUMNS}
+                WHERE t.uid = %s AND t.is_deleted = FALSE
+                  AND t.transaction_date >= %s AND t.transaction_date <= %s
+                ORDER BY t.transaction_date, t.dorder
+            """
+        # balance_tree指定時は amount が追加時点の残高のため、delta の累積和で求める
+        balance = "sum(h.delta) OVER (PARTITION BY h.aid ORDER BY h.payment_date, h.dorder)" if self._tree is not None else "h.amount"
+        return f"""
+            SELECT account_name, payment_date, dorder, transaction_date, purpose, balance
+            FROM (
+                SELECT a.aid, a.account_name, h.payment_date, h.dorder, t.transaction_date, t.purpose, {balance} AS balance
+                FROM expense.account_histories h
+                JOIN expense.accounts a ON a.aid = h.aid
+                JOIN expense.transactions t ON t.tid = h.tid
+                WHERE a.uid = %s AND h.is_deleted = FALSE
+            ) x
+            WHERE payment_date >= %s AND payment_date <= %s
+            ORDER BY aid, payment_date, dorder
+        """
+
+    def export_csv(self: Self, uname: str, kind: str, date_from: date, date_to: date, out: IO[Any]) -> bool:
+        """
+        CSV エクスポート
+
+        parameters
+            uname: ユーザ名
+            kind: "transactions"（取引。支払い方法・口座名称付き）または "histories"（口座履歴と残高）
+            date_from, date_to: 取引日（histories は支払日）の範囲（両端を含む）
+            out: 書き込み先（ヘッダ行付きの CSV）
+
+        returns
+            True: 正常終了
+            False: 異常終了
+
+        notes:
+            COPY ... TO STDOUT でサーバから受け取った分を順に out に書くため、件数によらずメモリ使用量は一定
+        """
+        if kind not in _EXPORT_COLUMNS:
+            print(f"エクスポートの種類が不正です: {kind}")
+            return False
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+                    query = cur.mogrify(self._export_query(kind), (uid, date_from, date_to)).decode()
+                    cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", out)
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+    def export_parquet(self: Self, uname: str, kind: str, date_from: date, date_to: date, path: str, batch_size: int = 10000) -> bool:
+        """
+        Parquet エクスポート
+
+        parameters
+            uname: ユーザ名
+            kind, date_from, date_to: export_csv と同じ
+            path: 書き込み先のファイル
+            batch_size: 1回にサーバから受け取り、1つのレコードバッチにする件数
+
+        returns
+            True: 正常終了
+            False: 異常終了（pyarrow がインストールされていない場合を含む）
+
+        notes:
+            名前付きカーソルで batch_size 件ずつ受け取り、列形式のレコードバッチにして書き込むため、
+            件数によらずメモリ使用量は一定
+        """
+        if kind not in _EXPORT_COLUMNS:
+            print(f"エクスポートの種類が不正です: {kind}")
+            return False
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            print(f"pyarrow が必要です: {e}")
+            return False
+
+        columns = _EXPORT_COLUMNS[kind]
+        schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+        try:
+            with self._connect() as conn:
+                with conn.cursor() as cur:
+                    uid: Optional[int] = self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+                with conn.cursor(name="expense_export_parquet") as cur:
+                    cur.itersize = batch_size
+                    cur.execute(self._export_query(kind), (uid, date_from, date_to))
+                    with pq.ParquetWriter(path, schema) as writer:
+                        while True:
+                            rows = cur.fetchmany(batch_size)
+                            if not rows:
+                                break
+                            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+                            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+
+class _SessionConnection:
+    """
+    ExpenseSession の操作中に Expense のメソッドへ渡す接続
+
+    commit はセッション側で行うため何もしない。rollback はこの操作の開始時点（セーブポイント）まで戻す。
+    """
+
+    def __init__(self: Self, conn: Any) -> None:
+        self._conn = conn
+        return
+
+    def cursor(self: Self, *args: Any, **kwargs: Any) -> Any:
+        return self._conn.cursor(*args, **kwargs)
+
+    def commit(self: Self) -> None:
+        return
+
+    def rollback(self: Self) -> None:
+        with self._conn.cursor() as cur:
+            cur.execute("ROLLBACK TO SAVEPOINT expense_session")
+        return
+
+
+class ExpenseSession:
+    """
+    Expense の操作を1本の接続・1トランザクションで行うセッション（Expense.session で作る）
+
+    ユーザIDは開始時に1回だけ取得する（ユーザが存在しない場合は uid が None になり、各操作は False / None を返す）。
+    各操作はセーブポイントの中で行い、処理中に例外が発生した操作（False を返す）の変更だけを取り消す。
+    with 文を例外で抜けた場合は、commit 済みのものを除いてすべて rollback する。
+    セッション内で読み込んだ口座ID・支払い方法は、commit した時にキャッシュへ登録する（取り消した操作の分は登録しない）。
+
+    使用できる操作は Expense の同名のメソッドから、先頭の uname を除いたもの。
+    iter_transactions、export_parquet はセッションの外で使う。
+    """
+
+    # セッションで使える操作
+    OPERATIONS = (
+        "create_account", "delete_account", "create_immediate_payment", "create_deferred_payment", "delete_payment",
+        "add_transaction", "delete_transaction", "add_transactions_bulk", "delete_transactions_bulk",
+        "get_balance", "get_balances", "list_transactions", "monthly_summary", "export_csv",
+    )
+
+    def __init__(self: Self, expense: Expense, uname: str, commit_every: Optional[int] = None) -> None:
+        self._expense = expense
+        self.uname = uname
+        self.uid: Optional[int] = None
+        self._commit_every = commit_every
+        self._context: Optional[ContextManager[Any]] = None
+        self._conn: Any = None
+        self.operations = 0     # 行った操作数（例外で取り消したものを除く）
+        self.commits = 0        # commit した回数
+        # commit 時にキャッシュへ反映する値（キー → (値, 世代)。値が None のものは破棄する）
+        self._cache_pending: Dict[Hashable, Tuple[Any, Optional[int]]] = {}
+        return
+
+    def __enter__(self: Self) -> Self:
+        if getattr(self._expense._local, "session", None) is not None:
+            raise RuntimeError("セッションは入れ子にできません")
+        self._context = self._expense._connect()
+        self._conn = self._context.__enter__()
+        try:
+            with self._conn.cursor() as cur:
+                self.uid = self._expense._get_uid(cur, self.uname)
+        except BaseException:
+            self._context.__exit__(*sys.exc_info())
+            raise
+        self._expense._local.session = self
+        return self
+
+    def __exit__(self: Self, exc_type: Any, exc: Any, tb: Any) -> None:
+        self._expense._local.session = None
+        try:
+            # 接続の with 文の終了時に commit（例外時は rollback）される
+            self._context.__exit__(exc_type, exc, tb)
+            if exc_type is None:
+                self.commits += 1
+                self._flush_cache()
+        finally:
+            self._cache_pending = {}
+            if self._expense._pool is None:
+                self._conn.close()
+        return None
+
+    def __getattr__(self: Self, name: str) -> Callable[..., Any]:
+        if name not in ExpenseSession.OPERATIONS:
+            raise AttributeError(name)
+        method = getattr(self._expense, name)
+
+        def operation(*args: Any, **kwargs: Any) -> Any:
+            if getattr(self._expense._local, "session", None) is not self:
+                raise RuntimeError("セッションの with 文の外では使えません")
+            return method(self.uname, *args, **kwargs)
+        return operation
+
+    def commit(self: Self) -> None:
+        """
+        ここまでの操作を commit する
+        """
+        self._conn.commit()
+        self.commits += 1
+        self._flush_cache()
+        return
+
+    def _flush_cache(self: Self) -> None:
+        """
+        commit した操作で読み込んだ値をキャッシュへ登録する（無効化したものは破棄する）
+        """
+        pending, self._cache_pending = self._cache_pending, {}
+        cache: Optional[TTLCache] = self._expense._cache
+        if cache is None:
+            return
+        for key, (value, generation) in pending.items():
+            if value is None:
+                cache.delete(key)
+            else:
+                cache.put(key, value, generation)
+        return
+
+    @contextmanager
+    def _operation(self: Self) -> Iterator[_SessionConnection]:
+        """
+        1操作分（Expense._connect の代わり）
+        """
+        with self._conn.cursor() as cur:
+            cur.execute("SAVEPOINT expense_session")
+        pending = dict(self._cache_pending)
+        try:
+            yield _SessionConnection(self._conn)
+        except BaseException:
+            with self._conn.cursor() as cur:
+                cur.execute("ROLLBACK TO SAVEPOINT expense_session")
+            # 取り消した操作で読み込んだ値は登録しない
+            self._cache_pending = pending
+            raise
+        with self._conn.cursor() as cur:
+            cur.execute("RELEASE SAVEPOINT expense_session")
+        self.operations += 1
+        if self._commit_every is not None and self.operations % self._commit_every == 0:
+            self.commit()
+        return
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import psycopg
+from contextlib import asynccontextmanager
+from datetime import datetime as dtm
+from datetime import date
+from typing import Self
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Iterable, List, Optional
+
+from psycopg_pool import AsyncConnectionPool
+
+from balance import BalanceTree
+from cache import TTLCache
+from expense import (PaymentInfo, calc_payment_date,
+                     _ADD_TRANSACTION_FUNCTION, _BALANCE_PROBE, _DELETE_TRANSACTION, _DELETE_TRANSACTION_HISTORY,
+                     _INSERT_HISTORY, _INSERT_TRANSACTION, _SELECT_AID, _SELECT_PAYMENT, _SELECT_TRANSACTION,
+                     _SELECT_TRANSACTION_ACCOUNTS, _SELECT_TRANSACTION_HISTORY, _SELECT_TRANSACTION_PAYMENT,
+                     _SELECT_UID, _SHIFT_BALANCES_AFTER, _SHIFT_LATER_BALANCES)
+from locks import AccountLocks
+
+class AsyncExpense:
+    """
+    Expense の asyncio 版
+
+    ドライバに psycopg (v3) の AsyncConnection を使う。
+    psycopg_pool.AsyncConnectionPool を渡した場合は、プールから接続を借りる。
+    処理内容・戻り値は Expense の同名メソッドと同じで、頻繁に実行する文は expense.py の定数を共有する。
+
+    1件毎の操作のみ（一括追加・セッション・残高取得は Expense を使う）。そのため dorder_counter は不要
+    （1件毎の追加は、make_dorder_counter.sql の適用後もトリガーで採番する）。
+    prepared も指定しない（psycopg (v3) は同じ文を繰り返し実行すると自動で PREPARE する）。
+    """
+
+    _dsn: str = ""
+    _pool: Optional[AsyncConnectionPool] = None
+    _cache: Optional[TTLCache] = None
+    _tree: Optional[BalanceTree] = None
+    _locks: Optional[AccountLocks] = None
+    _server_function: bool = False
+
+    def __init__(self: Self, dbhost: str, dbport: int, dbname: str, dbuser: str, dbpass: str, pool: Optional[AsyncConnectionPool] = None,
+                 cache: Optional[TTLCache] = None, balance_tree: bool = False, locks: Optional[AccountLocks] = None,
+                 server_function: bool = False) -> None:
+        """
+        Parameters:
+            dbhost, dbport, dbname, dbuser, dbpass: DB接続情報
+            pool: コネクションプール
+            cache, balance_tree, locks, server_function: Expense の同名の引数と同じ。
+                   Expense と同じ口座に書き込む場合は、同じ namespace の AccountLocks を指定する
+        """
+        self._dsn = f"host={dbhost} port={dbport} dbname={dbname} user={dbuser} password={dbpass}"
+        self._pool = pool
+        self._cache = cache
+        self._tree = BalanceTree() if balance_tree else None
+        self._locks = locks
+        self._server_function = server_function
+        return
+
+    @asynccontextmanager
+    async def _connect(self: Self) -> AsyncIterator[Any]:
+        """
+        DB接続を取得する
+
+        ブロック終了時に commit（例外時は rollback）される。
+        """
+        if self._pool is not None:
+            async with self._pool.connection() as conn:
+                yield conn
+            return
+
+        async with await psycopg.AsyncConnection.connect(self._dsn) as conn:
+            yield conn
+
+    async def _cached(self: Self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        キャッシュから取得する。ない場合は load() の結果を登録する（None は登録しない）
+        """
+        if self._cache is None:
+            return await load()
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+        generation = self._cache.generation()
+        value = await load()
+        if value is not None:
+            self._cache.put(key, value, generation)
+        return value
+
+    def _invalidate(self: Self, key: Hashable) -> None:
+        if self._cache is not None:
+            self._cache.delete(key)
+        return
+
+    async def _lock_accounts(self: Self, cur: Any, aids: Iterable[Optional[int]]) -> None:
+        """
+        口座をロックする（locks 未指定時は何もしない）
+        """
+        if self._locks is not None:
+            await self._locks.lock_async(cur, aids)
+        return
+
+    async def _get_uid(self: Self, cur: Any, uname: str) -> Optional[int]:
+        """
+        ユーザID取得
+        """
+        async def load() -> Optional[int]:
+            await cur.execute(_SELECT_UID, (uname,))
+            row = await cur.fetchone()
+            return row[0] if row is not None else None
+        return await self._cached(("uid", uname), load)
+
+    async def _get_aid(self: Self, cur: Any, uid: int, aname: str) -> Optional[int]:
+        """
+        口座ID取得（削除済みを除く）
+        """
+        async def load() -> Optional[int]:
+            await cur.execute(_SELECT_AID, (uid, aname))
+            row = await cur.fetchone()
+            return row[0] if row is not None else None
+        return await self._cached(("aid", uid, aname), load)
+
+    async def _get_payment(self: Self, cur: Any, uid: int, pname: str) -> Optional[PaymentInfo]:
+        """
+        支払い方法取得（削除済みを除く）
+        """
+        async def load() -> Optional[PaymentInfo]:
+            await cur.execute(_SELECT_PAYMENT, (uid, pname))
+            row = await cur.fetchone()
+            if row is None:
+                return None
+            return PaymentInfo(pid=row[0], aid=row[1], closing_day=row[2], payment_offset_month=row[3], payment_day=row[4])
+        return await self._cached(("payment", uid, pname), load)
+
+    async def create_account(self: Self, uname: str, aname: str) -> bool:
+        """
+        口座作成処理（Expense.create_account の非同期版）
+        """
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    uid: Optional[int] = await self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+
+                    # 口座を追加
+                    await cur.execute("""
+                        INSERT INTO expense.accounts (uid, account_name, is_deleted)
+                        VALUES (%s, %s, FALSE)
+                    """, (uid, aname))
+                    self._invalidate(("aid", uid, aname))
+
+                    await conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+    async def delete_account(self: Self, uname: str, aname: str) -> bool:
+        """
+        口座削除処理（Expense.delete_account の非同期版）
+        """
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    uid: Optional[int] = await self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+
+                    # 口座IDを取得
+                    aid: Optional[int] = await self._get_aid(cur, uid, aname)
+                    if aid is None:
+                        return False
+
+                    # 削除済みマークを付ける（同名が存在する場合は連番を付ける）
+                    new_name: str = f"{aname}(削除済み)"
+                    counter: int = 1
+                    while True:
+                        await cur.execute("""
+                            SELECT COUNT(*) FROM expense.accounts
+                            WHERE uid = %s AND account_name = %s
+                        """, (uid, new_name))
+                        if (await cur.fetchone())[0] == 0:
+                            break
+                        new_name = f"{aname}(削除済み{counter})"
+                        counter += 1
+
+                    # 口座を更新
+                    await cur.execute("""
+                        UPDATE expense.accounts
+                        SET account_name = %s, is_deleted = TRUE
+                        WHERE aid = %s
+                    """, (new_name, aid))
+                    self._invalidate(("aid", uid, aname))
+
+                    await conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+    async def create_immediate_payment(self: Self, uname: str, pname: str, aname: str) -> bool:
+        """
+        支払い方法作成（当日払い）（Expense.create_immediate_payment の非同期版）
+        """
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    uid: Optional[int] = await self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+
+                    # 口座IDを取得
+                    aid: Optional[int] = await self._get_aid(cur, uid, aname)
+                    if aid is None:
+                        return False
+
+                    # 支払い方法を追加
+                    await cur.execute("""
+                        INSERT INTO expense.payments (uid, payment_name, closing_day, payment_offset_month, payment_day, aid, deleted_at)
+                        VALUES (%s, %s, 0, 0, 0, %s, NULL)
+                    """, (uid, pname, aid))
+                    self._invalidate(("payment", uid, pname))
+
+                    await conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+    async def create_deferred_payment(self: Self, uname: str, pname: str, aname: str, close_day: int, payment_offset_month: int, payment_day: int) -> bool:
+        """
+        支払い方法作成（後日払い）（Expense.create_deferred_payment の非同期版）
+        """
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    uid: Optional[int] = await self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+
+                    # 口座IDを取得
+                    aid: Optional[int] = await self._get_aid(cur, uid, aname)
+                    if aid is None:
+                        return False
+
+                    # 支払い方法を追加
+                    await cur.execute("""
+                        INSERT INTO expense.payments (uid, payment_name, closing_day, payment_offset_month, payment_day, aid, deleted_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, NULL)
+                    """, (uid, pname, close_day, payment_offset_month, payment_day, aid))
+                    self._invalidate(("payment", uid, pname))
+
+                    await conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+    async def delete_payment(self: Self, uname: str, pname: str) -> bool:
+        """
+        支払い方法削除（Expense.delete_payment の非同期版）
+        """
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    uid: Optional[int] = await self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+
+                    # 支払い方法IDを取得
+                    payment: Optional[PaymentInfo] = await self._get_payment(cur, uid, pname)
+                    if payment is None:
+                        return False
+                    pid: int = payment["pid"]
+
+                    # 削除済みマークを付ける（同名が存在する場合は連番を付ける）
+                    new_name: str = f"{pname}(削除済み)"
+                    counter: int = 1
+                    while True:
+                        await cur.execute("""
+                            SELECT COUNT(*) FROM expense.payments
+                            WHERE uid = %s AND payment_name = %s
+                        """, (uid, new_name))
+                        if (await cur.fetchone())[0] == 0:
+                            break
+                        new_name = f"{pname}(削除済み{counter})"
+                        counter += 1
+
+                    # 支払い方法を更新
+                    await cur.execute("""
+                        UPDATE expense.payments
+                        SET payment_name = %s, deleted_at = CURRENT_DATE
+                        WHERE pid = %s
+                    """, (new_name, pid))
+                    self._invalidate(("payment", uid, pname))
+
+                    await conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+
+    async def add_transaction(self: Self, uname: str, tdate: dtm, purpose: str, memo: Optional[str], pname: Optional[str], amount_spent: int, aname: Optional[str], amount_received: int) -> bool:
+        """
+        取引追加（Expense.add_transaction の非同期版）
+        """
+        if self._server_function and self._tree is None:
+            return await self._add_transaction_server(uname, tdate, purpose, memo, pname, amount_spent, aname, amount_received)
+
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    uid: Optional[int] = await self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+
+                    # 支出pidを取得
+                    payment: Optional[PaymentInfo] = None
+                    expense_pid: Optional[int] = None
+                    if pname is not None:
+                        payment = await self._get_payment(cur, uid, pname)
+                        if payment is not None:
+                            expense_pid = payment["pid"]
+
+                    # 収入aidを取得
+                    income_aid: Optional[int] = None
+                    if aname is not None:
+                        income_aid = await self._get_aid(cur, uid, aname)
+
+                    # 口座をロック
+                    await self._lock_accounts(cur, [payment["aid"] if payment is not None else None, income_aid])
+
+                    # 取引日をdate型に変換
+                    transaction_date: date = tdate.date()
+
+                    # 取引を追加
+                    await cur.execute(_INSERT_TRANSACTION, (uid, transaction_date, purpose, memo, expense_pid, amount_spent, income_aid, amount_received))
+                    row = await cur.fetchone()
+                    if row is None:
+                        return False
+                    tid: int = row[0]
+
+                    # 支出の処理
+                    if payment is not None:
+                        expense_aid: int = payment["aid"]
+
+                        # 支出日を決定
+                        payment_date: date = calc_payment_date(transaction_date, payment["closing_day"], payment["payment_offset_month"], payment["payment_day"])
+
+                        if self._tree is not None:
+                            # 口座履歴を追加（以降の残高は更新しない）
+                            await self._tree.append_async(cur, expense_aid, payment_date, tid, -amount_spent)
+                        else:
+                            # 支出残額を取得
+                            await cur.execute(_BALANCE_PROBE, (expense_aid, payment_date))
+                            row = await cur.fetchone()
+                            expense_balance: int = row[0] if row is not None else 0
+
+                            # 口座履歴を追加
+                            await cur.execute(_INSERT_HISTORY, (expense_aid, payment_date, tid, expense_balance - amount_spent))
+
+                            # 以降の残高を更新
+                            await cur.execute(_SHIFT_LATER_BALANCES, (-amount_spent, expense_aid, payment_date))
+
+                    # 収入の処理
+                    if income_aid is not None:
+                        income_date: date = transaction_date
+
+                        if self._tree is not None:
+                            # 口座履歴を追加（以降の残高は更新しない）
+                            await self._tree.append_async(cur, income_aid, income_date, tid, amount_received)
+                        else:
+                            # 収入残額を取得
+                            await cur.execute(_BALANCE_PROBE, (income_aid, income_date))
+                            row = await cur.fetchone()
+                            income_balance: int = row[0] if row is not None else 0
+
+                            # 口座履歴を追加
+                            await cur.execute(_INSERT_HISTORY, (income_aid, income_date, tid, income_balance + amount_received))
+
+                            # 以降の残高を更新
+                            await cur.execute(_SHIFT_LATER_BALANCES, (amount_received, income_aid, income_date))
+
+                    await conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+    async def _add_transaction_server(self: Self, uname: str, tdate: dtm, purpose: str, memo: Optional[str], pname: Optional[str], amount_spent: int, aname: Optional[str], amount_received: int) -> bool:
+        """
+        取引追加（Expense._add_transaction_server の非同期版）
+        """
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(_ADD_TRANSACTION_FUNCTION, (uname, tdate.date(), purpose, memo, pname, amount_spent, aname, amount_received,
+                                                                  self._locks.namespace if self._locks is not None else None))
+                    row = await cur.fetchone()
+                    if row is None or row[0] is None:
+                        return False
+
+                    await conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
+
+    async def delete_transaction(self: Self, uname: str, tdate: dtm, dorder: int) -> bool:
+        """
+        取引削除（Expense.delete_transaction の非同期版）
+        """
+        try:
+            async with self._connect() as conn:
+                async with conn.cursor() as cur:
+                    # ユーザIDを取得
+                    uid: Optional[int] = await self._get_uid(cur, uname)
+                    if uid is None:
+                        return False
+
+                    # 取引日をdate型に変換
+                    transaction_date: date = tdate.date()
+
+                    # 取引情報を取得
+                    await cur.execute(_SELECT_TRANSACTION, (uid, transaction_date, dorder))
+                    row = await cur.fetchone()
+                    if row is None:
+                        return False
+                    tid: int = row[0]
+                    expense_pid: Optional[int] = row[1]
+                    income_aid: Optional[int] = row[2]
+                    amount_spent: int = row[3]
+                    amount_received: int = row[4]
+
+                    # 支払い方法から口座IDを取得し、支出日を決定（削除済みの支払い方法も含む）
+                    expense_aid: Optional[int] = None
+                    payment_date: Optional[date] = None
+                    if expense_pid is not None:
+                        await cur.execute(_SELECT_TRANSACTION_PAYMENT, (uid, expense_pid))
+                        row = await cur.fetchone()
+                        if row is not None:
+                            expense_aid = row[0]
+                            payment_date = calc_payment_date(transaction_date, row[1], row[2], row[3])
+
+                    # 口座履歴の支払日（パーティションの絞り込み用）
+                    payment_dates: List[date] = [transaction_date] if payment_date in (None, transaction_date) else [transaction_date, payment_date]
+
+                    # 口座履歴の口座をロック
+                    if self._locks is not None:
+                        await cur.execute(_SELECT_TRANSACTION_ACCOUNTS, ([tid], min(payment_dates), max(payment_dates), payment_dates))
+                        await self._locks.lock_async(cur, [row[0] for row in await cur.fetchall()])
+
+                    # 取引を削除マーク
+                    await cur.execute(_DELETE_TRANSACTION, (tid, transaction_date))
+
+                    if self._tree is not None:
+                        # 口座履歴を削除マーク（以降の残高は更新しない）
+                        await self._tree.remove_async(cur, tid, payment_dates)
+                    else:
+                        # 支出取り消し処理
+                        if expense_aid is not None and payment_date is not None:
+                            # 口座履歴からpayment_dateとdorderを取得
+                            await cur.execute(_SELECT_TRANSACTION_HISTORY, (expense_aid, tid, payment_date))
+                            row = await cur.fetchone()
+                            if row is not None:
+                                expense_payment_date: date = row[0]
+                                expense_dorder: int = row[1]
+
+                                # 口座履歴を削除マーク
+                                await cur.execute(_DELETE_TRANSACTION_HISTORY, (expense_aid, tid, expense_payment_date))
+
+                                # 以降の残高を更新（支出を取り消すので加算）
+                                await cur.execute(_SHIFT_BALANCES_AFTER, (amount_spent, expense_aid, expense_payment_date, expense_payment_date, expense_dorder))
+
+                        # 収入取り消し処理
+                        if income_aid is not None:
+                            # 口座履歴からpayment_dateとdorderを取得
+                            await cur.execute(_SELECT_TRANSACTION_HISTORY, (income_aid, tid, transaction_date))
+                            row = await cur.fetchone()
+                            if row is not None:
+                                income_payment_date: date = row[0]
+                                income_dorder: int = row[1]
+
+                                # 口座履歴を削除マーク
+                                await cur.execute(_DELETE_TRANSACTION_HISTORY, (income_aid, tid, income_payment_date))
+
+                                # 以降の残高を更新（収入を取り消すので減算）
+                                await cur.execute(_SHIFT_BALANCES_AFTER, (-amount_received, income_aid, income_payment_date, income_payment_date, income_dorder))
+
+                    await conn.commit()
+                    return True
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return False
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import threading
+from collections import OrderedDict
+
+from typing import Self
+from typing import Optional, Tuple
+
+
+class IconCache:
+    """
+    アイコン画像のLRUキャッシュ
+
+    内容のハッシュ値（auth.features.icon_hash）をキーにする。同じ内容なら同じキーになるため、
+    アイコンの更新で古いエントリが誤って返ることはない。
+
+    Parameters:
+        max_entries: 保持するアイコン数の上限
+        max_bytes: 保持するバイト数の上限
+    """
+
+    def __init__(self: Self, max_entries: int = 256, max_bytes: int = 16 * 1024 * 1024) -> None:
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[bytes, Optional[str]]]" = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def get(self: Self, icon_hash: str) -> Optional[Tuple[memoryview, Optional[str]]]:
+        """
+        アイコンを取得する
+
+        Returns:
+            (画像データ, MIMEタイプ)。画像データはキャッシュ内のバイト列を参照する読み取り専用の memoryview
+            None: キャッシュにない
+        """
+        with self._lock:
+            entry = self._entries.get(icon_hash)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(icon_hash)
+            self.hits += 1
+        return memoryview(entry[0]), entry[1]
+
+    def put(self: Self, icon_hash: str, data: bytes, mime_type: Optional[str]) -> memoryview:
+        """
+        アイコンを登録する
+
+        Returns:
+            登録したバイト列を参照する memoryview
+        """
+        data = bytes(data)
+        with self._lock:
+            old = self._entries.pop(icon_hash, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            # 上限より大きいものは保持しない
+            if len(data) <= self._max_bytes:
+                self._entries[icon_hash] = (data, mime_type)
+                self._bytes += len(data)
+                while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                    _, (evicted, _) = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+        return memoryview(data)
+
+    def clear(self: Self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        return
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import threading
+import time
+
+from typing import Self
+from typing import Any, Dict, Iterable, Optional, TypedDict
+
+# 口座ロックの advisory lock の第1キー（他の用途の advisory lock と重ならないようにする）
+ACCOUNT_LOCK_NAMESPACE: int = 0x45585041    # "EXPA"
+
+
+class LockStats(TypedDict):
+    acquired: int            # 取得したロック数
+    contended: int           # 他のトランザクションが保持していて待った回数
+    wait_time_total: float   # 待ち時間の合計（秒）
+    wait_time_max: float     # 待ち時間の最大（秒）
+    by_account: Dict[int, int]  # 口座ID → 待った回数（待ちが発生した口座のみ）
+
+
+class AccountLocks:
+    """
+    口座単位の排他
+
+    PostgreSQL のトランザクション単位の advisory lock（pg_advisory_xact_lock）を口座IDをキーに取得する。
+    同じ口座への書き込みはトランザクションの終了（commit / rollback）まで待ち、
+    異なる口座への書き込みは並行して進む。
+    複数の口座をロックする場合は口座IDの昇順に取得するため、デッドロックしない。
+
+    Parameters:
+        namespace: advisory lock の第1キー
+    """
+
+    def __init__(self: Self, namespace: int = ACCOUNT_LOCK_NAMESPACE) -> None:
+        self._namespace = namespace
+        self._lock = threading.Lock()
+        self._acquired = 0
+        self._contended = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._by_account: Dict[int, int] = {}
+        return
+
+    @property
+    def namespace(self: Self) -> int:
+        return self._namespace
+
+    def lock(self: Self, cur: Any, aids: Iterable[Optional[int]]) -> None:
+        """
+        口座をロックする（None は無視する）
+
+        まず待たずに取得を試み、取得できなかった場合のみ待つ（待ち時間を計測する）。
+        """
+        for aid in sorted({aid for aid in aids if aid is not None}):
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", (self._namespace, aid))
+            if cur.fetchone()[0]:
+                self._record(aid, None)
+                continue
+
+            start = time.monotonic()
+            cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (self._namespace, aid))
+            self._record(aid, time.monotonic() - start)
+        return
+
+    async def lock_async(self: Self, cur: Any, aids: Iterable[Optional[int]]) -> None:
+        """
+        lock の非同期版（psycopg の AsyncCursor。AsyncExpense で使う）
+        """
+        for aid in sorted({aid for aid in aids if aid is not None}):
+            await cur.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", (self._namespace, aid))
+            if (await cur.fetchone())[0]:
+                self._record(aid, None)
+                continue
+
+            start = time.monotonic()
+            await cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (self._namespace, aid))
+            self._record(aid, time.monotonic() - start)
+        return
+
+    def _record(self: Self, aid: int, waited: Optional[float]) -> None:
+        with self._lock:
+            self._acquired += 1
+            if waited is not None:
+                self._contended += 1
+                self._wait_time_total += waited
+                self._wait_time_max = max(self._wait_time_max, waited)
+                self._by_account[aid] = self._by_account.get(aid, 0) + 1
+        return
+
+    def stats(self: Self) -> LockStats:
+        """
+        ロック待ちの状況を取得する
+        """
+        with self._lock:
+            return LockStats(
+                acquired=self._acquired,
+                contended=self._contended,
+                wait_time_total=self._wait_time_total,
+                wait_time_max=self._wait_time_max,
+                by_account=dict(self._by_account),
+            )
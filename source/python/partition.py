@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import argparse
+import psycopg2
+import re
+from typing import Any, Dict, List, Optional, TypedDict
+
+# パーティション分割した表 → パーティションキー（test_environment/make_partition.sql）
+TABLES: Dict[str, str] = {
+    "transactions": "transaction_date",
+    "account_histories": "payment_date",
+}
+
+# 退避先のスキーマ
+ARCHIVE_SCHEMA: str = "expense_archive"
+
+_BOUND = re.compile(r"FROM \('(\d{4})-01-01'\) TO \('(\d{4})-01-01'\)")
+
+
+class PartitionInfo(TypedDict):
+    table: str              # 表（TABLES のキー）
+    name: str               # パーティション（スキーマ付き）
+    year: Optional[int]     # 年。既定のパーティションは None
+
+
+def list_partitions(cur: Any, schema: str = "expense") -> List[PartitionInfo]:
+    """
+    パーティションの一覧（表、年の順）
+
+    Parameters:
+        schema: "expense"（運用中）または ARCHIVE_SCHEMA（退避済み）
+    """
+    cur.execute("""
+        SELECT p.relname, c.oid::regclass::text, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class p ON p.oid = i.inhparent
+        JOIN pg_namespace n ON n.oid = p.relnamespace
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE n.nspname = %s AND p.relname = ANY(%s)
+    """, (schema, list(TABLES)))
+    result: List[PartitionInfo] = []
+    for table, name, bound in cur.fetchall():
+        match = _BOUND.search(bound)
+        result.append(PartitionInfo(table=table, name=name, year=int(match.group(1)) if match else None))
+    return sorted(result, key=lambda p: (p["table"], p["year"] if p["year"] is not None else 10000))
+
+
+def create_partitions(cur: Any, until_year: int, from_year: Optional[int] = None) -> List[str]:
+    """
+    年のパーティションを作る（既にある年は作らない）
+
+    既定のパーティションに入っているその年の行は、新しいパーティションへ移す。
+
+    Parameters:
+        until_year: この年まで作る
+        from_year: この年から作る。省略時は既にある最後の年の翌年から
+
+    Returns:
+        作成したパーティション
+    """
+    partitions = list_partitions(cur)
+    created: List[str] = []
+    for table, key in TABLES.items():
+        years = {p["year"] for p in partitions if p["table"] == table and p["year"] is not None}
+        if not years:
+            raise ValueError(f"パーティション分割されていません: expense.{table}")
+        archived = {p["year"] for p in list_partitions(cur, ARCHIVE_SCHEMA) if p["table"] == table}
+        for year in range(from_year if from_year is not None else max(years) + 1, until_year + 1):
+            if year in years or year in archived:
+                continue
+            name = f"expense.{table}_{year}"
+            cur.execute(f"CREATE TABLE {name} (LIKE expense.{table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+            cur.execute(f"""
+                WITH moved AS (
+                    DELETE FROM expense.{table}_default
+                    WHERE {key} >= %s AND {key} < %s
+                    RETURNING *
+                )
+                INSERT INTO {name} SELECT * FROM moved
+            """, (f"{year}-01-01", f"{year + 1}-01-01"))
+            cur.execute(f"ALTER TABLE expense.{table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+                        (f"{year}-01-01", f"{year + 1}-01-01"))
+            created.append(name)
+    return created
+
+
+def _move_to_archive(cur: Any, partition: PartitionInfo) -> None:
+    """
+    パーティションを切り離し、退避先の表のパーティションとして付け替える
+    """
+    table, year = partition["table"], partition["year"]
+    cur.execute(f"ALTER TABLE expense.{table} DETACH PARTITION {partition['name']}")
+    cur.execute(f"ALTER TABLE {partition['name']} SET SCHEMA {ARCHIVE_SCHEMA}")
+    cur.execute(f"ALTER TABLE {ARCHIVE_SCHEMA}.{table} ATTACH PARTITION {ARCHIVE_SCHEMA}.{table}_{year} FOR VALUES FROM (%s) TO (%s)",
+                (f"{year}-01-01", f"{year + 1}-01-01"))
+    return
+
+
+def archive_partitions(cur: Any, before_year: int) -> List[str]:
+    """
+    古い年のパーティションを退避する（expense_archive へ付け替える）
+
+    口座履歴は before_year より前の年、取引はさらに1年前までを退避する
+    （翌年の支払いの口座履歴が前年の取引を参照するため）。
+    退避した行は expense_archive.transactions / account_histories から参照できる。
+
+    口座履歴の残高は各行が累積値を持つため、退避後も以降の行で残高が求まる。
+    退避する年より後に口座履歴のない口座は、最後の行を既定のパーティションに残す（残高取得のため）。
+
+    notes:
+        退避した年の日付の取引は追加・削除しない。
+        運用中に残した口座履歴の取引は、退避した年のものでも既定のパーティションに残す
+        （make_partition.sql の制約トリガーが、削除されていない口座履歴の取引を運用中の表に求めるため）。
+        balance_tree で運用している場合は使わない（エクスポートの残高を退避していない行の増減から求めるため）。
+        make_bulk_dorder.sql（または make_dorder_counter.sql）の適用が必要（残す行の dorder を保つため）。
+
+    Returns:
+        退避したパーティション
+    """
+    archived: List[str] = []
+    for partition in list_partitions(cur):
+        year = partition["year"]
+        if partition["table"] != "account_histories" or year is None or year >= before_year:
+            continue
+        _move_to_archive(cur, partition)
+
+        # 以降に口座履歴のない口座の最後の行を、既定のパーティションへ戻す
+        # （以前の退避で残した行は、この年に口座履歴のある口座の分を退避先へ戻す）
+        cur.execute(f"""
+            WITH kept AS (
+                DELETE FROM {ARCHIVE_SCHEMA}.account_histories_{year} a
+                WHERE a.hid IN (
+                    SELECT DISTINCT ON (aid) hid
+                    FROM {ARCHIVE_SCHEMA}.account_histories_{year}
+                    WHERE is_deleted = FALSE
+                    ORDER BY aid, payment_date DESC, dorder DESC
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM expense.account_histories h
+                    WHERE h.aid = a.aid AND h.is_deleted = FALSE AND h.payment_date >= %s
+                )
+                RETURNING *
+            ), superseded AS (
+                DELETE FROM expense.account_histories_default d
+                WHERE d.payment_date < %s AND EXISTS (
+                    SELECT 1 FROM {ARCHIVE_SCHEMA}.account_histories_{year} a
+                    WHERE a.aid = d.aid AND a.is_deleted = FALSE
+                )
+                RETURNING d.*
+            ), restored AS (
+                INSERT INTO {ARCHIVE_SCHEMA}.account_histories SELECT * FROM superseded
+            )
+            INSERT INTO expense.account_histories SELECT * FROM kept
+        """, (f"{year + 1}-01-01", f"{year}-01-01"))
+        archived.append(partition["name"])
+
+    for partition in list_partitions(cur):
+        year = partition["year"]
+        if partition["table"] != "transactions" or year is None or year >= before_year - 1:
+            continue
+        _move_to_archive(cur, partition)
+        archived.append(partition["name"])
+
+    # 取引は、支払い側・収入側の口座履歴がともに退避された時だけ退避する
+    # （運用中に残した口座履歴から参照されている取引は既定のパーティションへ戻し、
+    #   以前に戻した取引は、口座履歴がすべて退避されたものを退避先へ戻す。
+    #   月別集計のトリガーで二重に加算しないよう、既定のパーティションへ直接戻す）
+    years = [p["year"] for p in list_partitions(cur, ARCHIVE_SCHEMA) if p["table"] == "transactions"]
+    if years:
+        cur.execute(f"""
+            WITH kept AS (
+                DELETE FROM {ARCHIVE_SCHEMA}.transactions a
+                WHERE a.tid IN (
+                    SELECT tid FROM expense.account_histories
+                    WHERE is_deleted = FALSE
+                )
+                RETURNING *
+            ), superseded AS (
+                DELETE FROM expense.transactions_default d
+                WHERE extract(year FROM d.transaction_date)::int = ANY(%s) AND NOT EXISTS (
+                    SELECT 1 FROM expense.account_histories h
+                    WHERE h.tid = d.tid AND h.is_deleted = FALSE
+                )
+                RETURNING d.*
+            ), restored AS (
+                INSERT INTO {ARCHIVE_SCHEMA}.transactions SELECT * FROM superseded
+            )
+            INSERT INTO expense.transactions_default SELECT * FROM kept
+        """, (years,))
+    return archived
+
+
+def compact(cur: Any, table: str, partition: str) -> int:
+    """
+    削除済みの行を運用中のパーティションから expense_archive.deleted_* へ移す（1パーティション分）
+
+    取引は、削除されていない口座履歴から参照されていないものだけを移す。
+
+    notes:
+        make_dorder_counter.sql の適用が必要（移した行の dorder を再び払い出さないため）。
+        一括追加は Expense(dorder_counter=True) で行う（max(dorder)+1 で採番すると、移した行の dorder を再び使う）。
+
+    Parameters:
+        table: 表（TABLES のキー）
+        partition: パーティション（スキーマ付き）
+
+    Returns:
+        移した行数
+    """
+    cur.execute("SELECT to_regclass('expense.transaction_dorders'), to_regclass('expense.account_history_dorders')")
+    if None in cur.fetchone():
+        raise ValueError("dorder の採番テーブルがありません（make_dorder_counter.sql の適用が必要）")
+
+    if table == "transactions":
+        condition = """
+            is_deleted = TRUE AND NOT EXISTS (
+                SELECT 1 FROM expense.account_histories h
+                WHERE h.tid = p.tid AND h.is_deleted = FALSE
+            )
+        """
+    else:
+        condition = "is_deleted = TRUE"
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {partition} p
+            WHERE {condition}
+            RETURNING p.*
+        )
+        INSERT INTO {ARCHIVE_SCHEMA}.deleted_{table} SELECT * FROM moved
+    """)
+    return cur.rowcount
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="取引・口座履歴のパーティション管理")
+    parser.add_argument("--dsn", required=True, help="接続文字列")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="年のパーティションを作る")
+    create.add_argument("--until-year", type=int, required=True)
+    create.add_argument("--from-year", type=int, help="省略時は既にある最後の年の翌年から")
+    archive = commands.add_parser("archive", help="古い年のパーティションを退避する")
+    archive.add_argument("--before-year", type=int, required=True)
+    commands.add_parser("compact", help="削除済みの行を移す（パーティション毎に commit）")
+    commands.add_parser("list", help="パーティションの一覧")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        with conn.cursor() as cur:
+            if args.command == "create":
+                names = create_partitions(cur, args.until_year, args.from_year)
+                conn.commit()
+                print(f"作成: {', '.join(names) if names else 'なし'}")
+            elif args.command == "archive":
+                names = archive_partitions(cur, args.before_year)
+                conn.commit()
+                print(f"退避: {', '.join(names) if names else 'なし'}")
+            elif args.command == "compact":
+                # 口座履歴を先に移す（取引は削除されていない口座履歴がないものだけ移るため）
+                for table in ("account_histories", "transactions"):
+                    for partition in [p for p in list_partitions(cur) if p["table"] == table]:
+                        moved = compact(cur, table, partition["name"])
+                        conn.commit()
+                        print(f"{partition['name']}: {moved}")
+            else:
+                for schema in ("expense", ARCHIVE_SCHEMA):
+                    for partition in list_partitions(cur, schema):
+                        print(partition["name"])
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import numpy as np
+from datetime import date
+from typing import Any, List
+
+# 暦テーブルの範囲（月単位、終わりは含まない）
+CALENDAR_START: np.datetime64 = np.datetime64("1900-01", "M")
+CALENDAR_END: np.datetime64 = np.datetime64("2400-01", "M")
+
+# 暦テーブル: CALENDAR_START からの月数 → その月の日数
+_months = np.arange(CALENDAR_START, CALENDAR_END + 1, dtype="datetime64[M]")
+MONTH_DAYS: np.ndarray = np.diff(_months.astype("datetime64[D]")).astype(np.int64)
+del _months
+
+
+def payment_dates(transaction_dates: Any, closing_day: Any, payment_offset_month: Any, payment_day: Any) -> np.ndarray:
+    """
+    支出日計算（配列版）
+
+    expense.calc_payment_date を配列にまとめて適用する。結果は calc_payment_date と一致する。
+
+    parameters
+        transaction_dates: 取引日の配列（date、datetime64 など）
+        closing_day: 締め日（0の場合は当日払い）
+        payment_offset_month: 支払い月ズレ
+        payment_day: 支払い日
+        （closing_day 以降は、スカラーまたは transaction_dates と同じ長さの配列。支払い方法が行毎に異なってもよい）
+
+    returns
+        支出日の配列（datetime64[D]）
+
+    notes:
+        月の末日は暦テーブル（MONTH_DAYS）から引く。支払い月が暦テーブルの範囲外の場合は ValueError
+    """
+    days = np.asarray(transaction_dates, dtype="datetime64[D]")
+    closing = np.broadcast_to(np.asarray(closing_day, dtype=np.int64), days.shape)
+    offset = np.broadcast_to(np.asarray(payment_offset_month, dtype=np.int64), days.shape)
+    pay_day = np.broadcast_to(np.asarray(payment_day, dtype=np.int64), days.shape)
+
+    deferred = closing != 0
+    if not deferred.any():
+        return days.copy()
+    if (pay_day[deferred] < 1).any():
+        raise ValueError("支払い日が不正です")
+
+    # 支払い月（暦テーブルの添字）
+    index = (days.astype("datetime64[M]") - CALENDAR_START).astype(np.int64) + offset
+    if (index[deferred] < 0).any() or (index[deferred] >= len(MONTH_DAYS)).any():
+        raise ValueError("暦テーブルで扱えない支払い月です")
+    index = np.where(deferred, index, 0)
+
+    # 支払い日がその月の末日を超える場合は末日
+    day = np.minimum(pay_day, MONTH_DAYS[index])
+    deferred_dates = (CALENDAR_START + index).astype("datetime64[D]") + (day - 1)
+    return np.where(deferred, deferred_dates, days)
+
+
+def to_dates(values: np.ndarray) -> List[date]:
+    """
+    datetime64 の配列を date のリストにする
+    """
+    return np.asarray(values, dtype="datetime64[D]").tolist()
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import psycopg2
+import psycopg2.extensions
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from typing import Self
+from typing import Any, Callable, Deque, Iterator, Optional, TypedDict
+
+
+class PoolTimeout(Exception):
+    """
+    接続取得待ちのタイムアウト
+    """
+    pass
+
+
+class PoolStats(TypedDict):
+    size: int                # 保持している接続数（使用中＋待機中）
+    in_use: int              # 貸し出し中の接続数
+    idle: int                # 待機中の接続数
+    max_size: int            # 最大接続数
+    utilisation: float       # in_use / max_size
+    requests: int            # 接続取得要求の回数
+    waits: int               # 空き待ちが発生した回数
+    wait_time_total: float   # 空き待ち時間の合計（秒）
+    wait_time_max: float     # 空き待ち時間の最大（秒）
+    timeouts: int            # タイムアウトした回数
+    created: int             # 新規接続した回数
+    discarded: int           # 破棄した接続数（ヘルスチェック不合格、寿命切れ等）
+
+
+class _Entry:
+
+    __slots__ = ("conn", "created_at", "released_at")
+
+    def __init__(self: Self, conn: Any, created_at: float) -> None:
+        self.conn = conn
+        self.created_at = created_at
+        self.released_at = created_at
+        return
+
+
+class ConnectionPool:
+    """
+    スレッドセーフなコネクションプール
+
+    Authorize / Expense のコンストラクタに渡すことで、同じプールを共有できる。
+
+    Parameters:
+        dsn: 接続文字列
+        min_size: 常に保持しておく接続数
+        max_size: 最大接続数
+        timeout: 接続取得待ちの上限（秒）
+        max_idle: 待機中の接続を破棄するまでの時間（秒）。0以下の場合は破棄しない
+        max_lifetime: 接続の寿命（秒）。0以下の場合は無制限
+        check: 貸し出し時に SELECT 1 で死活確認するか
+        check_idle: 死活確認する待機時間の下限（秒）。これより短い待機で返却された接続は確認しない
+        connect: 接続を生成する関数。省略時は psycopg2.connect(dsn)
+    """
+
+    def __init__(self: Self, dsn: str, min_size: int = 1, max_size: int = 10, timeout: float = 30.0,
+                 max_idle: float = 600.0, max_lifetime: float = 3600.0, check: bool = True,
+                 check_idle: float = 30.0, connect: Optional[Callable[[], Any]] = None) -> None:
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"プールサイズが不正です: min_size={min_size}, max_size={max_size}")
+
+        self._dsn = dsn
+        self._min_size = min_size
+        self._max_size = max_size
+        self._timeout = timeout
+        self._max_idle = max_idle
+        self._max_lifetime = max_lifetime
+        self._check = check
+        self._check_idle = check_idle
+        self._connect = connect if connect is not None else (lambda: psycopg2.connect(self._dsn))
+
+        self._cond = threading.Condition()
+        self._idle: Deque[_Entry] = deque()
+        self._used: dict[int, _Entry] = {}
+        self._size = 0
+        self._closed = False
+
+        self._requests = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+
+        for _ in range(min_size):
+            with self._cond:
+                self._size += 1
+            self._idle.append(self._new_entry())
+        return
+
+    @classmethod
+    def from_params(cls, dbhost: str, dbport: int, dbname: str, dbuser: str, dbpass: str, **kwargs: Any) -> "ConnectionPool":
+        """
+        Authorize / Expense と同じ引数からプールを作成する
+        """
+        return cls(f"host={dbhost} port={dbport} dbname={dbname} user={dbuser} password={dbpass}", **kwargs)
+
+    @contextmanager
+    def connection(self: Self) -> Iterator[Any]:
+        """
+        接続を借りるコンテキストマネージャ
+
+        psycopg2 の `with connection` と同様に、正常終了時は commit、例外時は rollback して
+        接続をプールへ返却する（途中で抜けた場合も必ず返却する）。
+        """
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            # GeneratorExit（ジェネレータの途中終了）、KeyboardInterrupt 等も rollback する
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def getconn(self: Self) -> Any:
+        """
+        接続を取得する。空きがなければ timeout 秒まで待つ
+
+        Raises:
+            PoolTimeout: 待ち時間が timeout を超えた
+        """
+        started = time.monotonic()
+        deadline = started + self._timeout
+        waited = False
+
+        with self._cond:
+            self._requests += 1
+
+        while True:
+            entry: Optional[_Entry] = None
+            create = False
+            evicted: list[_Entry] = []
+
+            try:
+                with self._cond:
+                    while True:
+                        if self._closed:
+                            raise PoolTimeout("プールはクローズされています")
+
+                        evicted.extend(self._evict_locked(time.monotonic()))
+
+                        if self._idle:
+                            entry = self._idle.pop()
+                            break
+                        if self._size < self._max_size:
+                            self._size += 1
+                            create = True
+                            break
+
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._timeouts += 1
+                            raise PoolTimeout(f"接続の取得が {self._timeout} 秒以内に完了しませんでした")
+                        waited = True
+                        self._cond.wait(remaining)
+            finally:
+                # 接続のクローズはネットワーク待ちになりうるため、ロックを解放してから行う
+                for dead in evicted:
+                    self._close_quietly(dead.conn)
+
+            if create:
+                try:
+                    entry = self._new_entry()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(entry):
+                self._drop(entry)
+                continue
+
+            with self._cond:
+                self._used[id(entry.conn)] = entry
+                if waited:
+                    elapsed = time.monotonic() - started
+                    self._waits += 1
+                    self._wait_time_total += elapsed
+                    self._wait_time_max = max(self._wait_time_max, elapsed)
+            return entry.conn
+
+    def putconn(self: Self, conn: Any, discard: bool = False) -> None:
+        """
+        接続を返却する
+
+        Parameters:
+            conn: getconn で取得した接続
+            discard: True の場合は再利用せずに破棄する
+        """
+        with self._cond:
+            entry = self._used.pop(id(conn), None)
+        if entry is None:
+            raise ValueError("このプールから取得した接続ではありません")
+
+        if not discard:
+            try:
+                status = conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        now = time.monotonic()
+        if discard or self._closed or self._expired(entry, now):
+            self._drop(entry)
+            return
+
+        entry.released_at = now
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+        return
+
+    def stats(self: Self) -> PoolStats:
+        """
+        プールの利用状況を取得する
+        """
+        with self._cond:
+            in_use = len(self._used)
+            return PoolStats(
+                size=self._size,
+                in_use=in_use,
+                idle=len(self._idle),
+                max_size=self._max_size,
+                utilisation=in_use / self._max_size,
+                requests=self._requests,
+                waits=self._waits,
+                wait_time_total=self._wait_time_total,
+                wait_time_max=self._wait_time_max,
+                timeouts=self._timeouts,
+                created=self._created,
+                discarded=self._discarded,
+            )
+
+    def close(self: Self) -> None:
+        """
+        待機中の接続をすべて閉じる。貸し出し中の接続は返却時に閉じる
+        """
+        with self._cond:
+            self._closed = True
+            entries = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for entry in entries:
+            self._drop(entry)
+        return
+
+    def __enter__(self: Self) -> Self:
+        return self
+
+    def __exit__(self: Self, *args: Any) -> None:
+        self.close()
+        return
+
+    def _new_entry(self: Self) -> _Entry:
+        conn = self._connect()
+        with self._cond:
+            self._created += 1
+        return _Entry(conn, time.monotonic())
+
+    def _expired(self: Self, entry: _Entry, now: float) -> bool:
+        return self._max_lifetime > 0 and now - entry.created_at >= self._max_lifetime
+
+    def _evict_locked(self: Self, now: float) -> list[_Entry]:
+        # 寿命切れ、または長時間使われていない接続を待機列から外す（min_size は維持する）
+        # ロック保持中に呼ぶこと。外した接続のクローズは呼び出し側がロック解放後に行う
+        kept: Deque[_Entry] = deque()
+        evicted: list[_Entry] = []
+        while self._idle:
+            entry = self._idle.popleft()
+            idle_too_long = self._max_idle > 0 and now - entry.released_at >= self._max_idle and self._size > self._min_size
+            if self._expired(entry, now) or idle_too_long:
+                self._size -= 1
+                self._discarded += 1
+                evicted.append(entry)
+            else:
+                kept.append(entry)
+        self._idle = kept
+        return evicted
+
+    def _healthy(self: Self, entry: _Entry) -> bool:
+        conn = entry.conn
+        if conn.closed:
+            return False
+        if not self._check:
+            return True
+        # 直前まで使われていた接続は生きているとみなし、往復を省く
+        if time.monotonic() - entry.released_at < self._check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _drop(self: Self, entry: _Entry) -> None:
+        self._close_quietly(entry.conn)
+        with self._cond:
+            self._size -= 1
+            self._discarded += 1
+            self._cond.notify()
+        return
+
+    @staticmethod
+    def _close_quietly(conn: Any) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return
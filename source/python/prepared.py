@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import re
+import threading
+import weakref
+from collections import deque
+
+from typing import Self
+from typing import Any, Deque, Dict, Sequence, Set, Tuple, TypedDict
+
+# 文の名前に使える文字（PREPARE / EXECUTE にそのまま埋め込むため）
+_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+class PreparedStats(TypedDict):
+    hits: int           # 準備済みの文を実行した回数
+    misses: int         # 文を準備（PREPARE）した回数
+    connections: int    # 文を準備した接続数（破棄された接続は除く。閉じた接続は次に新しい接続を登録するときに除く）
+    statements: int     # 登録されている文の数
+
+
+def to_placeholders(sql: str) -> str:
+    """
+    %s 形式のパラメータを PREPARE 用の $1, $2, ... に置き換える
+    """
+    count = 0
+
+    def number(match: re.Match) -> str:
+        nonlocal count
+        if match.group(0) == "%%":
+            return "%"
+        count += 1
+        return f"${count}"
+    return re.sub(r"%%|%s", number, sql)
+
+
+class PreparedStatements:
+    """
+    サーバ側の準備済み文（PREPARE / EXECUTE）の管理
+
+    文を名前で登録し、接続毎に初回だけ PREPARE して、以降は EXECUTE で名前を指定して実行する
+    （構文解析・実行計画の作成を接続毎に1回にする）。
+    Authorize / Expense のコンストラクタに同じインスタンスを渡すことで共有できる
+    （同じプールを使う場合は、文の名前が重ならないよう必ず同じインスタンスを渡す）。
+
+    接続が使い回される場合（ConnectionPool 使用時、ExpenseSession 内）に効果がある。
+    Authorize / Expense では pool の指定が必要（呼び出し毎に接続する場合は PREPARE の分だけ往復が増えるため）。
+    接続は弱参照で保持する（接続の寿命を延ばさない）。
+    """
+
+    def __init__(self: Self) -> None:
+        self._lock = threading.Lock()
+        self._statements: Dict[str, str] = {}
+        # id(接続) → (接続の弱参照, 準備済みの文の名前)。接続が破棄されたときに除く
+        self._connections: Dict[int, Tuple[weakref.ref, Set[str]]] = {}
+        # 破棄された接続の弱参照（弱参照のコールバックはロックを取らずに追加だけする）
+        self._dead: Deque[weakref.ref] = deque()
+        self._hits = 0
+        self._misses = 0
+        return
+
+    def execute(self: Self, cur: Any, name: str, sql: str, params: Sequence[Any] = ()) -> None:
+        """
+        文を実行する（結果は cur から取得する）
+
+        Parameters:
+            cur: カーソル
+            name: 文の名前（英小文字・数字・_）
+            sql: 文（パラメータは %s）。同じ名前は常に同じ文であること
+            params: パラメータ
+        """
+        conn = cur.connection
+        with self._lock:
+            registered = self._statements.get(name)
+            if registered is None:
+                if not _NAME.match(name):
+                    raise ValueError(f"文の名前が不正です: {name}")
+                self._statements[name] = sql
+            elif registered != sql:
+                raise ValueError(f"同じ名前で異なる文が登録されています: {name}")
+            prepared = self._prepared_names(conn)
+            hit = name in prepared
+
+        if not hit:
+            cur.execute(f"PREPARE {name} AS {to_placeholders(sql)}")
+            with self._lock:
+                self._prepared_names(conn).add(name)
+
+        if params:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", tuple(params))
+        else:
+            cur.execute(f"EXECUTE {name}")
+
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+        return
+
+    def _prepared_names(self: Self, conn: Any) -> Set[str]:
+        # ロック保持中に呼ぶこと
+        self._prune()
+        key = id(conn)
+        entry = self._connections.get(key)
+        if entry is None or entry[0]() is not conn:
+            # 閉じた接続を除く（PREPARE した文は接続とともに破棄される）
+            self._connections = {
+                k: v for k, v in self._connections.items() if (c := v[0]()) is not None and not c.closed
+            }
+            entry = (weakref.ref(conn, self._dead.append), set())
+            self._connections[key] = entry
+        return entry[1]
+
+    def _prune(self: Self) -> None:
+        # 破棄された接続を除く（ロック保持中に呼ぶこと）
+        while self._dead:
+            ref = self._dead.popleft()
+            self._connections = {k: v for k, v in self._connections.items() if v[0] is not ref}
+        return
+
+    def stats(self: Self) -> PreparedStats:
+        """
+        準備済み文の利用状況を取得する
+        """
+        with self._lock:
+            self._prune()
+            return PreparedStats(
+                hits=self._hits,
+                misses=self._misses,
+                connections=len(self._connections),
+                statements=len(self._statements),
+            )
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import argparse
+import psycopg2
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, TypedDict
+
+from balance import TREE_WRITER, BalanceTree, month_index, update_nodes
+from locks import ACCOUNT_LOCK_NAMESPACE, AccountLocks
+
+
+class AccountReport(TypedDict):
+    aid: int
+    rows: int               # 削除されていない口座履歴の件数
+    mismatched: int         # 残高（balance_tree時は delta）が取引から求めた値と一致しない行数
+    orphaned: int           # 削除済みの取引の口座履歴が削除されずに残っている行数
+    tree_mismatched: int    # 一致しない木のノード数（balance_tree時のみ）
+    fixed: bool             # 再構築した
+
+
+# 取引から求めた、口座履歴の本来の増減と残高（パラメータ: aid の配列）
+#
+# 1つの取引で同じ口座に支出と収入の2行がある場合、支出の行は
+# 支払日が取引日と異なる行、同じ場合は dorder の小さい行（add_transaction は支出 → 収入の順に追加する）
+_EXPECTED: str = """
+    live AS (
+        SELECT h.hid, h.aid, h.payment_date, h.dorder, h.amount, {delta_column} AS current_delta,
+               h.archived, t.is_deleted AS orphaned,
+               CASE
+                   WHEN p.aid = h.aid
+                    AND (t.aid IS DISTINCT FROM h.aid
+                         OR row_number() OVER (PARTITION BY h.tid, h.aid ORDER BY h.payment_date = t.transaction_date, h.dorder) = 1)
+                   THEN -t.amount_spent
+                   WHEN t.aid = h.aid THEN t.amount_received
+                   ELSE 0
+               END AS delta
+        FROM {histories} h
+        JOIN {transactions} t ON t.tid = h.tid
+        LEFT JOIN expense.payments p ON p.pid = t.pid
+        WHERE h.aid = ANY(%s) AND h.is_deleted = FALSE
+    ), expected AS (
+        SELECT hid, aid, payment_date, amount, current_delta, archived, orphaned, delta,
+               COALESCE(sum(delta) FILTER (WHERE NOT orphaned) OVER (PARTITION BY aid ORDER BY payment_date, dorder), 0) AS balance
+        FROM live
+    )
+"""
+
+
+# 退避済み（partition.py archive）の行を含める場合の口座履歴・取引
+_ARCHIVED_HISTORIES: str = """(
+        SELECT *, FALSE AS archived FROM expense.account_histories
+        UNION ALL
+        SELECT *, TRUE AS archived FROM expense_archive.account_histories
+    )"""
+_ARCHIVED_TRANSACTIONS: str = """(
+        SELECT * FROM expense.transactions
+        UNION ALL
+        SELECT * FROM expense_archive.transactions
+    )"""
+
+
+def _expected(balance_tree: bool, archived: bool = False) -> str:
+    if archived:
+        return _EXPECTED.format(delta_column="h.delta" if balance_tree else "NULL::int",
+                                histories=_ARCHIVED_HISTORIES, transactions=_ARCHIVED_TRANSACTIONS)
+    return _EXPECTED.format(delta_column="h.delta" if balance_tree else "NULL::int",
+                            histories="(SELECT *, FALSE AS archived FROM expense.account_histories)",
+                            transactions="expense.transactions")
+
+
+def has_archive(cur: Any) -> bool:
+    """
+    退避先（test_environment/make_partition.sql）があるか
+    """
+    cur.execute("SELECT to_regclass('expense_archive.account_histories') IS NOT NULL")
+    return bool(cur.fetchone()[0])
+
+
+def _tree_diff(cur: Any, aids: List[int], archived: bool = False) -> Dict[int, int]:
+    """
+    木のノードと、口座履歴の delta から求めたノードの差異の数（口座毎）
+    """
+    cur.execute(f"""
+        WITH {_expected(True, archived)}
+        SELECT aid, payment_date, delta FROM expected WHERE NOT orphaned
+    """, (aids,))
+    expected: Dict[Tuple[int, int], int] = {}
+    for aid, payment_date, delta in cur.fetchall():
+        for node in update_nodes(month_index(payment_date)):
+            expected[(aid, node)] = expected.get((aid, node), 0) + delta
+
+    cur.execute("SELECT aid, node, total FROM expense.account_balance_tree WHERE aid = ANY(%s)", (aids,))
+    actual: Dict[Tuple[int, int], int] = {(row[0], row[1]): int(row[2]) for row in cur.fetchall()}
+
+    diff: Dict[int, int] = {}
+    for key in set(expected) | set(actual):
+        if expected.get(key, 0) != actual.get(key, 0):
+            diff[key[0]] = diff.get(key[0], 0) + 1
+    return diff
+
+
+def verify_accounts(cur: Any, aids: List[int], balance_tree: bool = False, archived: bool = False) -> List[AccountReport]:
+    """
+    口座履歴の検証（書き込みはしない）
+
+    Parameters:
+        aids: 検証する口座ID
+        balance_tree: True の場合、amount ではなく delta と木のノードを検証する
+        archived: True の場合、退避済みの行も含めて残高を求める（件数は退避していない行のみ）
+
+    Returns:
+        aids の各口座の結果
+    """
+    mismatch = "current_delta <> delta" if balance_tree else "amount <> balance"
+    cur.execute(f"""
+        WITH {_expected(balance_tree, archived)}
+        SELECT aid,
+               count(*) FILTER (WHERE NOT orphaned),
+               count(*) FILTER (WHERE NOT orphaned AND {mismatch}),
+               count(*) FILTER (WHERE orphaned)
+        FROM expected
+        WHERE NOT archived
+        GROUP BY aid
+    """, (aids,))
+    counts: Dict[int, Tuple[int, int, int]] = {row[0]: (row[1], row[2], row[3]) for row in cur.fetchall()}
+    tree_diff: Dict[int, int] = _tree_diff(cur, aids, archived) if balance_tree else {}
+
+    return [
+        AccountReport(aid=aid, rows=counts.get(aid, (0, 0, 0))[0], mismatched=counts.get(aid, (0, 0, 0))[1],
+                      orphaned=counts.get(aid, (0, 0, 0))[2], tree_mismatched=tree_diff.get(aid, 0), fixed=False)
+        for aid in aids
+    ]
+
+
+def rebuild_accounts(cur: Any, aids: List[int], balance_tree: bool = False, archived: bool = False) -> None:
+    """
+    口座履歴の再構築
+
+    削除済みの取引の口座履歴を削除マークし、残りの amount を取引から求めた残高に書き換える。
+    balance_tree指定時は delta も書き換え、木のノードを作り直す。
+    archived指定時は、退避済みの行も含めて残高を求める（書き換えるのは退避していない行のみ）。
+    """
+    cur.execute(f"""
+        {TREE_WRITER if balance_tree else ""}
+        WITH {_expected(balance_tree, archived)}, orphans AS (
+            UPDATE expense.account_histories h
+            SET is_deleted = TRUE
+            FROM expected e
+            WHERE h.hid = e.hid AND e.orphaned
+        )
+        UPDATE expense.account_histories h
+        SET amount = e.balance{", delta = e.delta" if balance_tree else ""}
+        FROM expected e
+        WHERE h.hid = e.hid AND NOT e.orphaned
+          AND (h.amount <> e.balance{" OR h.delta <> e.delta" if balance_tree else ""})
+    """, (aids,))
+
+    if balance_tree:
+        cur.execute("DELETE FROM expense.account_balance_tree WHERE aid = ANY(%s)", (aids,))
+        cur.execute(f"""
+            SELECT aid, payment_date, delta FROM {_ARCHIVED_HISTORIES if archived else "expense.account_histories"} h
+            WHERE aid = ANY(%s) AND is_deleted = FALSE
+        """, (aids,))
+        BalanceTree().add(cur, [(row[0], row[1], row[2]) for row in cur.fetchall()])
+    return
+
+
+def _diverged(report: AccountReport) -> bool:
+    return report["mismatched"] > 0 or report["orphaned"] > 0 or report["tree_mismatched"] > 0
+
+
+def _run_chunk(dsn: str, aids: List[int], verify_only: bool, balance_tree: bool, lock_namespace: int) -> List[AccountReport]:
+    """
+    口座の一部を1本の接続で処理する（プロセスプールのワーカ）
+
+    検証は1回の問い合わせでまとめて行い、再構築は口座毎に1トランザクションで行う。
+    退避先（partition.py archive）がある場合は、退避済みの行も含めて残高を求める。
+    """
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            archived = has_archive(cur)
+            reports = verify_accounts(cur, aids, balance_tree, archived)
+            conn.rollback()
+            if verify_only:
+                return [report for report in reports if _diverged(report)]
+
+            locks = AccountLocks(lock_namespace)
+            result: List[AccountReport] = []
+            for report in reports:
+                if not _diverged(report):
+                    continue
+                # 口座をロックし（Expense(locks=...) の書き込みと直列化される）、検証後の更新に備えて検証し直す
+                locks.lock(cur, [report["aid"]])
+                report = verify_accounts(cur, [report["aid"]], balance_tree, archived)[0]
+                if _diverged(report):
+                    rebuild_accounts(cur, [report["aid"]], balance_tree, archived)
+                    report["fixed"] = True
+                    result.append(report)
+                conn.commit()
+            return result
+    finally:
+        conn.close()
+
+
+def run(dsn: str, aids: Optional[List[int]] = None, verify_only: bool = False, workers: int = 4,
+        chunk_size: int = 64, balance_tree: bool = False, lock_namespace: int = ACCOUNT_LOCK_NAMESPACE) -> List[AccountReport]:
+    """
+    口座履歴の検証・再構築
+
+    Parameters:
+        dsn: 接続文字列
+        aids: 対象の口座ID。省略時はすべての口座
+        verify_only: True の場合、検証のみ（書き込まない）
+        workers: プロセス数
+        chunk_size: 1回にワーカへ渡す口座数
+        balance_tree: Expense(balance_tree=True) で運用している場合は True
+        lock_namespace: 口座ロックの名前空間（Expense(locks=AccountLocks(namespace=...)) と同じ値にする）
+
+    Returns:
+        差異のあった口座の結果（verify_only でない場合は再構築済み）
+    """
+    if aids is None:
+        conn = psycopg2.connect(dsn)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT aid FROM expense.accounts ORDER BY aid")
+                aids = [row[0] for row in cur.fetchall()]
+        finally:
+            conn.close()
+
+    chunks = [aids[i:i + chunk_size] for i in range(0, len(aids), chunk_size)]
+    result: List[AccountReport] = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_chunk, dsn, chunk, verify_only, balance_tree, lock_namespace) for chunk in chunks]
+        for future in futures:
+            result.extend(future.result())
+    return sorted(result, key=lambda report: report["aid"])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="口座履歴（expense.account_histories）の検証・再構築")
+    parser.add_argument("--dsn", required=True, help="接続文字列")
+    parser.add_argument("--aid", type=int, action="append", help="対象の口座ID（複数指定可。省略時はすべて）")
+    parser.add_argument("--verify", action="store_true", help="検証のみ")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--balance-tree", action="store_true", help="balance_tree で運用している場合")
+    parser.add_argument("--lock-namespace", type=lambda value: int(value, 0), default=ACCOUNT_LOCK_NAMESPACE,
+                        help="口座ロックの名前空間（Expense(locks=AccountLocks(namespace=...)) と同じ値。0x 付きの16進も可）")
+    args = parser.parse_args()
+
+    reports = run(args.dsn, args.aid, args.verify, args.workers, balance_tree=args.balance_tree,
+                  lock_namespace=args.lock_namespace)
+    for report in reports:
+        print(f"aid={report['aid']} rows={report['rows']} mismatched={report['mismatched']} "
+              f"orphaned={report['orphaned']} tree_mismatched={report['tree_mismatched']} fixed={report['fixed']}")
+    print(f"差異のある口座: {len(reports)}")
+    return 1 if args.verify and reports else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
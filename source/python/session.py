@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import fcntl
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+from abc import ABC, abstractmethod
+from typing import Self
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+
+# セッションの破棄（auth.users 版。パラメータ: ユーザ名称, シーケンス管理用番号。AsyncAuthorize.logout と共有する）
+_REMOVE_SESSION: str = """
+    UPDATE auth.users
+    SET magic_number = NULL,
+        sequence_number = NULL
+    WHERE uname = %s AND sequence_number = %s
+"""
+
+
+class SessionStore(ABC):
+    """
+    セッション状態（マジックナンバー、シーケンス管理用番号）の保存先
+
+    Authorize はユーザの存在確認・パスワード照合を auth.users で行い、
+    セッション状態の読み書きはこのインターフェースを通して行う。
+    """
+
+    @abstractmethod
+    def set_magic(self: Self, user: str, uid: int, magic: int) -> None:
+        """
+        マジックナンバーを設定し、シーケンス管理用番号をクリアする
+        """
+
+    @abstractmethod
+    def has_magic(self: Self, user: str, magic: int) -> bool:
+        """
+        マジックナンバーが一致するか
+        """
+
+    @abstractmethod
+    def unlock(self: Self, user: str, magic: int, sequence: int) -> Optional[int]:
+        """
+        マジックナンバーが一致する場合に、マジックナンバーをクリアしてシーケンス管理用番号を設定する
+
+        Returns:
+            uid: 更新できた場合
+            None: マジックナンバー不一致
+        """
+
+    @abstractmethod
+    def extend(self: Self, user: str, sequence: int, new_sequence: int) -> Optional[int]:
+        """
+        シーケンス管理用番号が一致する場合に、新しい番号に置き換える
+
+        Returns:
+            uid: 更新できた場合
+            None: シーケンス管理用番号不一致
+        """
+
+    @abstractmethod
+    def remove(self: Self, user: str, sequence: int) -> bool:
+        """
+        シーケンス管理用番号が一致する場合に、セッションを破棄する（ログアウト）
+
+        Returns:
+            True: 破棄した
+            False: シーケンス管理用番号不一致
+        """
+
+
+class PostgresSessionStore(SessionStore):
+    """
+    auth.users の magic_number / sequence_number 列に保存する（従来どおりの保存先）
+
+    Parameters:
+        connect: DB接続を返す関数（with 文で使え、終了時に commit されるもの）
+    """
+
+    def __init__(self: Self, connect: Callable[[], ContextManager[Any]]) -> None:
+        self._connect = connect
+        return
+
+    def set_magic(self: Self, user: str, uid: int, magic: int) -> None:
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE auth.users
+                    SET magic_number = %s,
+                        sequence_number = NULL,
+                        last_access_at = now()
+                    WHERE uid = %s
+                """, (magic, uid))
+            conn.commit()
+        return
+
+    def has_magic(self: Self, user: str, magic: int) -> bool:
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 FROM auth.users WHERE uname = %s AND magic_number = %s", (user, magic))
+                return cur.fetchone() is not None
+
+    def unlock(self: Self, user: str, magic: int, sequence: int) -> Optional[int]:
+        return self._swap("magic_number", user, magic, sequence)
+
+    def extend(self: Self, user: str, sequence: int, new_sequence: int) -> Optional[int]:
+        return self._swap("sequence_number", user, sequence, new_sequence)
+
+    def remove(self: Self, user: str, sequence: int) -> bool:
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_REMOVE_SESSION, (user, sequence))
+                removed = cur.rowcount > 0
+            conn.commit()
+        return removed
+
+    def _swap(self: Self, column: str, user: str, current: int, sequence: int) -> Optional[int]:
+        with self._connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    UPDATE auth.users
+                    SET magic_number = NULL,
+                        sequence_number = %s,
+                        last_access_at = now()
+                    WHERE uname = %s AND {column} = %s
+                    RETURNING uid
+                """, (sequence, user, current))
+                row = cur.fetchone()
+            conn.commit()
+        return row[0] if row is not None else None
+
+
+class MemorySessionStore(SessionStore):
+    """
+    プロセス内のメモリに保存する（単一プロセス用）
+    """
+
+    def __init__(self: Self) -> None:
+        self._lock = threading.Lock()
+        # user -> [uid, magic, sequence]
+        self._sessions: Dict[str, List[Optional[int]]] = {}
+        return
+
+    def set_magic(self: Self, user: str, uid: int, magic: int) -> None:
+        with self._lock:
+            self._sessions[user] = [uid, magic, None]
+        return
+
+    def has_magic(self: Self, user: str, magic: int) -> bool:
+        with self._lock:
+            entry = self._sessions.get(user)
+            return entry is not None and entry[1] == magic
+
+    def unlock(self: Self, user: str, magic: int, sequence: int) -> Optional[int]:
+        with self._lock:
+            entry = self._sessions.get(user)
+            if entry is None or entry[1] != magic:
+                return None
+            entry[1] = None
+            entry[2] = sequence
+            return entry[0]
+
+    def extend(self: Self, user: str, sequence: int, new_sequence: int) -> Optional[int]:
+        with self._lock:
+            entry = self._sessions.get(user)
+            if entry is None or entry[2] != sequence:
+                return None
+            entry[2] = new_sequence
+            return entry[0]
+
+    def remove(self: Self, user: str, sequence: int) -> bool:
+        with self._lock:
+            entry = self._sessions.get(user)
+            if entry is None or entry[2] != sequence:
+                return False
+            del self._sessions[user]
+            return True
+
+
+class SharedMemorySessionStore(SessionStore):
+    """
+    共有メモリに保存する（同一ホスト上の複数ワーカープロセスで共有）
+
+    同じ name を指定したプロセス同士で状態を共有する。最初に開いたプロセスが領域を作成する。
+    ユーザ名をキーにした固定長のハッシュ表で、プロセス間の排他はロックファイル（flock）で行う。
+    セッションは最後の更新から ttl 秒で期限切れになる。ログアウト・期限切れのスロットは再利用する。
+
+    Parameters:
+        name: 共有メモリの名前
+        slots: 同時に保存できるセッション数の上限（作成時のみ有効）
+        lock_dir: ロックファイルを置くディレクトリ
+        ttl: セッションの有効期間（秒）
+    """
+
+    _HEADER = struct.Struct("<8sI")
+    _SIGNATURE = b"AUTHSES2"
+    # state, flags, name_len, name, uid, magic, sequence, expires_at（UNIX時刻）
+    _SLOT = struct.Struct("<BBH200sqqqd")
+    _EMPTY = 0
+    _USED = 1
+    _REMOVED = 2    # 削除済み（探索は続ける。登録時は再利用する）
+    _HAS_MAGIC = 0x01
+    _HAS_SEQUENCE = 0x02
+
+    def __init__(self: Self, name: str = "auth_sessions", slots: int = 4096, lock_dir: Optional[str] = None,
+                 ttl: float = 86400.0) -> None:
+        self._name = name
+        self._ttl = ttl
+        self._thread_lock = threading.Lock()
+        lock_path = os.path.join(lock_dir if lock_dir is not None else tempfile.gettempdir(), f"{name}.lock")
+        self._lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        with self._locked():
+            try:
+                self._shm = SharedMemory(name=name)
+            except FileNotFoundError:
+                self._shm = SharedMemory(name=name, create=True, size=self._HEADER.size + self._SLOT.size * slots)
+                self._shm.buf[:self._shm.size] = bytes(self._shm.size)
+                self._HEADER.pack_into(self._shm.buf, 0, self._SIGNATURE, slots)
+            # 各ワーカーの終了時に領域が削除されないよう、resource_tracker の管理から外す
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+
+            signature, self._slots = self._HEADER.unpack_from(self._shm.buf, 0)
+            if signature != self._SIGNATURE:
+                raise ValueError(f"共有メモリ {name} はセッション領域ではありません")
+        return
+
+    def set_magic(self: Self, user: str, uid: int, magic: int) -> None:
+        with self._locked():
+            index, _ = self._find(user, create=True)
+            self._write(index, user, self._HAS_MAGIC, uid, magic, 0)
+        return
+
+    def has_magic(self: Self, user: str, magic: int) -> bool:
+        with self._locked():
+            index, slot = self._find(user)
+            return slot is not None and bool(slot[1] & self._HAS_MAGIC) and slot[5] == magic
+
+    def unlock(self: Self, user: str, magic: int, sequence: int) -> Optional[int]:
+        with self._locked():
+            index, slot = self._find(user)
+            if slot is None or not slot[1] & self._HAS_MAGIC or slot[5] != magic:
+                return None
+            self._write(index, user, self._HAS_SEQUENCE, slot[4], 0, sequence)
+            return slot[4]
+
+    def extend(self: Self, user: str, sequence: int, new_sequence: int) -> Optional[int]:
+        with self._locked():
+            index, slot = self._find(user)
+            if slot is None or not slot[1] & self._HAS_SEQUENCE or slot[6] != sequence:
+                return None
+            self._write(index, user, self._HAS_SEQUENCE, slot[4], 0, new_sequence)
+            return slot[4]
+
+    def remove(self: Self, user: str, sequence: int) -> bool:
+        with self._locked():
+            index, slot = self._find(user)
+            if slot is None or not slot[1] & self._HAS_SEQUENCE or slot[6] != sequence:
+                return False
+            self._SLOT.pack_into(self._shm.buf, self._offset(index), self._REMOVED, 0, 0, b"", 0, 0, 0, 0.0)
+            return True
+
+    def close(self: Self) -> None:
+        """
+        このプロセスでの利用を終了する（領域は残る）
+        """
+        self._shm.close()
+        os.close(self._lock_fd)
+        return
+
+    def unlink(self: Self) -> None:
+        """
+        共有メモリ領域を削除する
+        """
+        # unlink は resource_tracker からの登録解除も行うため、いったん登録し直す
+        resource_tracker.register(self._shm._name, "shared_memory")
+        self._shm.unlink()
+        return
+
+    @contextmanager
+    def _locked(self: Self) -> Iterator[None]:
+        # flock はプロセス間の排他、threading.Lock は同一プロセス内のスレッド間の排他
+        with self._thread_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _find(self: Self, user: str, create: bool = False) -> Tuple[int, Optional[Tuple[Any, ...]]]:
+        """
+        ユーザのスロットを探す（線形探索のオープンアドレス法）
+
+        削除済み・期限切れのスロットは探索を続け、空きスロットに当たれば未登録。
+        期限切れのセッションは未登録として扱う。
+
+        Returns:
+            (位置, スロット): 登録済みの場合
+            (位置, None): 未登録の場合。位置は create の場合の登録先（最初に見つけた再利用できるスロット）、それ以外は -1
+        """
+        key = user.encode()
+        if len(key) > 200:
+            raise ValueError(f"ユーザ名が長すぎます: {user}")
+        now = time.time()
+        reusable = -1
+        start = zlib.crc32(key) % self._slots
+        for i in range(self._slots):
+            index = (start + i) % self._slots
+            slot = self._SLOT.unpack_from(self._shm.buf, self._offset(index))
+            if slot[0] == self._EMPTY:
+                if reusable < 0:
+                    reusable = index
+                break
+            expired = slot[0] == self._REMOVED or slot[7] <= now
+            if slot[0] == self._USED and slot[3][:slot[2]] == key:
+                if not expired:
+                    return index, slot
+                # 期限切れの自分のスロットは、そのまま再利用する
+                return (index if create else -1), None
+            if expired and reusable < 0:
+                reusable = index
+        if not create:
+            return -1, None
+        if reusable < 0:
+            raise RuntimeError("セッション領域に空きがありません")
+        return reusable, None
+
+    def _write(self: Self, index: int, user: str, flags: int, uid: int, magic: int, sequence: int) -> None:
+        key = user.encode()
+        self._SLOT.pack_into(self._shm.buf, self._offset(index), self._USED, flags, len(key), key, uid, magic, sequence,
+                             time.time() + self._ttl)
+        return
+
+    def _offset(self: Self, index: int) -> int:
+        return self._HEADER.size + self._SLOT.size * index
@@ -0,0 +1,94 @@
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+
+from access import AccessRecorder
+from authorize import Authorize
+from session import MemorySessionStore, PostgresSessionStore
+
+
+def make_connect():
+    conn = MagicMock()
+    connect = MagicMock()
+    connect.return_value.__enter__.return_value = conn
+    return connect, conn
+
+
+class TestAccessRecorder(unittest.TestCase):
+
+    @patch("access.execute_values")
+    def test_coalesce_per_user(self, mock_execute_values: MagicMock):
+        connect, conn = make_connect()
+        recorder = AccessRecorder(connect, interval=0)
+
+        recorder.record(1, datetime(2024, 1, 1, 10, 0, 0))
+        recorder.record(1, datetime(2024, 1, 1, 10, 0, 5))
+        recorder.record(1, datetime(2024, 1, 1, 10, 0, 3))
+        recorder.record(2, datetime(2024, 1, 1, 10, 0, 1))
+
+        self.assertEqual(recorder.flush(), 2)
+        rows = mock_execute_values.call_args.args[2]
+        self.assertEqual(dict(rows), {1: datetime(2024, 1, 1, 10, 0, 5), 2: datetime(2024, 1, 1, 10, 0, 1)})
+        self.assertEqual(mock_execute_values.call_count, 1)
+        self.assertEqual(recorder.pending(), 0)
+
+    @patch("access.execute_values")
+    def test_staleness_bound(self, mock_execute_values: MagicMock):
+        connect, conn = make_connect()
+        recorder = AccessRecorder(connect, interval=0, max_staleness=0.01)
+        flushed_by = []
+        mock_execute_values.side_effect = lambda *args, **kwargs: flushed_by.append(threading.current_thread())
+
+        recorder.record(1)
+        mock_execute_values.assert_not_called()
+        time.sleep(0.02)
+        recorder.record(2)
+
+        # 書き込みはバックグラウンドのスレッドで行う（record を呼んだスレッドでは行わない）
+        for _ in range(100):
+            if recorder.pending() == 0 and flushed_by:
+                break
+            time.sleep(0.01)
+        self.assertEqual(recorder.pending(), 0)
+        self.assertEqual(len(flushed_by), 1)
+        self.assertIsNot(flushed_by[0], threading.current_thread())
+        recorder.close()
+
+    @patch("access.execute_values")
+    def test_failed_flush_is_retried(self, mock_execute_values: MagicMock):
+        connect, conn = make_connect()
+        recorder = AccessRecorder(connect, interval=0)
+        mock_execute_values.side_effect = [Exception("down"), None]
+
+        recorder.record(1)
+        self.assertEqual(recorder.flush(), 0)
+        self.assertEqual(recorder.pending(), 1)
+        self.assertEqual(recorder.flush(), 1)
+
+    @patch("psycopg2.connect")
+    def test_authorize_defers_last_access(self, mock_connect: MagicMock):
+        store = MemorySessionStore()
+        store.set_magic("testuser", 7, 123456)
+        store.unlock("testuser", 123456, 654321)
+
+        recorder = MagicMock()
+        auth = Authorize("localhost", 5432, "testdb", "testuser", "testpass", access_recorder=recorder, session_store=store)
+
+        result = auth.try_unlock_extend("testuser", 654321)
+        self.assertTrue(100000 <= result <= 999999)
+        recorder.record.assert_called_once_with(7)
+        mock_connect.assert_not_called()
+
+    def test_authorize_requires_session_store(self):
+        # auth.users で認証する場合は、各処理で行を書き換えるため遅延書き込みの効果がない
+        recorder = MagicMock()
+        with self.assertRaises(ValueError):
+            Authorize("localhost", 5432, "testdb", "testuser", "testpass", access_recorder=recorder)
+        with self.assertRaises(ValueError):
+            Authorize("localhost", 5432, "testdb", "testuser", "testpass", access_recorder=recorder,
+                      session_store=PostgresSessionStore(MagicMock()))
+
+if __name__ == "__main__":
+    unittest.main()
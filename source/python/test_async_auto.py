@@ -0,0 +1,258 @@
+import unittest
+import zlib
+from datetime import datetime
+from unittest.mock import patch, AsyncMock, MagicMock
+
+from access import AccessRecorder
+from authorize import _EXTEND_ATOMIC
+from authorize_async import AsyncAuthorize
+from cache import TTLCache
+from expense import _ADD_TRANSACTION_FUNCTION
+from expense_async import AsyncExpense
+from locks import ACCOUNT_LOCK_NAMESPACE, AccountLocks
+from session import MemorySessionStore, PostgresSessionStore
+
+
+def make_conn():
+    conn = MagicMock()
+    conn.__aenter__.return_value = conn
+    conn.commit = AsyncMock()
+    cur = MagicMock()
+    cur.execute = AsyncMock()
+    cur.fetchone = AsyncMock()
+    cur.fetchall = AsyncMock()
+    conn.cursor.return_value.__aenter__.return_value = cur
+    return conn, cur
+
+
+class TestAsyncAuthorize(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.auth = AsyncAuthorize("localhost", 5432, "testdb", "testuser", "testpass")
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_get_magic_number_success(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        cur.fetchone.return_value = (1,)
+        cur.rowcount = 1
+
+        result = await self.auth.get_magic_number("testuser")
+        self.assertTrue(100000 <= result <= 999999)
+        conn.commit.assert_awaited()
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_get_magic_number_user_not_found(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        cur.fetchone.return_value = None
+
+        result = await self.auth.get_magic_number("unknown_user")
+        self.assertEqual(result, -1)
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_try_unlock_success(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        cur.fetchone.return_value = (1, "password123")
+        cur.rowcount = 1
+
+        magic = 123456
+        pass_hash = format(zlib.crc32(f"password123{magic}".encode()) & 0xFFFFFFFF, '08x')
+
+        result = await self.auth.try_unlock("testuser", magic, pass_hash)
+        self.assertTrue(100000 <= result <= 999999)
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_try_unlock_extend_not_found(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        cur.fetchone.return_value = None
+
+        result = await self.auth.try_unlock_extend("testuser", 654321)
+        self.assertEqual(result, -2)
+
+    async def test_uses_pool(self):
+        conn, cur = make_conn()
+        cur.fetchall.return_value = [(1, "Feature A", "/feature/a", None, None)]
+        pool = MagicMock()
+        pool.connection.return_value.__aenter__.return_value = conn
+        auth = AsyncAuthorize("localhost", 5432, "testdb", "testuser", "testpass", pool=pool)
+
+        result = await auth.get_feature_list("testuser")
+        self.assertEqual(result[0]["fname"], "Feature A")
+        pool.connection.assert_called_once()
+
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_atomic_extend(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        cur.fetchone.return_value = (1,)
+        auth = AsyncAuthorize("localhost", 5432, "testdb", "testuser", "testpass", atomic=True)
+
+        result = await auth.try_unlock_extend("testuser", 654321)
+        self.assertTrue(100000 <= result <= 999999)
+        self.assertEqual(cur.execute.await_count, 1)
+        self.assertEqual(cur.execute.await_args.args[0], _EXTEND_ATOMIC)
+        self.assertEqual(cur.execute.await_args.args[1][2:], ("testuser", 654321))
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_session_store(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        auth = AsyncAuthorize("localhost", 5432, "testdb", "testuser", "testpass", session_store=MemorySessionStore())
+
+        cur.fetchone.return_value = (1, False)
+        magic = await auth.get_magic_number("testuser")
+        cur.fetchone.return_value = (1, "password123")
+        pass_hash = format(zlib.crc32(f"password123{magic}".encode()) & 0xFFFFFFFF, '08x')
+        sequence = await auth.try_unlock("testuser", magic, pass_hash)
+        self.assertTrue(100000 <= sequence <= 999999)
+
+        # 認証延長・ログアウトはDBに接続しない
+        mock_connect.reset_mock()
+        extended = await auth.try_unlock_extend("testuser", sequence)
+        self.assertTrue(100000 <= extended <= 999999)
+        self.assertEqual(await auth.logout("testuser", extended), 0)
+        self.assertEqual(await auth.try_unlock_extend("testuser", extended), -2)
+        mock_connect.assert_not_called()
+
+    def test_rejects_unsupported_options(self):
+        with self.assertRaises(ValueError):
+            AsyncAuthorize("localhost", 5432, "testdb", "testuser", "testpass", session_store=PostgresSessionStore(MagicMock()))
+        with AccessRecorder(MagicMock()) as recorder:
+            with self.assertRaises(ValueError):
+                AsyncAuthorize("localhost", 5432, "testdb", "testuser", "testpass", access_recorder=recorder)
+
+    async def test_menu_cache(self):
+        conn, cur = make_conn()
+        cur.fetchall.return_value = [(1, "Feature A", "/feature/a", "abc", "image/png")]
+        pool = MagicMock()
+        pool.connection.return_value.__aenter__.return_value = conn
+        auth = AsyncAuthorize("localhost", 5432, "testdb", "testuser", "testpass", pool=pool,
+                              icon_url="/icon/{}", menu_cache=TTLCache())
+
+        first = await auth.get_feature_list("testuser", with_icon=False)
+        second = await auth.get_feature_list("testuser", with_icon=False)
+        self.assertEqual(first, second)
+        self.assertEqual(second[0]["icon_url"], "/icon/abc")
+        pool.connection.assert_called_once()
+
+        auth.invalidate_menu("testuser")
+        await auth.get_feature_list("testuser", with_icon=False)
+        self.assertEqual(pool.connection.call_count, 2)
+
+
+class TestAsyncExpense(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.expense = AsyncExpense("localhost", 5432, "testdb", "testuser", "testpass")
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_create_account_user_not_found(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        cur.fetchone.return_value = None
+
+        self.assertFalse(await self.expense.create_account("unknown_user", "口座"))
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_add_transaction_income(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        # uid, 収入aid, tid, 収入残額
+        cur.fetchone.side_effect = [(1,), (2,), (10,), (1000,)]
+
+        result = await self.expense.add_transaction("testuser", datetime(2024, 1, 16), "収入", None, None, 0, "口座", 500)
+        self.assertTrue(result)
+        params = cur.execute.await_args_list[4].args[1]
+        self.assertEqual(params[3], 1500)
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_add_transaction_locks_before_write(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        locks = AccountLocks()
+        expense = AsyncExpense("localhost", 5432, "testdb", "testuser", "testpass", locks=locks)
+        # uid, 支払い方法, 収入aid, ロック(aid=2), ロック(aid=3, 待ちあり), tid, 支出残額, 収入残額
+        cur.fetchone.side_effect = [(1,), (5, 3, 0, 0, 0), (2,), (True,), (False,), (10,), (0,), (1000,)]
+
+        self.assertTrue(await expense.add_transaction("testuser", datetime(2024, 1, 15), "振替", None, "現金", 100, "口座", 100))
+        calls = cur.execute.await_args_list
+        self.assertIn("pg_try_advisory_xact_lock", calls[3].args[0])
+        self.assertEqual(calls[3].args[1], (ACCOUNT_LOCK_NAMESPACE, 2))
+        self.assertIn("pg_advisory_xact_lock", calls[5].args[0])
+        self.assertEqual(calls[5].args[1], (ACCOUNT_LOCK_NAMESPACE, 3))
+        self.assertIn("INSERT INTO expense.transactions", calls[6].args[0])
+        self.assertEqual((locks.stats()["acquired"], locks.stats()["contended"]), (2, 1))
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_delete_transaction_locks_history_accounts(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        expense = AsyncExpense("localhost", 5432, "testdb", "testuser", "testpass", locks=AccountLocks())
+        # uid, 取引, ロック(aid=2), 収入の口座履歴
+        cur.fetchone.side_effect = [(1,), (10, None, 2, 0, 500), (True,), None]
+        cur.fetchall.return_value = [(2,)]
+
+        self.assertTrue(await expense.delete_transaction("testuser", datetime(2024, 1, 15), 1))
+        statements = [" ".join(c.args[0].split()) for c in cur.execute.await_args_list]
+        self.assertTrue(statements[2].startswith("SELECT DISTINCT aid FROM expense.account_histories"))
+        self.assertIn("pg_try_advisory_xact_lock", statements[3])
+        self.assertTrue(statements[4].startswith("UPDATE expense.transactions"))
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_delete_transaction_bounds_partition_key(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        # uid, 取引（支出のみ）, 支払い方法, 支出の口座履歴
+        cur.fetchone.side_effect = [(1,), (10, 5, None, 300, 0), (3, 25, 1, 10), (datetime(2024, 2, 10).date(), 1)]
+
+        self.assertTrue(await self.expense.delete_transaction("testuser", datetime(2024, 1, 15), 1))
+        calls = cur.execute.await_args_list
+        self.assertEqual(calls[3].args[1], (10, datetime(2024, 1, 15).date()))
+        self.assertEqual(calls[4].args[1], (3, 10, datetime(2024, 2, 10).date()))
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_balance_tree(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        expense = AsyncExpense("localhost", 5432, "testdb", "testuser", "testpass", balance_tree=True)
+        # uid, 取引（収入のみ）
+        cur.fetchone.side_effect = [(1,), (10, None, 2, 0, 500)]
+        cur.fetchall.return_value = [(2, datetime(2024, 1, 15).date(), 500)]
+
+        self.assertTrue(await expense.delete_transaction("testuser", datetime(2024, 1, 15), 1))
+        statements = [" ".join(c.args[0].split()) for c in cur.execute.await_args_list]
+        self.assertEqual(statements[3], "SET LOCAL expense.balance_tree = on;")
+        self.assertTrue(statements[4].startswith("UPDATE expense.account_histories"))
+        self.assertTrue(statements[5].startswith("INSERT INTO expense.account_balance_tree"))
+        self.assertEqual(set(cur.execute.await_args_list[5].args[1][2]), {-500})
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_server_function(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        expense = AsyncExpense("localhost", 5432, "testdb", "testuser", "testpass", server_function=True)
+        cur.fetchone.return_value = (10,)
+
+        self.assertTrue(await expense.add_transaction("testuser", datetime(2024, 1, 15), "収入", None, None, 0, "口座", 500))
+        self.assertEqual(cur.execute.await_count, 1)
+        self.assertEqual(cur.execute.await_args.args[0], _ADD_TRANSACTION_FUNCTION)
+
+    @patch("psycopg.AsyncConnection.connect", new_callable=AsyncMock)
+    async def test_cache(self, mock_connect: AsyncMock):
+        conn, cur = make_conn()
+        mock_connect.return_value = conn
+        expense = AsyncExpense("localhost", 5432, "testdb", "testuser", "testpass", cache=TTLCache())
+        # uid, 口座ID, 削除後の同名の確認
+        cur.fetchone.side_effect = [(1,), (2,), (0,)]
+
+        self.assertTrue(await expense.create_account("testuser", "口座"))
+        self.assertTrue(await expense.delete_account("testuser", "口座"))
+        # 2回目のユーザIDはキャッシュから取得する
+        self.assertEqual(cur.fetchone.await_count, 3)
+
+if __name__ == "__main__":
+    unittest.main()
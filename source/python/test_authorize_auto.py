@@ -1,6 +1,9 @@
+import time
 import unittest
 from unittest.mock import patch, MagicMock
 from authorize import Authorize
+from icon import IconCache
+from cache import TTLCache
 
 class TestAuthorize(unittest.TestCase):
 
@@ -76,6 +79,20 @@ class TestAuthorize(unittest.TestCase):
         result = self.auth.try_unlock_extend("testuser", 654321)
         self.assertTrue(100000 <= result <= 999999)
 
+    @patch("psycopg2.connect")
+    def test_logout(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.rowcount = 1
+        self.assertEqual(self.auth.logout("testuser", 222222), 0)
+        self.assertEqual(mock_cursor.execute.call_args.args[1], ("testuser", 222222))
+
+        mock_cursor.rowcount = 0
+        self.assertEqual(self.auth.logout("testuser", 222222), -2)
+
     @patch("psycopg2.connect")
     def test_get_feature_list_success(self, mock_connect: MagicMock):
         mock_conn = MagicMock()
@@ -93,5 +110,210 @@ class TestAuthorize(unittest.TestCase):
         self.assertEqual(result[0]["fname"], "Feature A")
         self.assertEqual(result[1]["icon_mime_type"], "image/png")
 
+class TestAuthorizeAtomic(unittest.TestCase):
+
+    def setUp(self):
+        self.auth = Authorize("localhost", 5432, "testdb", "testuser", "testpass", atomic=True)
+
+    @patch("psycopg2.connect")
+    def test_get_magic_number_single_statement(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.fetchone.return_value = (1,)
+
+        result = self.auth.get_magic_number("testuser")
+        self.assertTrue(100000 <= result <= 999999)
+        self.assertEqual(mock_cursor.execute.call_count, 1)
+
+    @patch("psycopg2.connect")
+    def test_try_unlock_invalid_hash_rolls_back(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.fetchone.return_value = (1, "password123")
+
+        result = self.auth.try_unlock("testuser", 123456, "wronghash")
+        self.assertEqual(result, -2)
+        mock_conn.rollback.assert_called_once()
+        mock_conn.commit.assert_not_called()
+
+    @patch("psycopg2.connect")
+    def test_try_unlock_success(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.fetchone.return_value = (1, "password123")
+
+        import zlib
+        magic = 123456
+        combined = f"password123{magic}"
+        pass_hash = format(zlib.crc32(combined.encode()) & 0xFFFFFFFF, '08x')
+
+        result = self.auth.try_unlock("testuser", magic, pass_hash)
+        self.assertTrue(100000 <= result <= 999999)
+        self.assertEqual(mock_cursor.execute.call_count, 1)
+
+    @patch("psycopg2.connect")
+    def test_try_unlock_extend_stale_sequence(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.fetchone.return_value = None
+
+        result = self.auth.try_unlock_extend("testuser", 654321)
+        self.assertEqual(result, -2)
+        self.assertEqual(mock_cursor.execute.call_count, 1)
+
+class TestAuthorizeExtendMany(unittest.TestCase):
+
+    def setUp(self):
+        self.auth = Authorize("localhost", 5432, "testdb", "testuser", "testpass")
+
+    @patch("authorize.execute_values")
+    @patch("psycopg2.connect")
+    def test_extend_many(self, mock_connect: MagicMock, mock_execute_values: MagicMock):
+        mock_conn = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+
+        mock_execute_values.return_value = [(1, "user1"), (3, "user3")]
+
+        result = self.auth.try_unlock_extend_many([("user1", 111111), ("user2", 222222), ("user3", 333333), ("user1", 111111)])
+        self.assertTrue(100000 <= result[0] <= 999999)
+        self.assertEqual(result[1], -2)
+        self.assertTrue(100000 <= result[2] <= 999999)
+        self.assertEqual(result[3], -2)
+
+        mock_execute_values.assert_called_once()
+        rows = mock_execute_values.call_args.args[2]
+        self.assertEqual([row[:2] for row in rows], [("user1", 111111), ("user2", 222222), ("user3", 333333)])
+        self.assertEqual(rows[0][2], result[0])
+        mock_conn.commit.assert_called_once()
+
+    @patch("authorize.execute_values")
+    @patch("psycopg2.connect")
+    def test_extend_many_error(self, mock_connect: MagicMock, mock_execute_values: MagicMock):
+        mock_execute_values.side_effect = Exception("down")
+
+        result = self.auth.try_unlock_extend_many([("user1", 111111), ("user2", 222222)])
+        self.assertEqual(result, [-9, -9])
+
+    def test_extend_many_empty(self):
+        self.assertEqual(self.auth.try_unlock_extend_many([]), [])
+
+class TestAuthorizeIcon(unittest.TestCase):
+
+    def setUp(self):
+        self.auth = Authorize("localhost", 5432, "testdb", "testuser", "testpass", icon_url="/portal/menu/api/icon/{}")
+
+    @patch("psycopg2.connect")
+    def test_get_feature_list_without_icon(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.fetchall.return_value = [
+            (1, "Feature A", "/feature/a", None, None),
+            (2, "Feature B", "/feature/b", "ab12", "image/png")
+        ]
+
+        result = self.auth.get_feature_list("testuser", with_icon=False)
+        self.assertNotIn("icon_data", mock_cursor.execute.call_args.args[0])
+        self.assertIsNone(result[0]["icon_url"])
+        self.assertIsNone(result[1]["icon_data"])
+        self.assertEqual(result[1]["icon_hash"], "ab12")
+        self.assertEqual(result[1]["icon_url"], "/portal/menu/api/icon/ab12")
+
+    @patch("psycopg2.connect")
+    def test_get_icon_cached(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.fetchone.return_value = (memoryview(b"icon"), "image/png")
+
+        data, mime = self.auth.get_icon("ab12")
+        self.assertEqual(bytes(data), b"icon")
+        self.assertEqual(mime, "image/png")
+
+        data2, _ = self.auth.get_icon("ab12")
+        self.assertEqual(mock_connect.call_count, 1)
+        self.assertIs(data.obj, data2.obj)
+
+    def test_icon_cache_eviction(self):
+        cache = IconCache(max_entries=2, max_bytes=10)
+        cache.put("a", b"1234", None)
+        cache.put("b", b"1234", None)
+        cache.get("a")
+        cache.put("c", b"1234", None)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("d", b"12345678", None)
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(cache.get("c"))
+
+class TestAuthorizeMenuCache(unittest.TestCase):
+
+    def setUp(self):
+        self.auth = Authorize("localhost", 5432, "testdb", "testuser", "testpass", menu_cache=TTLCache(ttl=60))
+
+    @patch("psycopg2.connect")
+    def test_cached_until_invalidated(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.fetchall.return_value = [(1, "Feature A", "/feature/a", None, None)]
+
+        self.assertEqual(self.auth.get_feature_list("user1")[0]["fname"], "Feature A")
+        self.auth.get_feature_list("user2")
+        result = self.auth.get_feature_list("user1")
+        result[0]["fname"] = "changed"
+        self.assertEqual(self.auth.get_feature_list("user1")[0]["fname"], "Feature A")
+        self.assertEqual(mock_cursor.execute.call_count, 2)
+
+        self.auth.invalidate_menu("user1")
+        self.auth.get_feature_list("user1")
+        self.auth.get_feature_list("user2")
+        self.assertEqual(mock_cursor.execute.call_count, 3)
+
+        self.auth.invalidate_menu("*")
+        self.auth.get_feature_list("user2")
+        self.assertEqual(mock_cursor.execute.call_count, 4)
+
+    @patch("psycopg2.connect")
+    def test_error_not_cached(self, mock_connect: MagicMock):
+        mock_connect.side_effect = Exception("down")
+        self.assertEqual(self.auth.get_feature_list("user1"), [])
+        mock_connect.side_effect = None
+        mock_connect.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value.fetchall.return_value = []
+        self.auth.get_feature_list("user1")
+        self.assertEqual(mock_connect.call_count, 2)
+
+    def test_stale_put_is_ignored(self):
+        cache = TTLCache(ttl=60)
+        generation = cache.generation()
+        cache.delete("user1")
+        self.assertFalse(cache.put("user1", [], generation))
+        self.assertIsNone(cache.get("user1"))
+
+    def test_ttl(self):
+        cache = TTLCache(ttl=0.01)
+        cache.put("user1", [])
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("user1"))
+
 if __name__ == "__main__":
     unittest.main()
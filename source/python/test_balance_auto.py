@@ -0,0 +1,104 @@
+import random
+import unittest
+from datetime import date, datetime
+from unittest.mock import patch, MagicMock
+
+from balance import TREE_WRITER, BalanceTree, month_index, prefix_nodes, update_nodes
+from expense import Expense
+
+
+class TestFenwick(unittest.TestCase):
+
+    def test_prefix_sum(self):
+        size = 64
+        rng = random.Random(1)
+        tree = {}
+        months = [0] * (size + 1)
+        for _ in range(500):
+            index = rng.randint(1, size)
+            delta = rng.randint(-1000, 1000)
+            months[index] += delta
+            for node in update_nodes(index, size):
+                tree[node] = tree.get(node, 0) + delta
+
+            query = rng.randint(0, size)
+            self.assertEqual(sum(tree.get(node, 0) for node in prefix_nodes(query)), sum(months[:query + 1]))
+
+    def test_node_count_is_logarithmic(self):
+        for index in range(1, 4097):
+            self.assertLessEqual(len(update_nodes(index)), 13)
+            self.assertLessEqual(len(prefix_nodes(index)), 12)
+
+    def test_month_index(self):
+        self.assertEqual(month_index(date(1970, 1, 31)), 1)
+        self.assertEqual(month_index(date(2024, 3, 1)), 54 * 12 + 3)
+        with self.assertRaises(ValueError):
+            month_index(date(1969, 12, 31))
+
+
+class TestBalanceTree(unittest.TestCase):
+
+    def test_add_aggregates_nodes(self):
+        cur = MagicMock()
+        BalanceTree().add(cur, [(1, date(1970, 1, 5), 100), (1, date(1970, 1, 20), -30), (2, date(1970, 2, 1), 0)])
+
+        cur.execute.assert_called_once()
+        aids, nodes, totals = cur.execute.call_args.args[1]
+        self.assertEqual(nodes, update_nodes(1))
+        self.assertEqual(set(aids), {1})
+        self.assertEqual(set(totals), {70})
+
+    def test_balance_at_reads_previous_months(self):
+        cur = MagicMock()
+        cur.fetchone.return_value = (1500,)
+
+        self.assertEqual(BalanceTree().balance_at(cur, 1, date(1970, 3, 10)), 1500)
+        params = cur.execute.call_args.args[1]
+        self.assertEqual(params[1], prefix_nodes(2))
+        self.assertEqual(params[3], date(1970, 3, 1))
+
+
+class TestExpenseBalanceTree(unittest.TestCase):
+
+    def setUp(self):
+        self.expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", balance_tree=True)
+
+    @patch("psycopg2.connect")
+    def test_add_transaction_does_not_rewrite_tail(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        # uid, 収入aid, tid, 残高
+        mock_cursor.fetchone.side_effect = [(1,), (2,), (10,), (1000,)]
+
+        self.assertTrue(self.expense.add_transaction("testuser", datetime(2024, 1, 16), "収入", None, None, 0, "口座", 500))
+        statements = [" ".join(c.args[0].split()) for c in mock_cursor.execute.call_args_list]
+        self.assertFalse(any("UPDATE expense.account_histories" in sql for sql in statements))
+        self.assertTrue(statements[4].startswith(f"{TREE_WRITER} INSERT INTO expense.account_histories"))
+        history = mock_cursor.execute.call_args_list[4].args[1]
+        self.assertEqual(history[3:], (1500, 500))
+        self.assertIn("account_balance_tree", statements[5])
+
+    @patch("psycopg2.connect")
+    def test_delete_transaction(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        # uid, 取引, 支払い方法
+        mock_cursor.fetchone.side_effect = [(1,), (10, 5, 2, 100, 500), (3, 15, 1, 10)]
+        mock_cursor.fetchall.return_value = [(3, date(2024, 2, 10), -100), (2, date(2024, 1, 16), 500)]
+
+        self.assertTrue(self.expense.delete_transaction("testuser", datetime(2024, 1, 16), 1))
+        statements = [" ".join(c.args[0].split()) for c in mock_cursor.execute.call_args_list]
+        self.assertTrue(statements[-2].startswith(f"{TREE_WRITER} UPDATE expense.account_histories"))
+        self.assertEqual(mock_cursor.execute.call_args_list[-2].args[1], ([10], date(2024, 1, 16), date(2024, 2, 10), [date(2024, 1, 16), date(2024, 2, 10)]))
+        aids, nodes, totals = mock_cursor.execute.call_args.args[1]
+        self.assertEqual(dict(zip(zip(aids, nodes), totals))[(3, month_index(date(2024, 2, 10)))], 100)
+        self.assertEqual(dict(zip(zip(aids, nodes), totals))[(2, month_index(date(2024, 1, 16)))], -500)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,582 @@
+import io
+import os
+import tempfile
+import unittest
+from datetime import datetime, date
+from unittest.mock import patch, MagicMock
+
+import psycopg2.extensions
+
+from cache import TTLCache
+from expense import Expense, TransactionRow, _copy_text, calc_payment_date
+from locks import ACCOUNT_LOCK_NAMESPACE, AccountLocks
+from pool import ConnectionPool
+
+
+def executed_sql(mock_cursor: MagicMock) -> list:
+    return [" ".join(c.args[0].split()) for c in mock_cursor.execute.call_args_list]
+
+
+class TestExpenseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", cache=TTLCache(ttl=60))
+
+    @patch("psycopg2.connect")
+    def test_add_transaction_uses_cache(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        # uid, 支払い方法, 収入aid, tid, 支出残額, 収入残額
+        mock_cursor.fetchone.side_effect = [(1,), (5, 3, 25, 1, 10), (2,), (10,), (0,), (1000,)]
+        self.assertTrue(self.expense.add_transaction("testuser", datetime(2024, 1, 15), "テスト", None, "カード", 100, "口座", 500))
+        self.assertEqual(len(executed_sql(mock_cursor)), 10)
+
+        mock_cursor.reset_mock()
+        # tid, 支出残額, 収入残額
+        mock_cursor.fetchone.side_effect = [(11,), (-100,), (1500,)]
+        self.assertTrue(self.expense.add_transaction("testuser", datetime(2024, 1, 16), "テスト", None, "カード", 100, "口座", 500))
+        statements = executed_sql(mock_cursor)
+        self.assertEqual(len(statements), 7)
+        self.assertFalse(any("FROM auth.users" in sql or "FROM expense.payments" in sql or "FROM expense.accounts" in sql for sql in statements))
+
+        # 後日払い: 2024/01/16 + 1ヶ月、10日
+        history = mock_cursor.execute.call_args_list[2].args[1]
+        self.assertEqual(history[1], date(2024, 2, 10))
+
+    @patch("psycopg2.connect")
+    def test_delete_payment_invalidates(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        # uid, 支払い方法, 同名件数
+        mock_cursor.fetchone.side_effect = [(1,), (5, 3, 0, 0, 0), (0,)]
+        self.assertTrue(self.expense.delete_payment("testuser", "現金"))
+
+        mock_cursor.reset_mock()
+        # 支払い方法（削除済みのため該当なし）
+        mock_cursor.fetchone.side_effect = [None]
+        self.assertFalse(self.expense.delete_payment("testuser", "現金"))
+        self.assertTrue(any("FROM expense.payments" in sql for sql in executed_sql(mock_cursor)))
+
+    @patch("psycopg2.connect")
+    def test_unknown_user_not_cached(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.fetchone.return_value = None
+        self.assertFalse(self.expense.create_account("unknown_user", "口座"))
+        self.assertFalse(self.expense.create_account("unknown_user", "口座"))
+        self.assertEqual(mock_cursor.execute.call_count, 2)
+
+
+class TestExpenseBalance(unittest.TestCase):
+
+    @patch("psycopg2.connect")
+    def test_get_balances(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = (1,)
+        mock_cursor.fetchall.return_value = [("口座", 1500), ("カード", -300)]
+
+        self.assertEqual(expense.get_balances("testuser", date(2024, 1, 31)), {"口座": 1500, "カード": -300})
+        statements = executed_sql(mock_cursor)
+        self.assertEqual(len(statements), 2)
+        self.assertIn("LEFT JOIN LATERAL", statements[1])
+        self.assertEqual(mock_cursor.execute.call_args.args[1], (date(2024, 1, 31), 1, None, None))
+
+    @patch("psycopg2.connect")
+    def test_get_balance_tree(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", balance_tree=True)
+        mock_cursor.fetchone.return_value = (1,)
+        mock_cursor.fetchall.return_value = [("口座", 1500)]
+
+        self.assertEqual(expense.get_balance("testuser", "口座", datetime(2024, 3, 10)), 1500)
+        params = mock_cursor.execute.call_args.args[1]
+        self.assertEqual(params[1:], (date(2024, 3, 1), date(2024, 3, 10), 1, "口座", "口座"))
+        self.assertIn("account_balance_tree", executed_sql(mock_cursor)[1])
+
+        mock_cursor.fetchall.return_value = []
+        self.assertIsNone(expense.get_balance("testuser", "なし", date(2024, 3, 10)))
+
+    @patch("psycopg2.connect")
+    def test_delete_transaction_with_deleted_payment(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        # uid, 取引, 支払い方法（削除済み）, 口座履歴
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.side_effect = [(1,), (10, 5, None, 100, 0), (3, 0, 0, 0), (date(2024, 1, 15), 2)]
+
+        self.assertTrue(expense.delete_transaction("testuser", datetime(2024, 1, 15), 1))
+        statements = executed_sql(mock_cursor)
+        # 支払い方法の取得で削除済みを除外しない（除外すると口座履歴と残高が取り消されない）
+        lookup = next(sql for sql in statements if "FROM expense.payments" in sql)
+        self.assertNotIn("deleted_at", lookup)
+        self.assertTrue(statements[-1].startswith("UPDATE expense.account_histories SET amount = amount + %s"))
+        self.assertEqual(mock_cursor.execute.call_args.args[1], (100, 3, date(2024, 1, 15), date(2024, 1, 15), 2))
+        mock_conn.commit.assert_called_once()
+
+    @patch("psycopg2.connect")
+    def test_unknown_user(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = None
+        self.assertIsNone(expense.get_balances("unknown_user", date(2024, 1, 31)))
+
+
+class TestExpenseBulk(unittest.TestCase):
+
+    def rows(self) -> list:
+        return [
+            TransactionRow(tdate=datetime(2024, 1, 15), purpose="昼食", memo="タブ\tあり", pname="カード", amount_spent=800, aname=None, amount_received=0),
+            TransactionRow(tdate=datetime(2024, 1, 15), purpose="給与", memo=None, pname=None, amount_spent=0, aname="口座", amount_received=200000),
+            TransactionRow(tdate=datetime(2024, 1, 20), purpose="振替", memo=None, pname="カード", amount_spent=500, aname="口座", amount_received=500),
+        ]
+
+    def copied(self, mock_cursor: MagicMock) -> list:
+        return [c.args[1].getvalue().splitlines() for c in mock_cursor.copy_expert.call_args_list]
+
+    @patch("psycopg2.connect")
+    def test_add_transactions_bulk(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", cache=TTLCache(ttl=60))
+        # uid, 支払い方法, 収入aid（以降はキャッシュ）
+        mock_cursor.fetchone.side_effect = [(1,), (5, 3, 25, 1, 10), (2,)]
+
+        self.assertTrue(expense.add_transactions_bulk("testuser", self.rows()))
+        transactions, histories = self.copied(mock_cursor)
+        self.assertEqual(transactions[0], "0\t2024-01-15\t昼食\tタブ\\tあり\t5\t800\t\\N\t0")
+        self.assertEqual(len(transactions), 3)
+        # 後日払い: 2024/01 + 1ヶ月、10日。同じ取引では支出 → 収入
+        self.assertEqual(histories, [
+            "0\t0\t3\t2024-02-10\t-800\t\\N",
+            "1\t0\t2\t2024-01-15\t200000\t\\N",
+            "2\t0\t3\t2024-02-10\t-500\t\\N",
+            "2\t1\t2\t2024-01-20\t500\t\\N",
+        ])
+
+        statements = executed_sql(mock_cursor)
+        self.assertEqual(len(statements), 8)
+        self.assertTrue(statements[-1].startswith("UPDATE expense.account_histories h"))
+        mock_conn.commit.assert_called_once()
+
+    @patch("psycopg2.connect")
+    def test_add_transactions_bulk_tree(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", balance_tree=True)
+        mock_cursor.fetchone.side_effect = [(1,), (2,), (5, 3, 25, 1, 10), (2,)]
+
+        self.assertTrue(expense.add_transactions_bulk("testuser", self.rows()[1:]))
+        histories = self.copied(mock_cursor)[1]
+        self.assertEqual(histories[0], "0\t0\t2\t2024-01-15\t200000\t{648,640,512}")
+
+        statements = executed_sql(mock_cursor)
+        self.assertIn("delta, is_deleted", statements[-2])
+        self.assertIn("account_balance_tree", statements[-1])
+        self.assertFalse(any(sql.startswith("UPDATE expense.account_histories") for sql in statements))
+
+    @patch("psycopg2.connect")
+    def test_add_transactions_bulk_counter(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", dorder_counter=True)
+        mock_cursor.fetchone.side_effect = [(1,), (5, 3, 25, 1, 10), (2,), (5, 3, 25, 1, 10), (2,)]
+
+        self.assertTrue(expense.add_transactions_bulk("testuser", self.rows()))
+        statements = executed_sql(mock_cursor)
+        self.assertTrue(statements[-4].startswith("WITH alloc AS ( INSERT INTO expense.transaction_dorders"))
+        self.assertTrue(statements[-2].startswith("WITH alloc AS ( INSERT INTO expense.account_history_dorders"))
+        self.assertFalse(any("max(dorder)" in sql or "max(h.dorder)" in sql for sql in statements))
+
+    def test_copy_text(self):
+        self.assertEqual(_copy_text((1, None, "a\\b\nc", [3, 2])), "1\t\\N\ta\\\\b\\nc\t{3,2}\n")
+
+
+class TestExpenseBulkDelete(unittest.TestCase):
+
+    @patch("psycopg2.connect")
+    def test_delete_transactions_bulk(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = (1,)
+        # 削除した取引（tid, 取引日, 支払い方法の closing_day, payment_offset_month, payment_day）
+        mock_cursor.fetchall.return_value = [(10, date(2024, 1, 15), None, None, None), (11, date(2024, 1, 15), 0, 0, 0)]
+
+        keys = [(datetime(2024, 1, 15), 1), (datetime(2024, 1, 15), 2), (datetime(2024, 1, 15), 1)]
+        self.assertTrue(expense.delete_transactions_bulk("testuser", keys))
+        statements = executed_sql(mock_cursor)
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(mock_cursor.execute.call_args_list[1].args[1], (1, date(2024, 1, 15), date(2024, 1, 15), [date(2024, 1, 15)] * 2, [1, 2]))
+        self.assertTrue(statements[2].startswith("WITH removed AS ( UPDATE expense.account_histories"))
+        self.assertEqual(mock_cursor.execute.call_args.args[1], ([10, 11], date(2024, 1, 15), date(2024, 1, 15), [date(2024, 1, 15)]))
+        mock_conn.commit.assert_called_once()
+
+    @patch("psycopg2.connect")
+    def test_missing_key_rolls_back(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = (1,)
+        mock_cursor.fetchall.return_value = [(10,)]
+
+        self.assertFalse(expense.delete_transactions_bulk("testuser", [(datetime(2024, 1, 15), 1), (datetime(2024, 1, 16), 1)]))
+        self.assertEqual(mock_cursor.execute.call_count, 2)
+        mock_conn.rollback.assert_called_once()
+        mock_conn.commit.assert_not_called()
+
+    @patch("psycopg2.connect")
+    def test_delete_transactions_bulk_tree(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", balance_tree=True)
+        mock_cursor.fetchone.return_value = (1,)
+        mock_cursor.fetchall.side_effect = [[(10, date(2024, 1, 15), None, None, None), (11, date(2024, 1, 20), 15, 1, 10)],
+                                            [(2, date(2024, 1, 15), 500), (2, date(2024, 1, 20), 300)]]
+
+        self.assertTrue(expense.delete_transactions_bulk("testuser", [(datetime(2024, 1, 15), 1), (datetime(2024, 1, 20), 1)]))
+        statements = executed_sql(mock_cursor)
+        self.assertEqual(len(statements), 4)
+        # 口座履歴は取引日と支出日のパーティションだけを読む
+        self.assertEqual(mock_cursor.execute.call_args_list[2].args[1], ([10, 11], date(2024, 1, 15), date(2024, 2, 10), [date(2024, 1, 15), date(2024, 1, 20), date(2024, 2, 10)]))
+        self.assertIn("account_balance_tree", statements[3])
+        self.assertEqual(set(mock_cursor.execute.call_args.args[1][2]), {-800})
+
+
+class TestExpenseListing(unittest.TestCase):
+
+    ROW = (date(2024, 1, 15), 2, "昼食", None, "カード", 800, None, 0)
+
+    @patch("psycopg2.connect")
+    def test_list_transactions(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = (1,)
+        mock_cursor.fetchall.return_value = [self.ROW]
+
+        result = expense.list_transactions("testuser", date(2024, 1, 1), date(2024, 1, 31), after=(date(2024, 1, 15), 1), limit=50)
+        self.assertEqual(result[0]["pname"], "カード")
+        self.assertEqual((result[0]["transaction_date"], result[0]["dorder"]), (date(2024, 1, 15), 2))
+        self.assertEqual(mock_cursor.execute.call_args.args[1], (1, date(2024, 1, 1), date(2024, 1, 31), date(2024, 1, 15), 1, 50))
+        self.assertNotIn("OFFSET", executed_sql(mock_cursor)[1])
+
+        expense.list_transactions("testuser", date(2024, 1, 1), date(2024, 1, 31))
+        self.assertEqual(mock_cursor.execute.call_args.args[1][3:5], (date(2024, 1, 1), 0))
+
+    @patch("psycopg2.connect")
+    def test_iter_transactions(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        named_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.side_effect = lambda name=None: MagicMock(__enter__=MagicMock(return_value=named_cursor if name else mock_cursor))
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = (1,)
+        named_cursor.__iter__.return_value = iter([self.ROW, self.ROW])
+
+        result = list(expense.iter_transactions("testuser", date(2024, 1, 1), date(2024, 12, 31), batch_size=500))
+        self.assertEqual(len(result), 2)
+        self.assertEqual(named_cursor.itersize, 500)
+        self.assertEqual(named_cursor.execute.call_args.args[1], (1, date(2024, 1, 1), date(2024, 12, 31)))
+
+        mock_cursor.fetchone.return_value = None
+        self.assertEqual(list(expense.iter_transactions("unknown_user", date(2024, 1, 1), date(2024, 12, 31))), [])
+
+    def test_iter_transactions_stopped_early(self):
+        mock_conn = MagicMock()
+        mock_conn.closed = 0
+        mock_conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        mock_cursor = MagicMock()
+        named = MagicMock()
+        named_cursor = named.__enter__.return_value
+        mock_conn.cursor.side_effect = lambda name=None: named if name else MagicMock(__enter__=MagicMock(return_value=mock_cursor))
+        mock_cursor.fetchone.return_value = (1,)
+        named_cursor.__iter__.side_effect = lambda: iter([self.ROW] * 3)
+        pool = ConnectionPool("", min_size=1, max_size=1, timeout=0.01, check=False, connect=lambda: mock_conn)
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", pool=pool)
+        # break（参照がなくなったジェネレータは閉じられる）
+        for _ in expense.iter_transactions("testuser", date(2024, 1, 1), date(2024, 12, 31)):
+            break
+        self.assertEqual(named.__exit__.call_count, 1)
+        self.assertEqual(pool.stats()["in_use"], 0)
+
+        # close()
+        rows = expense.iter_transactions("testuser", date(2024, 1, 1), date(2024, 12, 31))
+        next(rows)
+        self.assertEqual(pool.stats()["in_use"], 1)
+        rows.close()
+        self.assertEqual(named.__exit__.call_count, 2)
+        self.assertEqual(pool.stats()["in_use"], 0)
+        mock_conn.commit.assert_not_called()
+        self.assertEqual(len(list(expense.iter_transactions("testuser", date(2024, 1, 1), date(2024, 12, 31)))), 3)
+
+
+class TestExpenseMonthlySummary(unittest.TestCase):
+
+    @patch("psycopg2.connect")
+    def test_monthly_summary(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = (1,)
+        mock_cursor.fetchall.return_value = [(date(2024, 1, 1), "昼食", "カード", None, 2400, 0, 3)]
+
+        result = expense.monthly_summary("testuser", date(2024, 1, 15), date(2024, 3, 31))
+        self.assertEqual(result, [{"month": date(2024, 1, 1), "purpose": "昼食", "pname": "カード", "aname": None,
+                                   "spent": 2400, "received": 0, "count": 3}])
+        self.assertEqual(mock_cursor.execute.call_args.args[1], (1, date(2024, 1, 1), date(2024, 3, 1)))
+        self.assertIn("FROM expense.monthly_rollups", executed_sql(mock_cursor)[1])
+
+
+class TestExpenseExport(unittest.TestCase):
+
+    @patch("psycopg2.connect")
+    def test_export_csv(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = (1,)
+        mock_cursor.mogrify.return_value = b"SELECT 1"
+
+        out = io.StringIO()
+        self.assertTrue(expense.export_csv("testuser", "histories", date(2024, 1, 1), date(2024, 12, 31), out))
+        self.assertEqual(mock_cursor.mogrify.call_args.args[1], (1, date(2024, 1, 1), date(2024, 12, 31)))
+        self.assertIn("h.amount AS balance", " ".join(mock_cursor.mogrify.call_args.args[0].split()))
+        mock_cursor.copy_expert.assert_called_once_with("COPY (SELECT 1) TO STDOUT WITH (FORMAT csv, HEADER)", out)
+
+        self.assertFalse(expense.export_csv("testuser", "unknown", date(2024, 1, 1), date(2024, 12, 31), out))
+
+    @patch("psycopg2.connect")
+    def test_export_parquet(self, mock_connect: MagicMock):
+        import pyarrow.parquet as pq
+
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        named_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.side_effect = lambda name=None: MagicMock(__enter__=MagicMock(return_value=named_cursor if name else mock_cursor))
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = (1,)
+        row = (date(2024, 1, 15), 1, "昼食", None, "カード", 800, None, 0)
+        named_cursor.fetchmany.side_effect = [[row, row], [row], []]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "transactions.parquet")
+            self.assertTrue(expense.export_parquet("testuser", "transactions", date(2024, 1, 1), date(2024, 12, 31), path, batch_size=2))
+            table = pq.read_table(path)
+
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.column("purpose").to_pylist(), ["昼食"] * 3)
+        self.assertEqual(table.column("transaction_date").to_pylist()[0], date(2024, 1, 15))
+        named_cursor.fetchmany.assert_called_with(2)
+
+
+class TestExpenseSession(unittest.TestCase):
+
+    @patch("psycopg2.connect")
+    def test_one_connection_one_commit(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = (1,)
+
+        with expense.session("testuser") as s:
+            self.assertEqual(s.uid, 1)
+            self.assertTrue(s.create_account("口座1"))
+            self.assertTrue(s.create_account("口座2"))
+
+        mock_connect.assert_called_once()
+        mock_connect.return_value.__exit__.assert_called_once_with(None, None, None)
+        mock_conn.commit.assert_not_called()
+        mock_conn.close.assert_called_once()
+        statements = executed_sql(mock_cursor)
+        self.assertEqual(sum("FROM auth.users" in sql for sql in statements), 1)
+        self.assertEqual(statements.count("SAVEPOINT expense_session"), 2)
+        self.assertEqual(statements.count("RELEASE SAVEPOINT expense_session"), 2)
+        self.assertEqual((s.operations, s.commits), (2, 1))
+
+        with self.assertRaises(RuntimeError):
+            s.create_account("口座3")
+
+    @patch("psycopg2.connect")
+    def test_failed_operation_rolls_back_to_savepoint(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        mock_cursor.fetchone.return_value = (1,)
+
+        def execute(sql, params=None):
+            if params is not None and params[-1] == "口座1":
+                raise Exception("unique violation")
+        mock_cursor.execute.side_effect = execute
+
+        with expense.session("testuser", commit_every=1) as s:
+            self.assertFalse(s.create_account("口座1"))
+            self.assertTrue(s.create_account("口座2"))
+
+        statements = executed_sql(mock_cursor)
+        self.assertIn("ROLLBACK TO SAVEPOINT expense_session", statements)
+        self.assertEqual(mock_conn.commit.call_count, 1)
+        self.assertEqual((s.operations, s.commits), (1, 2))
+
+    @patch("psycopg2.connect")
+    def test_cache_put_deferred_until_commit(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        cache = TTLCache()
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", cache=cache)
+        mock_cursor.fetchone.return_value = (7,)
+        key = ("aid", 7, "口座")
+
+        # 成功した操作の値は commit まで登録しない（セッション内では再利用する）
+        with expense.session("testuser") as s:
+            with s._operation():
+                self.assertEqual(expense._get_aid(mock_cursor, 7, "口座"), 7)
+            with s._operation():
+                self.assertEqual(expense._get_aid(mock_cursor, 7, "口座"), 7)
+            self.assertIsNone(cache.get(key))
+        self.assertEqual(sum("FROM expense.accounts" in sql for sql in executed_sql(mock_cursor)), 1)
+        self.assertEqual(cache.get(key), 7)
+
+        # 取り消した操作、rollback したセッションの値は登録しない
+        cache.clear()
+        with self.assertRaises(RuntimeError):
+            with expense.session("testuser") as s:
+                with self.assertRaises(RuntimeError):
+                    with s._operation():
+                        expense._get_aid(mock_cursor, 7, "口座")
+                        raise RuntimeError("rollback")
+                s.commit()
+                self.assertIsNone(cache.get(key))
+                with s._operation():
+                    expense._get_aid(mock_cursor, 7, "口座2")
+                raise RuntimeError("rollback")
+        self.assertIsNone(cache.get(key))
+        self.assertIsNone(cache.get(("aid", 7, "口座2")))
+
+        # 無効化は commit 時にも行う
+        with expense.session("testuser") as s:
+            with s._operation():
+                expense._invalidate(key)
+            cache.put(key, 7)
+        self.assertIsNone(cache.get(key))
+
+    def test_unknown_operation(self):
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        with self.assertRaises(AttributeError):
+            expense.session("testuser").iter_transactions
+
+
+class TestExpenseServerFunction(unittest.TestCase):
+
+    @patch("psycopg2.connect")
+    def test_add_transaction_round_trips(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        # 従来: uid, 支払い方法, 収入aid, tid, 支出残額, 収入残額
+        mock_cursor.fetchone.side_effect = [(1,), (5, 3, 25, 1, 10), (2,), (10,), (0,), (1000,)]
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass")
+        self.assertTrue(expense.add_transaction("testuser", datetime(2024, 1, 15), "テスト", None, "カード", 100, "口座", 500))
+        self.assertEqual(mock_cursor.execute.call_count + mock_conn.commit.call_count, 11)
+
+        mock_cursor.reset_mock()
+        mock_conn.reset_mock()
+        mock_cursor.fetchone.side_effect = [(10,)]
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", server_function=True, locks=AccountLocks())
+        self.assertTrue(expense.add_transaction("testuser", datetime(2024, 1, 15), "テスト", None, "カード", 100, "口座", 500))
+        self.assertEqual(mock_cursor.execute.call_count + mock_conn.commit.call_count, 2)
+        self.assertEqual(mock_cursor.execute.call_args.args[1],
+                         ("testuser", date(2024, 1, 15), "テスト", None, "カード", 100, "口座", 500, ACCOUNT_LOCK_NAMESPACE))
+
+    @patch("psycopg2.connect")
+    def test_unknown_user(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.fetchone.return_value = (None,)
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", server_function=True)
+        self.assertFalse(expense.add_transaction("unknown_user", datetime(2024, 1, 15), "テスト", None, None, 0, "口座", 500))
+        self.assertIsNone(mock_cursor.execute.call_args.args[1][-1])
+        mock_conn.commit.assert_not_called()
+
+
+class TestCalcPaymentDate(unittest.TestCase):
+
+    def test_immediate(self):
+        self.assertEqual(calc_payment_date(date(2024, 1, 31), 0, 0, 0), date(2024, 1, 31))
+
+    def test_deferred_month_end(self):
+        self.assertEqual(calc_payment_date(date(2024, 1, 31), 25, 1, 31), date(2024, 2, 29))
+        self.assertEqual(calc_payment_date(date(2024, 11, 15), 15, 2, 10), date(2025, 1, 10))
+        self.assertEqual(calc_payment_date(date(2024, 1, 15), 15, -1, 31), date(2023, 12, 31))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+
+from expense import Expense
+from locks import ACCOUNT_LOCK_NAMESPACE, AccountLocks
+
+
+class TestAccountLocks(unittest.TestCase):
+
+    def test_sorted_and_unique(self):
+        cur = MagicMock()
+        cur.fetchone.return_value = (True,)
+        locks = AccountLocks()
+
+        locks.lock(cur, [5, None, 2, 5])
+        self.assertEqual([c.args[1] for c in cur.execute.call_args_list], [(ACCOUNT_LOCK_NAMESPACE, 2), (ACCOUNT_LOCK_NAMESPACE, 5)])
+        self.assertTrue(all("pg_try_advisory_xact_lock" in c.args[0] for c in cur.execute.call_args_list))
+        stats = locks.stats()
+        self.assertEqual((stats["acquired"], stats["contended"]), (2, 0))
+
+    def test_contended(self):
+        cur = MagicMock()
+        cur.fetchone.side_effect = [(False,), (True,)]
+        locks = AccountLocks()
+
+        locks.lock(cur, [3, 1])
+        statements = [c.args[0] for c in cur.execute.call_args_list]
+        self.assertEqual(len(statements), 3)
+        self.assertIn("pg_advisory_xact_lock", statements[1])
+        self.assertEqual(cur.execute.call_args_list[1].args[1], (ACCOUNT_LOCK_NAMESPACE, 1))
+        stats = locks.stats()
+        self.assertEqual((stats["acquired"], stats["contended"], stats["by_account"]), (2, 1, {1: 1}))
+        self.assertGreaterEqual(stats["wait_time_max"], 0.0)
+
+
+class TestExpenseLocks(unittest.TestCase):
+
+    @patch("psycopg2.connect")
+    def test_add_transaction_locks_before_write(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", locks=AccountLocks())
+        # uid, 支払い方法, 収入aid, ロック(aid=2), ロック(aid=3), tid, 支出残額, 収入残額
+        mock_cursor.fetchone.side_effect = [(1,), (5, 3, 0, 0, 0), (2,), (True,), (True,), (10,), (0,), (1000,)]
+
+        self.assertTrue(expense.add_transaction("testuser", datetime(2024, 1, 15), "振替", None, "現金", 100, "口座", 100))
+        statements = [c.args[0] for c in mock_cursor.execute.call_args_list]
+        self.assertIn("pg_try_advisory_xact_lock", statements[3])
+        self.assertEqual(mock_cursor.execute.call_args_list[3].args[1][1], 2)
+        self.assertEqual(mock_cursor.execute.call_args_list[4].args[1][1], 3)
+        self.assertIn("INSERT INTO expense.transactions", statements[5])
+
+    @patch("psycopg2.connect")
+    def test_delete_transaction_locks_history_accounts(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", locks=AccountLocks(), balance_tree=True)
+        mock_cursor.fetchone.side_effect = [(1,), (10, None, 2, 0, 500), (True,)]
+        mock_cursor.fetchall.side_effect = [[(2,)], []]
+
+        self.assertTrue(expense.delete_transaction("testuser", datetime(2024, 1, 15), 1))
+        statements = [" ".join(c.args[0].split()) for c in mock_cursor.execute.call_args_list]
+        self.assertTrue(statements[2].startswith("SELECT DISTINCT aid FROM expense.account_histories"))
+        self.assertIn("pg_try_advisory_xact_lock", statements[3])
+        self.assertTrue(statements[4].startswith("UPDATE expense.transactions"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+from unittest.mock import MagicMock
+
+import partition
+
+_CATALOG = [
+    ("transactions", "expense.transactions_default", "DEFAULT"),
+    ("transactions", "expense.transactions_2025", "FOR VALUES FROM ('2025-01-01') TO ('2026-01-01')"),
+    ("account_histories", "expense.account_histories_2024", "FOR VALUES FROM ('2024-01-01') TO ('2025-01-01')"),
+    ("transactions", "expense.transactions_2024", "FOR VALUES FROM ('2024-01-01') TO ('2025-01-01')"),
+    ("account_histories", "expense.account_histories_2025", "FOR VALUES FROM ('2025-01-01') TO ('2026-01-01')"),
+    ("account_histories", "expense.account_histories_default", "DEFAULT"),
+]
+
+
+class TestPartition(unittest.TestCase):
+
+    def test_list_partitions(self):
+        cur = MagicMock()
+        cur.fetchall.return_value = _CATALOG
+
+        partitions = partition.list_partitions(cur)
+        self.assertEqual([(p["name"], p["year"]) for p in partitions], [
+            ("expense.account_histories_2024", 2024),
+            ("expense.account_histories_2025", 2025),
+            ("expense.account_histories_default", None),
+            ("expense.transactions_2024", 2024),
+            ("expense.transactions_2025", 2025),
+            ("expense.transactions_default", None),
+        ])
+        self.assertEqual(cur.execute.call_args.args[1], ("expense", ["transactions", "account_histories"]))
+
+    def test_create_partitions(self):
+        cur = MagicMock()
+        # 運用中、退避先（transactions）、退避先（account_histories）
+        cur.fetchall.side_effect = [_CATALOG, [], []]
+
+        created = partition.create_partitions(cur, 2026)
+        self.assertEqual(created, ["expense.transactions_2026", "expense.account_histories_2026"])
+        statements = [" ".join(c.args[0].split()) for c in cur.execute.call_args_list]
+        self.assertTrue(statements[2].startswith("CREATE TABLE expense.transactions_2026 (LIKE expense.transactions"))
+        self.assertIn("DELETE FROM expense.transactions_default WHERE transaction_date >= %s", statements[3])
+        self.assertEqual(cur.execute.call_args_list[3].args[1], ("2026-01-01", "2027-01-01"))
+        self.assertIn("ATTACH PARTITION expense.transactions_2026", statements[4])
+
+    def test_create_partitions_not_partitioned(self):
+        cur = MagicMock()
+        cur.fetchall.return_value = []
+        with self.assertRaises(ValueError):
+            partition.create_partitions(cur, 2026)
+
+    def test_archive_partitions(self):
+        cur = MagicMock()
+        # 運用中（口座履歴）、運用中（取引）、退避先（以前に退避した取引）
+        cur.fetchall.side_effect = [_CATALOG, _CATALOG, [
+            ("transactions", "expense_archive.transactions_2023", "FOR VALUES FROM ('2023-01-01') TO ('2024-01-01')"),
+        ]]
+
+        # 口座履歴は 2025 年より前、取引はさらに1年前まで
+        archived = partition.archive_partitions(cur, 2025)
+        self.assertEqual(archived, ["expense.account_histories_2024"])
+        statements = [" ".join(c.args[0].split()) for c in cur.execute.call_args_list]
+        self.assertIn("DETACH PARTITION expense.account_histories_2024", statements[1])
+        self.assertIn("SET SCHEMA expense_archive", statements[2])
+        self.assertIn("ATTACH PARTITION expense_archive.account_histories_2024", statements[3])
+        self.assertIn("INSERT INTO expense.account_histories SELECT * FROM kept", statements[4])
+        self.assertEqual(cur.execute.call_args_list[4].args[1], ("2025-01-01", "2024-01-01"))
+        self.assertFalse(any("DETACH PARTITION expense.transactions" in s for s in statements))
+
+        # 運用中の口座履歴から参照されている取引は、既定のパーティションへ戻す
+        self.assertIn("DELETE FROM expense_archive.transactions a WHERE a.tid IN", statements[-1])
+        self.assertIn("INSERT INTO expense.transactions_default SELECT * FROM kept", statements[-1])
+        self.assertEqual(cur.execute.call_args.args[1], ([2023],))
+
+    def test_compact(self):
+        cur = MagicMock()
+        cur.fetchone.return_value = ("expense.transaction_dorders", "expense.account_history_dorders")
+        cur.rowcount = 3
+
+        self.assertEqual(partition.compact(cur, "transactions", "expense.transactions_2024"), 3)
+        sql = " ".join(cur.execute.call_args.args[0].split())
+        self.assertIn("DELETE FROM expense.transactions_2024 p", sql)
+        self.assertIn("h.tid = p.tid AND h.is_deleted = FALSE", sql)
+        self.assertIn("INSERT INTO expense_archive.deleted_transactions", sql)
+
+        partition.compact(cur, "account_histories", "expense.account_histories_2024")
+        sql = " ".join(cur.execute.call_args.args[0].split())
+        self.assertNotIn("h.tid", sql)
+        self.assertIn("INSERT INTO expense_archive.deleted_account_histories", sql)
+
+    def test_compact_requires_dorder_counter(self):
+        cur = MagicMock()
+        cur.fetchone.return_value = (None, None)
+
+        with self.assertRaises(ValueError):
+            partition.compact(cur, "account_histories", "expense.account_histories_2024")
+        self.assertEqual(cur.execute.call_count, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+from datetime import date, timedelta
+
+import numpy as np
+
+from expense import calc_payment_date
+from payment_schedule import payment_dates, to_dates
+
+
+class TestPaymentDates(unittest.TestCase):
+
+    def test_matches_scalar(self):
+        # 閏年・月末を含む期間
+        days = [date(2023, 12, 1) + timedelta(days=i) for i in range(800)]
+        for closing_day in (0, 1, 15, 25, 31):
+            for offset in (-13, -1, 0, 1, 2, 12, 25):
+                for payment_day in (1, 10, 28, 29, 30, 31):
+                    expected = [calc_payment_date(d, closing_day, offset, payment_day) for d in days]
+                    self.assertEqual(to_dates(payment_dates(days, closing_day, offset, payment_day)), expected,
+                                     (closing_day, offset, payment_day))
+
+    def test_per_row_methods(self):
+        days = [date(2024, 1, 31), date(2024, 1, 31), date(2024, 12, 31)]
+        result = payment_dates(days, [0, 25, 10], [0, 1, 2], [0, 31, 30])
+        self.assertEqual(to_dates(result), [date(2024, 1, 31), date(2024, 2, 29), date(2025, 2, 28)])
+        self.assertEqual(result.dtype, np.dtype("datetime64[D]"))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            payment_dates([date(2024, 1, 1)], 25, 1, 0)
+        with self.assertRaises(ValueError):
+            payment_dates([date(2399, 12, 1)], 25, 1, 10)
+        # 当日払いは支払い日・暦テーブルの範囲を見ない
+        self.assertEqual(to_dates(payment_dates([date(2399, 12, 1)], 0, 1, 0)), [date(2399, 12, 1)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import psycopg2.extensions
+
+from authorize import Authorize
+from pool import ConnectionPool, PoolTimeout
+
+
+def make_conn():
+    conn = MagicMock()
+    conn.closed = 0
+    conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    return conn
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse_connection(self):
+        factory = MagicMock(side_effect=make_conn)
+        pool = ConnectionPool("", min_size=0, max_size=2, connect=factory)
+
+        with pool.connection() as c1:
+            pass
+        with pool.connection() as c2:
+            pass
+
+        self.assertIs(c1, c2)
+        self.assertEqual(factory.call_count, 1)
+        c1.commit.assert_called()
+
+    def test_rollback_on_error(self):
+        pool = ConnectionPool("", min_size=1, max_size=1, connect=make_conn)
+
+        with self.assertRaises(RuntimeError):
+            with pool.connection() as conn:
+                raise RuntimeError("boom")
+
+        conn.rollback.assert_called()
+        self.assertEqual(pool.stats()["idle"], 1)
+
+    def test_generator_close_returns_connection(self):
+        pool = ConnectionPool("", min_size=1, max_size=1, timeout=0.01, connect=make_conn)
+
+        def rows():
+            with pool.connection() as conn:
+                yield conn
+                yield conn
+
+        gen = rows()
+        conn = next(gen)
+        self.assertEqual(pool.stats()["in_use"], 1)
+        gen.close()
+
+        conn.rollback.assert_called()
+        conn.commit.assert_not_called()
+        self.assertEqual((pool.stats()["in_use"], pool.stats()["idle"]), (0, 1))
+        with pool.connection() as conn2:
+            pass
+        self.assertIs(conn, conn2)
+
+    def test_health_check_discards_broken_connection(self):
+        factory = MagicMock(side_effect=make_conn)
+        pool = ConnectionPool("", min_size=1, max_size=1, check_idle=0.0, connect=factory)
+
+        with pool.connection() as conn:
+            pass
+        conn.cursor.return_value.__enter__.return_value.execute.side_effect = psycopg2.OperationalError()
+
+        with pool.connection() as conn2:
+            pass
+
+        self.assertIsNot(conn, conn2)
+        self.assertEqual(pool.stats()["discarded"], 1)
+
+    def test_health_check_only_after_idle(self):
+        pool = ConnectionPool("", min_size=1, max_size=1, check_idle=0.05, connect=make_conn)
+
+        with pool.connection() as conn:
+            pass
+        cur = conn.cursor.return_value.__enter__.return_value
+        cur.execute.reset_mock()
+
+        # 返却直後の接続は確認しない
+        with pool.connection():
+            pass
+        cur.execute.assert_not_called()
+
+        time.sleep(0.06)
+        with pool.connection():
+            pass
+        cur.execute.assert_called_once_with("SELECT 1")
+
+    def test_eviction_closes_outside_lock(self):
+        pool = ConnectionPool("", min_size=0, max_size=2, max_idle=0.01, connect=make_conn)
+        locked = []
+
+        conns = [pool.getconn() for _ in range(2)]
+        for conn in conns:
+            conn.close.side_effect = lambda: locked.append(pool._cond._is_owned())
+            pool.putconn(conn)
+        time.sleep(0.02)
+        pool.putconn(pool.getconn())
+
+        self.assertEqual(locked, [False, False])
+        self.assertEqual(pool.stats()["discarded"], 2)
+
+    def test_max_lifetime(self):
+        factory = MagicMock(side_effect=make_conn)
+        pool = ConnectionPool("", min_size=0, max_size=1, max_lifetime=0.01, connect=factory)
+
+        with pool.connection() as c1:
+            pass
+        time.sleep(0.02)
+        with pool.connection() as c2:
+            pass
+
+        self.assertIsNot(c1, c2)
+        c1.close.assert_called()
+
+    def test_idle_eviction_keeps_min_size(self):
+        pool = ConnectionPool("", min_size=1, max_size=3, max_idle=0.01, connect=make_conn)
+
+        conns = [pool.getconn() for _ in range(3)]
+        for conn in conns:
+            pool.putconn(conn)
+        time.sleep(0.02)
+        conn = pool.getconn()
+        pool.putconn(conn)
+
+        self.assertEqual(pool.stats()["size"], 1)
+
+    def test_timeout_and_wait_stats(self):
+        pool = ConnectionPool("", min_size=0, max_size=1, timeout=0.05, connect=make_conn)
+
+        conn = pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+
+        stats = pool.stats()
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["utilisation"], 1.0)
+
+        threading.Timer(0.02, pool.putconn, (conn,)).start()
+        pool._timeout = 1.0
+        conn2 = pool.getconn()
+        self.assertIs(conn, conn2)
+        self.assertEqual(pool.stats()["waits"], 1)
+        self.assertGreater(pool.stats()["wait_time_max"], 0.0)
+
+    def test_authorize_uses_pool(self):
+        conn = make_conn()
+        cur = conn.cursor.return_value.__enter__.return_value
+        cur.fetchone.return_value = (1,)
+        cur.rowcount = 1
+        pool = ConnectionPool("", min_size=0, max_size=1, check=False, connect=lambda: conn)
+        auth = Authorize("localhost", 5432, "testdb", "testuser", "testpass", pool=pool)
+
+        with patch("psycopg2.connect") as mock_connect:
+            result = auth.get_magic_number("testuser")
+
+        self.assertTrue(100000 <= result <= 999999)
+        mock_connect.assert_not_called()
+        self.assertEqual(pool.stats()["in_use"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
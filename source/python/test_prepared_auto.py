@@ -0,0 +1,107 @@
+import gc
+import unittest
+from unittest.mock import MagicMock
+
+from authorize import Authorize
+from expense import Expense
+from pool import ConnectionPool
+from prepared import PreparedStatements, to_placeholders
+
+
+def connection():
+    conn = MagicMock()
+    conn.closed = 0
+    cur = MagicMock()
+    cur.connection = conn
+    conn.cursor.return_value.__enter__.return_value = cur
+    return conn, cur
+
+
+class TestPreparedStatements(unittest.TestCase):
+
+    def test_to_placeholders(self):
+        self.assertEqual(to_placeholders("SELECT %s, '100%%' WHERE a = %s"), "SELECT $1, '100%' WHERE a = $2")
+
+    def test_prepare_once_per_connection(self):
+        prepared = PreparedStatements()
+        conn1, cur1 = connection()
+        conn2, cur2 = connection()
+        sql = "SELECT uid FROM auth.users WHERE uname = %s"
+
+        prepared.execute(cur1, "uid", sql, ("a",))
+        prepared.execute(cur1, "uid", sql, ("b",))
+        prepared.execute(cur2, "uid", sql, ("c",))
+
+        self.assertEqual([c.args for c in cur1.execute.call_args_list], [
+            ("PREPARE uid AS SELECT uid FROM auth.users WHERE uname = $1",),
+            ("EXECUTE uid (%s)", ("a",)),
+            ("EXECUTE uid (%s)", ("b",)),
+        ])
+        self.assertEqual(cur2.execute.call_args_list[0].args[0], "PREPARE uid AS SELECT uid FROM auth.users WHERE uname = $1")
+        self.assertEqual(prepared.stats(), {"hits": 1, "misses": 2, "connections": 2, "statements": 1})
+
+    def test_closed_connection_is_forgotten(self):
+        prepared = PreparedStatements()
+        conn1, cur1 = connection()
+        conn2, cur2 = connection()
+
+        prepared.execute(cur1, "one", "SELECT 1")
+        conn1.closed = 1
+        prepared.execute(cur2, "one", "SELECT 1")
+        self.assertEqual(prepared.stats()["connections"], 1)
+        self.assertEqual(cur2.execute.call_args_list[-1].args, ("EXECUTE one",))
+
+    def test_released_connection_is_forgotten(self):
+        prepared = PreparedStatements()
+        conn, cur = connection()
+
+        prepared.execute(cur, "one", "SELECT 1")
+        self.assertEqual(prepared.stats()["connections"], 1)
+        del conn, cur
+        gc.collect()
+        self.assertEqual(prepared.stats()["connections"], 0)
+
+    def test_invalid_registration(self):
+        prepared = PreparedStatements()
+        _, cur = connection()
+
+        prepared.execute(cur, "one", "SELECT 1")
+        with self.assertRaises(ValueError):
+            prepared.execute(cur, "one", "SELECT 2")
+        with self.assertRaises(ValueError):
+            prepared.execute(cur, "bad name; DROP", "SELECT 1")
+
+
+class TestSharedPrepared(unittest.TestCase):
+
+    def test_authorize_and_expense_share_pooled_connection(self):
+        conn, cur = connection()
+        conn.get_transaction_status.return_value = 0
+        pool = ConnectionPool("", min_size=0, max_size=1, check=False, connect=lambda: conn)
+        prepared = PreparedStatements()
+        auth = Authorize("localhost", 5432, "testdb", "testuser", "testpass", pool=pool, prepared=prepared)
+        expense = Expense("localhost", 5432, "testdb", "testuser", "testpass", pool=pool, prepared=prepared)
+
+        cur.fetchone.return_value = (1,)
+        cur.rowcount = 1
+        self.assertTrue(100000 <= auth.try_unlock_extend("testuser", 123456) <= 999999)
+        self.assertTrue(100000 <= auth.try_unlock_extend("testuser", 123456) <= 999999)
+        self.assertTrue(expense.create_account("testuser", "口座"))
+
+        statements = [c.args[0] for c in cur.execute.call_args_list]
+        self.assertEqual(sum(s.startswith("PREPARE auth_extend_") for s in statements), 2)
+        self.assertIn("EXECUTE auth_extend_select (%s, %s)", statements)
+        self.assertIn("PREPARE expense_uid AS SELECT uid FROM auth.users WHERE uname = $1", statements)
+        stats = prepared.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["connections"]), (2, 3, 1))
+
+    def test_requires_pool(self):
+        prepared = PreparedStatements()
+        with self.assertRaises(ValueError):
+            Authorize("localhost", 5432, "testdb", "testuser", "testpass", prepared=prepared)
+        with self.assertRaises(ValueError):
+            Expense("localhost", 5432, "testdb", "testuser", "testpass", prepared=prepared)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import warnings
+
+sys.dont_write_bytecode = True
+warnings.filterwarnings('ignore')
+
+import os
+import re
+import unittest
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import psycopg2
+
+import authorize
+import expense
+import partition
+from prepared import to_placeholders
+
+# 実行計画の検証（頻繁に実行する文が順次走査（Seq Scan）にならないこと）
+#
+# test_environment/make_table.sql、make_table2.sql、make_index.sql を適用したDBの接続文字列を
+# 環境変数 QUERY_PLAN_DSN に指定して実行する（未指定時はスキップ）。
+# 試験データは1トランザクションで投入して ANALYZE し、終了時に rollback する（DBには残らない）。
+# さらに make_bulk_dorder.sql、make_partition.sql を適用したDBでは、パーティションの絞り込みも検証する
+# （試験データの前後の年のパーティションを作り、対象の年以外を読まないこと。PREPARE した文の汎用プランも同様）。
+#
+#   QUERY_PLAN_DSN="host=127.0.0.1 port=5432 dbname=dbportal user=pusr password=pppp" python -m pytest -q test_query_plan.py
+DSN: str = os.environ.get("QUERY_PLAN_DSN", "")
+
+# 試験データの件数
+USERS: int = 2000               # ユーザ数（それぞれ口座2件・支払い方法1件と削除済みの支払い方法 DELETED_PAYMENTS 件）
+DELETED_PAYMENTS: int = 4
+TRANSACTIONS_PER_USER: int = 10
+
+# 順次走査を許さない表
+TABLES = {"users", "accounts", "payments", "transactions", "account_histories"}
+
+# 試験データの年（取引日・支払日はすべてこの年）と、パーティション分割時に前後に作る年
+YEAR: int = 2024
+PARTITION_YEARS: Tuple[int, int] = (YEAR - 1, YEAR + 1)
+
+# パーティションの絞り込みを検証する文（名前 → 読んでよい年の範囲。None は制限なし（既定のパーティションも読む））
+PRUNED: Dict[str, Tuple[Optional[int], Optional[int]]] = {
+    "残高取得": (None, YEAR),
+    "以降の残高の更新": (YEAR, None),
+    "取引取得": (YEAR, YEAR),
+    "取引の削除マーク": (YEAR, YEAR),
+    "取引の口座履歴": (YEAR, YEAR),
+    "取引の口座履歴の削除マーク": (YEAR, YEAR),
+    "削除位置以降の残高の更新": (YEAR, None),
+    "取引の口座（ロック）": (YEAR, YEAR),
+    "取引一覧": (YEAR, YEAR),
+    "一括削除の取引": (YEAR, YEAR),
+}
+
+# 取引・口座履歴のパーティション名
+PARTITION_NAME = re.compile(r"^(transactions|account_histories)_(\d{4}|default)$")
+
+
+def seq_scans(plan: Dict[str, Any]) -> Iterator[str]:
+    """
+    実行計画（EXPLAIN (FORMAT JSON)）の中の、TABLES の表の順次走査
+    """
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in TABLES:
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from seq_scans(child)
+
+
+def partitions(plan: Dict[str, Any]) -> Iterator[str]:
+    """
+    実行計画の中の、取引・口座履歴のパーティション
+    """
+    if PARTITION_NAME.match(plan.get("Relation Name", "")):
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from partitions(child)
+
+
+@unittest.skipUnless(DSN, "QUERY_PLAN_DSN が未指定")
+class TestQueryPlan(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.conn = psycopg2.connect(DSN)
+        cls.cur = cls.conn.cursor()
+        cur = cls.cur
+
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'expense.transactions'::regclass)")
+        cls.partitioned = cur.fetchone()[0]
+
+        cur.execute("""
+            INSERT INTO auth.users (uname, upass, sequence_number)
+            SELECT 'plan_user_' || i, 'x', i FROM generate_series(1, %s) i
+        """, (USERS,))
+        cur.execute("""
+            INSERT INTO expense.accounts (uid, account_name, is_deleted)
+            SELECT u.uid, '口座' || k, FALSE
+            FROM auth.users u CROSS JOIN generate_series(1, 2) k
+            WHERE u.uname LIKE 'plan_user_%%'
+        """)
+        cur.execute("""
+            INSERT INTO expense.payments (uid, payment_name, closing_day, payment_offset_month, payment_day, aid)
+            SELECT a.uid, '現金', 0, 0, 0, a.aid
+            FROM expense.accounts a JOIN auth.users u ON u.uid = a.uid
+            WHERE u.uname LIKE 'plan_user_%%' AND a.account_name = '口座1'
+        """)
+        # 削除済みの支払い方法（支払い方法の表が小さすぎると、取引一覧の結合が順次走査になるため）
+        cur.execute("""
+            INSERT INTO expense.payments (uid, payment_name, closing_day, payment_offset_month, payment_day, aid, deleted_at)
+            SELECT p.uid, '現金(削除済み' || k || ')', 0, 0, 0, p.aid, DATE '2023-12-31'
+            FROM expense.payments p CROSS JOIN generate_series(1, %s) k
+            JOIN auth.users u ON u.uid = p.uid
+            WHERE u.uname LIKE 'plan_user_%%'
+        """, (DELETED_PAYMENTS,))
+        cur.execute("""
+            INSERT INTO expense.transactions (uid, transaction_date, purpose, pid, amount_spent, is_deleted)
+            SELECT p.uid, DATE '2024-01-01' + (n * 37 + p.uid) %% 366, '食費', p.pid, 100, FALSE
+            FROM expense.payments p CROSS JOIN generate_series(1, %s) n
+            JOIN auth.users u ON u.uid = p.uid
+            WHERE u.uname LIKE 'plan_user_%%' AND p.deleted_at IS NULL
+        """, (TRANSACTIONS_PER_USER,))
+        cur.execute("""
+            INSERT INTO expense.account_histories (aid, payment_date, tid, amount, is_deleted)
+            SELECT p.aid, t.transaction_date, t.tid, -100, FALSE
+            FROM expense.transactions t
+            JOIN expense.payments p ON p.pid = t.pid
+            JOIN auth.users u ON u.uid = t.uid
+            WHERE u.uname LIKE 'plan_user_%%'
+        """)
+        # 削除済みの行（部分索引の対象外）
+        cur.execute("UPDATE expense.transactions SET is_deleted = TRUE WHERE tid % 3 = 0")
+        cur.execute("UPDATE expense.account_histories SET is_deleted = TRUE WHERE tid % 3 = 0")
+        if cls.partitioned:
+            # 既定のパーティションに入った行を、年のパーティションへ移す
+            partition.create_partitions(cur, PARTITION_YEARS[1], PARTITION_YEARS[0])
+        for table in ("auth.users", "expense.accounts", "expense.payments", "expense.transactions", "expense.account_histories"):
+            cur.execute(f"ANALYZE {table}")
+
+        cur.execute("""
+            SELECT u.uid, a.aid, t.tid, t.transaction_date, t.dorder
+            FROM auth.users u
+            JOIN expense.accounts a ON a.uid = u.uid AND a.account_name = '口座1'
+            JOIN expense.transactions t ON t.uid = u.uid AND t.is_deleted = FALSE
+            WHERE u.uname = 'plan_user_1'
+            ORDER BY t.tid
+            LIMIT 1
+        """)
+        cls.uid, cls.aid, cls.tid, cls.tdate, cls.dorder = cur.fetchone()
+        cur.execute("SELECT pid FROM expense.payments WHERE uid = %s AND deleted_at IS NULL", (cls.uid,))
+        cls.pid = cur.fetchone()[0]
+
+        # 一括追加の一時テーブル（add_transactions_bulk と同じ。数件の取引）
+        cur.execute(expense._BULK_TABLES)
+        cur.execute("""
+            INSERT INTO bulk_transactions (seq, transaction_date, purpose, pid, amount_spent, amount_received, dorder, tid)
+            SELECT n, DATE '2024-06-01' + n, '食費', %s, 100, 0, n, NULL FROM generate_series(0, 4) n
+        """, (cls.pid,))
+        cur.execute("""
+            INSERT INTO bulk_histories (seq, side, aid, payment_date, delta)
+            SELECT n, 0, %s, DATE '2024-06-01' + n, -100 FROM generate_series(0, 4) n
+        """, (cls.aid,))
+        cur.execute("ANALYZE bulk_transactions")
+        cur.execute("ANALYZE bulk_histories")
+        return
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.rollback()
+        cls.conn.close()
+        return
+
+    def statements(self) -> List[Tuple[str, str, Tuple[Any, ...]]]:
+        """
+        検証する文（名前, 文, パラメータ）。Expense / Authorize が実行する文そのもの
+        """
+        uname, uid, aid, pid, tid, tdate, dorder = "plan_user_1", self.uid, self.aid, self.pid, self.tid, self.tdate, self.dorder
+        return [
+            ("ユーザID取得", expense._SELECT_UID, (uname,)),
+            ("認証延長", authorize._EXTEND_SELECT, (uname, 1)),
+            ("認証延長の更新", authorize._EXTEND_UPDATE, (2, None, uid)),
+            ("認証延長（1文版）", authorize._EXTEND_ATOMIC, (2, None, uname, 1)),
+            ("口座ID取得", expense._SELECT_AID, (uid, "口座1")),
+            ("支払い方法取得", expense._SELECT_PAYMENT, (uid, "現金")),
+            ("残高取得", expense._BALANCE_PROBE, (aid, tdate)),
+            ("以降の残高の更新", expense._SHIFT_LATER_BALANCES, (-100, aid, tdate)),
+            ("取引取得", expense._SELECT_TRANSACTION, (uid, tdate, dorder)),
+            ("取引の削除マーク", expense._DELETE_TRANSACTION, (tid, tdate)),
+            ("取引の支払い方法", expense._SELECT_TRANSACTION_PAYMENT, (uid, pid)),
+            ("取引の口座履歴", expense._SELECT_TRANSACTION_HISTORY, (aid, tid, tdate)),
+            ("取引の口座履歴の削除マーク", expense._DELETE_TRANSACTION_HISTORY, (aid, tid, tdate)),
+            ("削除位置以降の残高の更新", expense._SHIFT_BALANCES_AFTER, (100, aid, tdate, tdate, dorder)),
+            ("取引の口座（ロック）", expense._SELECT_TRANSACTION_ACCOUNTS, ([tid], tdate, tdate, [tdate])),
+            ("取引一覧", expense._LIST_TRANSACTIONS, (uid, date(2024, 1, 1), date(2024, 12, 31), date(2024, 1, 1), 0, 100)),
+            ("残高一覧", expense._SELECT_BALANCES, (tdate, uid, None, None)),
+            ("一括追加の取引の dorder", expense._BULK_TRANSACTION_DORDERS, (uid,)),
+            ("一括追加の取引の追加", expense._BULK_INSERT_TRANSACTIONS, (uid,)),
+            ("一括追加の口座履歴の追加", expense._bulk_histories_sql(False, False), ()),
+            ("一括追加の以降の残高の更新", expense._BULK_SHIFT_LATER_BALANCES, ()),
+            ("一括削除の取引", expense._BULK_DELETE_TRANSACTIONS, (uid, tdate, tdate, [tdate], [dorder])),
+            ("一括削除の口座履歴", expense._BULK_DELETE_HISTORIES, ([tid], tdate, tdate, [tdate])),
+        ]
+
+    def test_no_seq_scan(self):
+        for name, sql, params in self.statements():
+            with self.subTest(name):
+                self.cur.execute("EXPLAIN (FORMAT JSON) " + sql, params or None)
+                plan = self.cur.fetchone()[0][0]["Plan"]
+                self.assertEqual(list(seq_scans(plan)), [], f"{name}: {plan}")
+
+    def test_partition_pruning(self):
+        if not self.partitioned:
+            self.skipTest("パーティション分割されていない（make_partition.sql 未適用）")
+        self.assertEqual(self.tdate.year, YEAR)
+
+        for name, sql, params in self.statements():
+            if name not in PRUNED:
+                continue
+            low, high = PRUNED[name]
+            # 汎用プランは、PREPARE した文（prepared 指定時）を実行時のパラメータで絞り込めること
+            for mode in ("force_custom_plan", "force_generic_plan"):
+                with self.subTest(name, plan_cache_mode=mode):
+                    self.cur.execute(f"SET plan_cache_mode = {mode}")
+                    self.cur.execute(f"PREPARE plan_check AS {to_placeholders(sql)}")
+                    try:
+                        self.cur.execute(f"EXPLAIN (FORMAT JSON) EXECUTE plan_check ({', '.join(['%s'] * len(params))})", params)
+                        plan = self.cur.fetchone()[0][0]["Plan"]
+                    finally:
+                        self.cur.execute("DEALLOCATE plan_check")
+                        self.cur.execute("RESET plan_cache_mode")
+
+                    read: Set[str] = set(partitions(plan))
+                    self.assertTrue(read, f"{name}: {plan}")
+                    for relation in read:
+                        suffix = relation.rsplit("_", 1)[1]
+                        if suffix == "default":
+                            allowed = low is None or high is None
+                        else:
+                            allowed = (low is None or int(suffix) >= low) and (high is None or int(suffix) <= high)
+                        self.assertTrue(allowed, f"{name}: {relation} を読んでいる")
+
+
+if __name__ == '__main__':
+    unittest.main()
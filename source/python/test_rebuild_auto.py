@@ -0,0 +1,84 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from unittest.mock import call, patch, MagicMock
+
+import rebuild
+from balance import month_index, update_nodes
+
+
+class TestVerify(unittest.TestCase):
+
+    def test_verify_accounts(self):
+        cur = MagicMock()
+        cur.fetchall.return_value = [(1, 10, 0, 0), (2, 5, 3, 1)]
+
+        reports = rebuild.verify_accounts(cur, [1, 2, 3])
+        self.assertEqual([r["aid"] for r in reports], [1, 2, 3])
+        self.assertEqual((reports[1]["rows"], reports[1]["mismatched"], reports[1]["orphaned"]), (5, 3, 1))
+        self.assertEqual(reports[2]["rows"], 0)
+        self.assertEqual([rebuild._diverged(r) for r in reports], [False, True, False])
+        self.assertIn("amount <> balance", cur.execute.call_args.args[0])
+
+    def test_tree_diff(self):
+        cur = MagicMock()
+        payment_date = date(2024, 1, 15)
+        nodes = update_nodes(month_index(payment_date))
+        cur.fetchall.side_effect = [
+            [(1, payment_date, 500), (1, payment_date, -200)],
+            [(1, node, 300) for node in nodes[:-1]] + [(1, nodes[-1], 999), (1, 1, 0)],
+        ]
+        self.assertEqual(rebuild._tree_diff(cur, [1]), {1: 1})
+
+    def test_verify_archived(self):
+        cur = MagicMock()
+        cur.fetchall.return_value = [(1, 10, 0, 0)]
+
+        rebuild.verify_accounts(cur, [1], archived=True)
+        sql = cur.execute.call_args.args[0]
+        self.assertIn("expense_archive.account_histories", sql)
+        self.assertIn("expense_archive.transactions", sql)
+        self.assertIn("WHERE NOT archived", sql)
+
+
+class TestRun(unittest.TestCase):
+
+    @patch("rebuild.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("psycopg2.connect")
+    def test_verify_only(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = (False,)
+        mock_cursor.fetchall.return_value = [(1, 10, 0, 0), (2, 5, 1, 0)]
+
+        reports = rebuild.run("dsn", [1, 2], verify_only=True, workers=2)
+        self.assertEqual([(r["aid"], r["fixed"]) for r in reports], [(2, False)])
+        self.assertFalse(any(c.args[0].lstrip().startswith("WITH") and "UPDATE" in c.args[0] for c in mock_cursor.execute.call_args_list))
+        mock_conn.commit.assert_not_called()
+
+    @patch("rebuild.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("psycopg2.connect")
+    def test_rebuild(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        # 退避先なし、ロック
+        mock_cursor.fetchone.side_effect = [(False,), (True,)]
+        # 全口座の検証、ロック後の再検証
+        mock_cursor.fetchall.side_effect = [[(1, 10, 0, 0), (2, 5, 1, 1)], [(2, 5, 1, 1)]]
+
+        reports = rebuild.run("dsn", [1, 2], workers=1, lock_namespace=7)
+        self.assertEqual([(r["aid"], r["fixed"]) for r in reports], [(2, True)])
+        statements = [" ".join(c.args[0].split()) for c in mock_cursor.execute.call_args_list]
+        # 指定した名前空間でロックする
+        self.assertIn(call("SELECT pg_try_advisory_xact_lock(%s, %s)", (7, 2)), mock_cursor.execute.call_args_list)
+        self.assertTrue(statements[-1].endswith("AND (h.amount <> e.balance)"))
+        self.assertEqual(mock_cursor.execute.call_args.args[1], ([2],))
+        mock_conn.commit.assert_called_once()
+        mock_conn.close.assert_called_once()
+
+if __name__ == "__main__":
+    unittest.main()
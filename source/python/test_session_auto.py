@@ -0,0 +1,208 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+import zlib
+from unittest.mock import patch, MagicMock
+
+from authorize import Authorize
+from session import MemorySessionStore, SessionStore, SharedMemorySessionStore
+
+
+def extend_in_child(name, lock_dir, sequence, new_sequence, result):
+    store = SharedMemorySessionStore(name, lock_dir=lock_dir)
+    result.put(store.extend("testuser", sequence, new_sequence))
+    store.close()
+
+
+class TestSessionStore(unittest.TestCase):
+
+    def test_incomplete_store(self):
+        class IncompleteStore(SessionStore):
+            def set_magic(self, user, uid, magic):
+                return
+
+        # 未実装のメソッドがあれば、呼び出し時ではなく生成時に失敗する
+        with self.assertRaises(TypeError):
+            IncompleteStore()
+
+
+class TestMemorySessionStore(unittest.TestCase):
+
+    def make_store(self):
+        return MemorySessionStore()
+
+    def test_handshake(self):
+        store = self.make_store()
+
+        store.set_magic("testuser", 7, 123456)
+        self.assertTrue(store.has_magic("testuser", 123456))
+        self.assertFalse(store.has_magic("testuser", 111111))
+        self.assertIsNone(store.unlock("testuser", 111111, 222222))
+        self.assertEqual(store.unlock("testuser", 123456, 222222), 7)
+        self.assertFalse(store.has_magic("testuser", 123456))
+
+        self.assertEqual(store.extend("testuser", 222222, 333333), 7)
+        self.assertIsNone(store.extend("testuser", 222222, 444444))
+        self.assertIsNone(store.extend("unknown_user", 333333, 444444))
+
+    def test_new_magic_clears_sequence(self):
+        store = self.make_store()
+
+        store.set_magic("testuser", 7, 123456)
+        store.unlock("testuser", 123456, 222222)
+        store.set_magic("testuser", 7, 654321)
+        self.assertIsNone(store.extend("testuser", 222222, 333333))
+
+    def test_remove(self):
+        store = self.make_store()
+
+        store.set_magic("testuser", 7, 123456)
+        store.unlock("testuser", 123456, 222222)
+        self.assertFalse(store.remove("testuser", 111111))
+        self.assertTrue(store.remove("testuser", 222222))
+        self.assertIsNone(store.extend("testuser", 222222, 333333))
+        self.assertFalse(store.remove("testuser", 222222))
+
+
+class TestSharedMemorySessionStore(TestMemorySessionStore):
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.name = f"auth_sessions_test_{os.getpid()}"
+        self.stores = []
+
+    def tearDown(self):
+        if self.stores:
+            self.stores[0].unlink()
+        for store in self.stores:
+            store.close()
+
+    def make_store(self, ttl=86400.0):
+        store = SharedMemorySessionStore(self.name, slots=8, lock_dir=self.lock_dir, ttl=ttl)
+        self.stores.append(store)
+        return store
+
+    def test_shared_between_processes(self):
+        store = self.make_store()
+        store.set_magic("testuser", 7, 123456)
+        store.unlock("testuser", 123456, 222222)
+
+        result = multiprocessing.Queue()
+        child = multiprocessing.Process(target=extend_in_child, args=(self.name, self.lock_dir, 222222, 333333, result))
+        child.start()
+        child.join()
+
+        self.assertEqual(result.get(), 7)
+        self.assertEqual(store.extend("testuser", 333333, 444444), 7)
+
+    def test_full(self):
+        store = self.make_store()
+        for i in range(8):
+            store.set_magic(f"user{i}", i, 100000 + i)
+        with self.assertRaises(RuntimeError):
+            store.set_magic("user8", 8, 100008)
+        self.assertTrue(store.has_magic("user3", 100003))
+
+    def test_remove_reuses_slot(self):
+        store = self.make_store()
+        for i in range(8):
+            store.set_magic(f"user{i}", i, 100000 + i)
+            store.unlock(f"user{i}", 100000 + i, 200000 + i)
+        self.assertTrue(store.remove("user3", 200003))
+
+        # 削除したスロットの先に続く探索で、他のユーザは引き続き見つかる
+        for i in range(8):
+            if i != 3:
+                self.assertEqual(store.extend(f"user{i}", 200000 + i, 300000 + i), i)
+        store.set_magic("user8", 8, 100008)
+        self.assertTrue(store.has_magic("user8", 100008))
+        with self.assertRaises(RuntimeError):
+            store.set_magic("user9", 9, 100009)
+
+    def test_expired_slots_are_reused(self):
+        store = self.make_store(ttl=60.0)
+        with patch("session.time.time", return_value=1000.0):
+            for i in range(8):
+                store.set_magic(f"user{i}", i, 100000 + i)
+
+        # 期限切れの後は、スロット数を超えて新しいユーザが登録できる
+        with patch("session.time.time", return_value=1061.0):
+            self.assertFalse(store.has_magic("user0", 100000))
+            for i in range(8, 16):
+                store.set_magic(f"user{i}", i, 100000 + i)
+            for i in range(8, 16):
+                self.assertTrue(store.has_magic(f"user{i}", 100000 + i))
+            # 有効なセッションで埋まれば、再び空きはない
+            with self.assertRaises(RuntimeError):
+                store.set_magic("user0", 0, 100000)
+
+    def test_extend_refreshes_expiry(self):
+        store = self.make_store(ttl=60.0)
+        with patch("session.time.time", return_value=1000.0):
+            store.set_magic("testuser", 7, 123456)
+            store.unlock("testuser", 123456, 222222)
+        with patch("session.time.time", return_value=1050.0):
+            self.assertEqual(store.extend("testuser", 222222, 333333), 7)
+        with patch("session.time.time", return_value=1100.0):
+            self.assertEqual(store.extend("testuser", 333333, 444444), 7)
+        with patch("session.time.time", return_value=1161.0):
+            self.assertIsNone(store.extend("testuser", 444444, 555555))
+
+
+class TestAuthorizeWithSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemorySessionStore()
+        self.auth = Authorize("localhost", 5432, "testdb", "testuser", "testpass", session_store=self.store)
+
+    @patch("psycopg2.connect")
+    def test_handshake(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        mock_cursor.fetchone.return_value = (1, False)
+        magic = self.auth.get_magic_number("testuser")
+        self.assertTrue(100000 <= magic <= 999999)
+
+        mock_cursor.fetchone.return_value = (1, "password123")
+        self.assertEqual(self.auth.try_unlock("testuser", magic, "wronghash"), -2)
+        self.assertEqual(self.auth.try_unlock("testuser", magic + 1, "wronghash"), -1)
+
+        pass_hash = format(zlib.crc32(f"password123{magic}".encode()) & 0xFFFFFFFF, '08x')
+        sequence = self.auth.try_unlock("testuser", magic, pass_hash)
+        self.assertTrue(100000 <= sequence <= 999999)
+        self.assertEqual(self.auth.try_unlock("testuser", magic, pass_hash), -1)
+
+        mock_connect.reset_mock()
+        extended = self.auth.try_unlock_extend("testuser", sequence)
+        self.assertTrue(100000 <= extended <= 999999)
+        self.assertEqual(self.auth.try_unlock_extend("testuser", sequence), -2)
+
+        self.assertEqual(self.auth.logout("testuser", sequence), -2)
+        self.assertEqual(self.auth.logout("testuser", extended), 0)
+        self.assertEqual(self.auth.try_unlock_extend("testuser", extended), -2)
+        mock_connect.assert_not_called()
+
+    @patch("psycopg2.connect")
+    def test_stale_columns_cleared(self, mock_connect: MagicMock):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+        # 切り替え前の magic_number / sequence_number が残っている
+        mock_cursor.fetchone.return_value = (1, True)
+        self.assertTrue(100000 <= self.auth.get_magic_number("testuser") <= 999999)
+        sql = " ".join(mock_cursor.execute.call_args.args[0].split())
+        self.assertEqual(sql, "UPDATE auth.users SET magic_number = NULL, sequence_number = NULL WHERE uid = %s")
+
+        mock_cursor.reset_mock()
+        mock_cursor.fetchone.return_value = (1, False)
+        self.auth.get_magic_number("testuser")
+        self.assertEqual(mock_cursor.execute.call_count, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+--- 取引追加のサーバ側関数（Expense(server_function=True)）
+--- Expense.add_transaction と同じ処理を1回の呼び出しで行う（往復: 約11回 → 2回（呼び出し + commit））
+---
+--- 戻り値: 追加した取引の tid。ユーザが存在しない場合は NULL
+--- p_lock_namespace: NULL 以外の場合、口座をその値を第1キーとする advisory lock で口座IDの昇順にロックする（locks.AccountLocks と同じ）
+
+create or replace function expense.add_transaction(
+    p_uname           TEXT,
+    p_tdate           DATE,
+    p_purpose         TEXT,
+    p_memo            TEXT,
+    p_pname           TEXT,
+    p_amount_spent    INTEGER,
+    p_aname           TEXT,
+    p_amount_received INTEGER,
+    p_lock_namespace  INTEGER DEFAULT NULL
+)
+returns integer as $$
+declare
+  v_uid          integer;
+  v_pid          integer;
+  v_expense_aid  integer;
+  v_closing_day  integer;
+  v_offset       integer;
+  v_payment_day  integer;
+  v_income_aid   integer;
+  v_aid          integer;
+  v_tid          integer;
+  v_payment_date date;
+  v_month        date;
+  v_balance      integer;
+begin
+  -- ユーザIDを取得
+  select uid into v_uid from auth.users where uname = p_uname;
+  if v_uid is null then
+    return null;
+  end if;
+
+  -- 支出pidを取得
+  if p_pname is not null then
+    select pid, aid, closing_day, payment_offset_month, payment_day
+      into v_pid, v_expense_aid, v_closing_day, v_offset, v_payment_day
+      from expense.payments
+     where uid = v_uid and payment_name = p_pname and deleted_at is null;
+  end if;
+
+  -- 収入aidを取得
+  if p_aname is not null then
+    select aid into v_income_aid
+      from expense.accounts
+     where uid = v_uid and account_name = p_aname and is_deleted = false;
+  end if;
+
+  -- 口座をロック
+  if p_lock_namespace is not null then
+    foreach v_aid in array coalesce((
+        select array_agg(distinct a order by a)
+          from unnest(array[v_expense_aid, v_income_aid]) a
+         where a is not null), '{}') loop
+      perform pg_advisory_xact_lock(p_lock_namespace, v_aid);
+    end loop;
+  end if;
+
+  -- 取引を追加
+  insert into expense.transactions (uid, transaction_date, purpose, memo, pid, amount_spent, aid, amount_received, is_deleted)
+  values (v_uid, p_tdate, p_purpose, p_memo, v_pid, p_amount_spent, v_income_aid, p_amount_received, false)
+  returning tid into v_tid;
+
+  -- 支出の処理
+  if v_pid is not null then
+    -- 支出日を決定（calc_payment_date と同じ）
+    if v_closing_day = 0 then
+      v_payment_date := p_tdate;
+    else
+      v_month := (date_trunc('month', p_tdate) + make_interval(months => v_offset))::date;
+      v_payment_date := v_month + (least(v_payment_day, extract(day from (v_month + interval '1 month' - interval '1 day'))::integer) - 1);
+    end if;
+
+    select amount into v_balance
+      from expense.account_histories
+     where aid = v_expense_aid and is_deleted = false and payment_date <= v_payment_date
+     order by payment_date desc, dorder desc
+     limit 1;
+
+    insert into expense.account_histories (aid, payment_date, tid, amount, is_deleted)
+    values (v_expense_aid, v_payment_date, v_tid, coalesce(v_balance, 0) - p_amount_spent, false);
+
+    update expense.account_histories
+       set amount = amount - p_amount_spent
+     where aid = v_expense_aid and is_deleted = false and payment_date > v_payment_date;
+  end if;
+
+  -- 収入の処理
+  if v_income_aid is not null then
+    select amount into v_balance
+      from expense.account_histories
+     where aid = v_income_aid and is_deleted = false and payment_date <= p_tdate
+     order by payment_date desc, dorder desc
+     limit 1;
+
+    insert into expense.account_histories (aid, payment_date, tid, amount, is_deleted)
+    values (v_income_aid, p_tdate, v_tid, coalesce(v_balance, 0) + p_amount_received, false);
+
+    update expense.account_histories
+       set amount = amount + p_amount_received
+     where aid = v_income_aid and is_deleted = false and payment_date > p_tdate;
+  end if;
+
+  return v_tid;
+end;
+$$ LANGUAGE plpgsql;
+
+
+
+---
+drop function expense.add_transaction;
@@ -0,0 +1,64 @@
+--- 残高の差分管理（Expense(balance_tree=True)、balance.BalanceTree）
+--- 月番号: (年 - 1970) * 12 + 月（1970年1月 = 1、上限 4096）
+
+--- 口座履歴毎の増減
+alter table expense.account_histories
+    add column delta INTEGER NOT NULL DEFAULT 0; -- この履歴による残高の増減
+
+update expense.account_histories h
+set delta = d.delta
+from (
+    select hid, amount - coalesce(lag(amount) over (partition by aid order by payment_date, dorder), 0) as delta
+    from expense.account_histories
+    where is_deleted = FALSE
+) d
+where h.hid = d.hid;
+
+--- 月毎の増減の合計（Fenwick木）
+create table expense.account_balance_tree (
+    aid          INTEGER                      NOT NULL,
+    node         INTEGER                      NOT NULL, -- Fenwick木のノード番号（月番号）
+    total        BIGINT                       NOT NULL DEFAULT 0,
+    FOREIGN KEY (aid) REFERENCES expense.accounts(aid),
+    PRIMARY KEY (aid, node)
+);
+
+insert into expense.account_balance_tree (aid, node, total)
+with recursive months as (
+    select aid,
+           (extract(year from payment_date)::int - 1970) * 12 + extract(month from payment_date)::int as node,
+           sum(delta) as total
+    from expense.account_histories
+    where is_deleted = FALSE
+    group by 1, 2
+), walk(aid, node, total) as (
+    select aid, node, total from months
+    union all
+    select aid, node + (node & -node), total from walk where node + (node & -node) <= 4096
+)
+select aid, node, sum(total) from walk group by aid, node;
+
+--- 以降、amount は残高ではなく delta と木が正となるため、balance_tree 以外の書き込み
+--- （Expense(balance_tree=False)、AsyncExpense、expense.add_transaction 関数、rebuild.py の --balance-tree なし）を拒否する。
+--- balance_tree の書き込みは、トランザクション内で expense.balance_tree = on を設定してから行う（balance.TREE_WRITER）
+create or replace function expense.require_balance_tree()
+returns trigger as $$
+begin
+  if coalesce(current_setting('expense.balance_tree', true), '') <> 'on' then
+    raise exception 'expense.account_histories は balance_tree で運用しています（Expense(balance_tree=True) で書き込んでください）';
+  end if;
+  return null;
+end;
+$$ LANGUAGE plpgsql;
+
+create trigger trg_require_balance_tree
+before insert or update on expense.account_histories
+for each statement execute function expense.require_balance_tree();
+
+
+
+---
+drop trigger trg_require_balance_tree on expense.account_histories;
+drop function expense.require_balance_tree;
+drop table expense.account_balance_tree;
+alter table expense.account_histories drop column delta;
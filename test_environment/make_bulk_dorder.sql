@@ -0,0 +1,30 @@
+--- 一括取引追加（Expense.add_transactions_bulk）
+--- dorder を指定して INSERT した場合は、トリガーで上書きしない
+
+create or replace function expense.set_transactions_dorder()
+returns trigger as $$
+begin
+  if NEW.dorder is null then
+    NEW.dorder := (
+        select coalesce(max(dorder), 0) + 1
+        from expense.transactions
+        where uid = NEW.uid and transaction_date = NEW.transaction_date
+    );
+  end if;
+  return NEW;
+end;
+$$ LANGUAGE plpgsql;
+
+create or replace function expense.set_account_histories_dorder()
+returns trigger as $$
+begin
+  if NEW.dorder is null then
+    NEW.dorder := (
+        select coalesce(max(dorder), 0) + 1
+        from expense.account_histories
+        where aid = NEW.aid and payment_date = NEW.payment_date
+    );
+  end if;
+  return NEW;
+end;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,75 @@
+--- dorder の採番を max(dorder)+1 から採番テーブルに変更する（Expense(dorder_counter=True)）
+--- 採番テーブルの行ロックで、同じ日付への同時追加も一意制約違反にならずに順に採番される
+--- make_bulk_dorder.sql の適用後に適用する
+
+create table expense.transaction_dorders (
+    uid              INTEGER                      NOT NULL,
+    transaction_date DATE                         NOT NULL,
+    last_dorder      INTEGER                      NOT NULL, -- 採番済みの最大値
+    PRIMARY KEY (uid, transaction_date)
+);
+
+create table expense.account_history_dorders (
+    aid              INTEGER                      NOT NULL,
+    payment_date     DATE                         NOT NULL,
+    last_dorder      INTEGER                      NOT NULL, -- 採番済みの最大値
+    PRIMARY KEY (aid, payment_date)
+);
+
+insert into expense.transaction_dorders (uid, transaction_date, last_dorder)
+select uid, transaction_date, max(dorder)
+from expense.transactions
+group by uid, transaction_date;
+
+insert into expense.account_history_dorders (aid, payment_date, last_dorder)
+select aid, payment_date, max(dorder)
+from expense.account_histories
+group by aid, payment_date;
+
+--- dorder 未指定時は採番する。指定時は採番済みの最大値をそれに合わせる
+create or replace function expense.set_transactions_dorder()
+returns trigger as $$
+begin
+  if NEW.dorder is null then
+    insert into expense.transaction_dorders as c (uid, transaction_date, last_dorder)
+    values (NEW.uid, NEW.transaction_date, 1)
+    on conflict (uid, transaction_date) do update
+    set last_dorder = c.last_dorder + 1
+    returning last_dorder into NEW.dorder;
+  else
+    insert into expense.transaction_dorders as c (uid, transaction_date, last_dorder)
+    values (NEW.uid, NEW.transaction_date, NEW.dorder)
+    on conflict (uid, transaction_date) do update
+    set last_dorder = excluded.last_dorder
+    where c.last_dorder < excluded.last_dorder;
+  end if;
+  return NEW;
+end;
+$$ LANGUAGE plpgsql;
+
+create or replace function expense.set_account_histories_dorder()
+returns trigger as $$
+begin
+  if NEW.dorder is null then
+    insert into expense.account_history_dorders as c (aid, payment_date, last_dorder)
+    values (NEW.aid, NEW.payment_date, 1)
+    on conflict (aid, payment_date) do update
+    set last_dorder = c.last_dorder + 1
+    returning last_dorder into NEW.dorder;
+  else
+    insert into expense.account_history_dorders as c (aid, payment_date, last_dorder)
+    values (NEW.aid, NEW.payment_date, NEW.dorder)
+    on conflict (aid, payment_date) do update
+    set last_dorder = excluded.last_dorder
+    where c.last_dorder < excluded.last_dorder;
+  end if;
+  return NEW;
+end;
+$$ LANGUAGE plpgsql;
+
+
+
+---
+--- トリガー関数は make_bulk_dorder.sql を再適用して戻す
+drop table expense.transaction_dorders;
+drop table expense.account_history_dorders;
@@ -0,0 +1,5 @@
+--- 機能一覧をアイコン画像なしで取得するための列（Authorize.get_feature_list(with_icon=False)、get_icon）
+alter table auth.features
+    add column icon_hash TEXT generated always as (encode(sha256(icon_data), 'hex')) stored; -- アイコン内容のハッシュ値
+
+create index features_icon_hash_idx on auth.features (icon_hash) where icon_hash is not null;
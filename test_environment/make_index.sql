@@ -0,0 +1,25 @@
+--- 頻繁に実行する文のための索引（検証: source/python/test_query_plan.py）
+--- いずれも削除されていない行（is_deleted = FALSE）のみの部分索引
+---
+--- 既存の UNIQUE 制約の索引で足りるもの（追加しない）
+---   auth.users (uname)                                        ユーザID取得、認証の各ステップ
+---   expense.accounts (uid, account_name)                      口座ID取得、get_balances の口座一覧
+---   expense.payments (uid, payment_name)                      支払い方法の取得
+---   expense.transactions (uid, transaction_date, dorder)      delete_transaction の取引取得、list_transactions、dorder の採番
+---   expense.account_histories (aid, payment_date, dorder)     dorder の採番（削除済みの行も含めて連番のため）
+---
+--- amount は索引に含めない（以降の残高の UPDATE が HOT 更新のままになるように）
+
+--- 残高取得（payment_date <= ? の最後の行）、以降の残高の UPDATE（payment_date > ?）、export の口座履歴
+create index account_histories_live_idx on expense.account_histories (aid, payment_date, dorder) where is_deleted = FALSE;
+
+--- 取引の口座履歴（delete_transaction、delete_transactions_bulk、口座のロック、BalanceTree.remove_many）
+create index account_histories_tid_idx on expense.account_histories (tid) where is_deleted = FALSE;
+
+analyze expense.account_histories;
+
+
+
+---
+drop index expense.account_histories_live_idx;
+drop index expense.account_histories_tid_idx;
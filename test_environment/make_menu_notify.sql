@@ -0,0 +1,55 @@
+--- 機能一覧の変更通知（Authorize.listen_menu_changes で受信し、機能一覧のキャッシュを破棄する）
+--- チャネル: auth_menu_changed、ペイロード: ユーザ名称（'*' は全ユーザ）
+
+--- 機能の変更は全ユーザに影響する
+create or replace function auth.notify_features_changed()
+returns trigger as $$
+begin
+  perform pg_notify('auth_menu_changed', '*');
+  return null;
+end;
+$$ LANGUAGE plpgsql;
+
+create trigger trg_notify_features_changed
+after insert or update or delete or truncate on auth.features
+for each statement
+execute function auth.notify_features_changed();
+
+--- 使用可能機能の変更は該当ユーザのみ
+create or replace function auth.notify_user_features_changed()
+returns trigger as $$
+begin
+  if TG_OP in ('UPDATE', 'DELETE') then
+    perform pg_notify('auth_menu_changed', u.uname) from auth.users u where u.uid = OLD.uid;
+  end if;
+  if TG_OP in ('INSERT', 'UPDATE') then
+    perform pg_notify('auth_menu_changed', u.uname) from auth.users u where u.uid = NEW.uid;
+  end if;
+  return null;
+end;
+$$ LANGUAGE plpgsql;
+
+create trigger trg_notify_user_features_changed
+after insert or update or delete on auth.user_features
+for each row
+execute function auth.notify_user_features_changed();
+
+create trigger trg_notify_user_features_truncated
+after truncate on auth.user_features
+for each statement
+execute function auth.notify_features_changed();
+
+--- ユーザ名称の変更（キャッシュのキーが変わる）
+create or replace function auth.notify_users_renamed()
+returns trigger as $$
+begin
+  perform pg_notify('auth_menu_changed', OLD.uname);
+  return null;
+end;
+$$ LANGUAGE plpgsql;
+
+create trigger trg_notify_users_renamed
+after update of uname on auth.users
+for each row
+when (OLD.uname is distinct from NEW.uname)
+execute function auth.notify_users_renamed();
@@ -0,0 +1,77 @@
+--- 月別集計（Expense.monthly_summary）
+--- expense.transactions の追加・更新と同じトランザクションで、文単位のトリガーがまとめて加算する
+
+create table expense.monthly_rollups (
+    uid          INTEGER                      NOT NULL,
+    month        DATE                         NOT NULL, -- 取引日の月初
+    purpose      TEXT                         NOT NULL,
+    pid          INTEGER                      NOT NULL, -- 0: 支払い方法なし
+    aid          INTEGER                      NOT NULL, -- 0: 入金口座なし
+    spent        BIGINT                       NOT NULL DEFAULT 0,
+    received     BIGINT                       NOT NULL DEFAULT 0,
+    count        INTEGER                      NOT NULL DEFAULT 0,
+    FOREIGN KEY (uid) REFERENCES auth.users(uid) ON DELETE CASCADE,
+    PRIMARY KEY (uid, month, purpose, pid, aid)
+);
+
+insert into expense.monthly_rollups (uid, month, purpose, pid, aid, spent, received, count)
+select uid, date_trunc('month', transaction_date)::date, purpose, coalesce(pid, 0), coalesce(aid, 0),
+       sum(amount_spent), sum(amount_received), count(*)
+from expense.transactions
+where is_deleted = FALSE
+group by 1, 2, 3, 4, 5;
+
+--- 削除されていない行を加算、更新前の削除されていない行を減算する
+create or replace function expense.apply_monthly_rollups()
+returns trigger as $$
+begin
+  if TG_OP = 'INSERT' then
+    insert into expense.monthly_rollups as r (uid, month, purpose, pid, aid, spent, received, count)
+    select uid, date_trunc('month', transaction_date)::date, purpose, coalesce(pid, 0), coalesce(aid, 0),
+           sum(amount_spent), sum(amount_received), count(*)
+    from new_rows
+    where is_deleted = FALSE
+    group by 1, 2, 3, 4, 5
+    on conflict (uid, month, purpose, pid, aid) do update
+    set spent = r.spent + excluded.spent,
+        received = r.received + excluded.received,
+        count = r.count + excluded.count;
+  else
+    insert into expense.monthly_rollups as r (uid, month, purpose, pid, aid, spent, received, count)
+    select uid, date_trunc('month', transaction_date)::date, purpose, coalesce(pid, 0), coalesce(aid, 0),
+           sum(sign * amount_spent), sum(sign * amount_received), sum(sign)
+    from (
+        select 1 as sign, * from new_rows where is_deleted = FALSE
+        union all
+        select -1 as sign, * from old_rows where is_deleted = FALSE
+    ) d
+    group by 1, 2, 3, 4, 5
+    having sum(sign) <> 0 or sum(sign * amount_spent) <> 0 or sum(sign * amount_received) <> 0
+    on conflict (uid, month, purpose, pid, aid) do update
+    set spent = r.spent + excluded.spent,
+        received = r.received + excluded.received,
+        count = r.count + excluded.count;
+  end if;
+  return NULL;
+end;
+$$ LANGUAGE plpgsql;
+
+create trigger trg_monthly_rollups_insert
+after insert on expense.transactions
+referencing new table as new_rows
+for each statement
+execute function expense.apply_monthly_rollups();
+
+create trigger trg_monthly_rollups_update
+after update on expense.transactions
+referencing old table as old_rows new table as new_rows
+for each statement
+execute function expense.apply_monthly_rollups();
+
+
+
+---
+drop trigger trg_monthly_rollups_insert on expense.transactions;
+drop trigger trg_monthly_rollups_update on expense.transactions;
+drop function expense.apply_monthly_rollups;
+drop table expense.monthly_rollups;
@@ -0,0 +1,161 @@
+--- 取引・口座履歴の日付による範囲パーティション（年単位。運用は source/python/partition.py）
+---
+--- expense.transactions は transaction_date、expense.account_histories は payment_date で年毎に分割する。
+--- 範囲外の日付は既定のパーティション（*_default）に入る。翌年以降のパーティションは partition.py create で作る。
+---
+--- 前提: make_bulk_dorder.sql（または make_dorder_counter.sql）を適用済みであること（退避時に dorder を指定して行を戻すため）
+---       削除済みの行を移す（partition.py compact）場合は make_dorder_counter.sql も必要
+---       （max(dorder)+1 の採番では、移した行の dorder が再び払い出され、キーセットページングの位置がずれるため）
+---       列を追加する migration（make_balance_tree.sql 等）の後に適用する（退避先の表は適用時の列で作る）
+---
+--- 主キー・一意制約はパーティションキーを含む必要があるため、主キーは (tid, transaction_date)、(hid, payment_date) になる
+--- （tid、hid は引き続き連番で一意）。account_histories.tid → transactions(tid) の外部キーは張れないため削除し、
+--- 代わりに制約トリガーでコミット時に検査する（削除されていない口座履歴が、運用中の取引を参照していること）。
+--- 表の索引（make_index.sql）・トリガー（make_monthly_rollup.sql 等）はそのまま作り直す。
+
+--- 退避先（partition.py archive / compact）
+create schema expense_archive;
+
+--- 表を年単位の範囲パーティションに置き換える（この migration の中だけで使う）
+create or replace function expense.partition_by_year(p_table text, p_key text, p_primary_key text)
+returns void as $$
+declare
+  v_name       text := split_part(p_table, '.', 2);
+  v_old        text := p_table || '_unpartitioned';
+  v_indexes    text[];
+  v_triggers   text[];
+  v_foreigns   text[];
+  v_uniques    text[];
+  v_pkey       text;
+  v_sequences  text[];
+  v_def        text;
+  v_from       integer;
+  v_to         integer;
+  v_year       integer;
+begin
+  -- 主キー以外の制約・索引・トリガー・連番の定義を控える
+  -- （account_histories.tid → transactions(tid) の外部キーは、先に transactions の元の表とともに削除される）
+  select coalesce(array_agg(pg_get_indexdef(indexrelid)), '{}') into v_indexes
+    from pg_index
+   where indrelid = p_table::regclass
+     and not exists (select 1 from pg_constraint where conindid = indexrelid);
+  select coalesce(array_agg(pg_get_triggerdef(oid)), '{}') into v_triggers
+    from pg_trigger
+   where tgrelid = p_table::regclass and not tgisinternal;
+  select coalesce(array_agg(format('constraint %I %s', conname, pg_get_constraintdef(oid))), '{}') into v_foreigns
+    from pg_constraint
+   where conrelid = p_table::regclass and contype = 'f';
+  select coalesce(array_agg(format('constraint %I %s', conname, pg_get_constraintdef(oid))), '{}') into v_uniques
+    from pg_constraint
+   where conrelid = p_table::regclass and contype = 'u';
+  select conname into v_pkey
+    from pg_constraint
+   where conrelid = p_table::regclass and contype = 'p';
+  select coalesce(array_agg(format('%s %I', pg_get_serial_sequence(p_table, attname), attname)), '{}') into v_sequences
+    from pg_attribute
+   where attrelid = p_table::regclass and attnum > 0 and not attisdropped
+     and pg_get_serial_sequence(p_table, attname) is not null;
+
+  execute format('alter table %s rename to %I', p_table, v_name || '_unpartitioned');
+
+  execute format('create table %s (like %s including defaults including constraints) partition by range (%I)', p_table, v_old, p_key);
+  -- 既存の行の年から翌年まで
+  execute format('select extract(year from min(%1$I))::integer, extract(year from max(%1$I))::integer from %2$s', p_key, v_old)
+     into v_from, v_to;
+  v_from := least(coalesce(v_from, extract(year from current_date)::integer), extract(year from current_date)::integer);
+  v_to := greatest(coalesce(v_to, 0), extract(year from current_date)::integer) + 1;
+  for v_year in v_from .. v_to loop
+    execute format('create table %s partition of %s for values from (%L) to (%L)',
+                   p_table || '_' || v_year, p_table, make_date(v_year, 1, 1), make_date(v_year + 1, 1, 1));
+  end loop;
+  execute format('create table %s partition of %s default', p_table || '_default', p_table);
+
+  execute format('insert into %s select * from %s', p_table, v_old);
+
+  foreach v_def in array v_sequences loop
+    execute format('alter sequence %s owned by %s.%I', split_part(v_def, ' ', 1), p_table, split_part(v_def, ' ', 2));
+  end loop;
+  execute format('drop table %s cascade', v_old);
+
+  -- 制約・索引・トリガーは元の表を削除してから作る（名前の重複を避ける）
+  execute format('alter table %s add constraint %I primary key (%s)', p_table, v_pkey, p_primary_key);
+  foreach v_def in array v_uniques || v_foreigns loop
+    execute format('alter table %s add %s', p_table, v_def);
+  end loop;
+  foreach v_def in array v_indexes loop
+    execute v_def;
+  end loop;
+  foreach v_def in array v_triggers loop
+    execute v_def;
+  end loop;
+  return;
+end;
+$$ LANGUAGE plpgsql;
+
+begin;
+
+--- 行の移動中に書き込まれないようにする
+lock table expense.transactions, expense.account_histories in access exclusive mode;
+
+--- トリガーは行を移した後に作るため、移し替えでは動かない（dorder・月別集計は元の値のまま）
+select expense.partition_by_year('expense.transactions', 'transaction_date', 'tid, transaction_date');
+select expense.partition_by_year('expense.account_histories', 'payment_date', 'hid, payment_date');
+
+drop function expense.partition_by_year;
+
+--- 退避した年のパーティションを付け替える先（partition.py archive）
+create table expense_archive.transactions (like expense.transactions) partition by range (transaction_date);
+create table expense_archive.account_histories (like expense.account_histories) partition by range (payment_date);
+
+--- 削除済みの行の移動先（partition.py compact）
+create table expense_archive.deleted_transactions (like expense.transactions);
+create table expense_archive.deleted_account_histories (like expense.account_histories);
+
+--- account_histories.tid → transactions(tid) の外部キーの代わり
+--- コミット時に検査する（パーティションの作成・退避で行を移す間は、一時的に参照先がなくてもよい）
+--- 削除済みの口座履歴は検査しない（partition.py compact で取引より先に移す）
+create or replace function expense.check_history_transaction()
+returns trigger as $$
+begin
+  if NEW.is_deleted = FALSE and not exists (select 1 from expense.transactions where tid = NEW.tid) then
+    raise foreign_key_violation using message = format('口座履歴の取引がありません: hid=%s, tid=%s', NEW.hid, NEW.tid);
+  end if;
+  return null;
+end;
+$$ LANGUAGE plpgsql;
+
+create or replace function expense.check_transaction_histories()
+returns trigger as $$
+begin
+  if exists (select 1 from expense.account_histories where tid = OLD.tid and is_deleted = FALSE)
+     and not exists (select 1 from expense.transactions where tid = OLD.tid) then
+    raise foreign_key_violation using message = format('口座履歴から参照されている取引です: tid=%s', OLD.tid);
+  end if;
+  return null;
+end;
+$$ LANGUAGE plpgsql;
+
+create constraint trigger trg_check_history_transaction
+after insert or update of tid on expense.account_histories
+deferrable initially deferred
+for each row execute function expense.check_history_transaction();
+
+create constraint trigger trg_check_transaction_histories
+after delete or update of tid on expense.transactions
+deferrable initially deferred
+for each row execute function expense.check_transaction_histories();
+
+commit;
+
+analyze expense.transactions;
+analyze expense.account_histories;
+
+
+
+---
+--- 元に戻す場合は、退避した行を含めて通常の表に作り直す（expense_archive の行を expense へ戻してから）
+drop trigger trg_check_history_transaction on expense.account_histories;
+drop trigger trg_check_transaction_histories on expense.transactions;
+drop function expense.check_history_transaction;
+drop function expense.check_transaction_histories;
+drop schema expense_archive cascade;